@@ -0,0 +1,225 @@
+import os
+import json
+import time
+import logging
+import threading
+import urllib.error
+import urllib.request
+
+from typing import Any, Dict, List, Optional
+from dataclasses import asdict
+
+from src.config import GenerationAPIConfig, MockServerConfig, to_dataclass
+
+logger = logging.getLogger("apiLogger")
+
+QUOTA_MESSAGE = 'You exceeded your current quota, please check your plan and billing details.'
+
+class BackendError(Exception):
+    """A request failed and sending it again won't help."""
+
+class RetryableError(BackendError):
+    """The request can be sent again after a backoff."""
+
+class RateLimited(RetryableError):
+    pass
+
+class QuotaExceeded(BackendError):
+    pass
+
+class Backend:
+    """Sends one batch of prompts and returns an OpenAI style completions response
+
+        {"choices": [{"text", "index", "logprobs", "finish_reason"}, ...], "usage": {...}}
+
+    with the n choices of every prompt flattened in prompt order. Backends raise
+    RetryableError (or RateLimited) when the scheduler should back off and retry,
+    and QuotaExceeded when generation has to stop. complete is called from several
+    threads at once.
+
+    cache_namespace keeps the cached completions of different backends apart.
+    """
+    cache_namespace = ""
+
+    def complete(self, api_cfg: GenerationAPIConfig, prompts: List[str]) -> Dict[str, Any]:
+        raise NotImplementedError("You must override complete for your backend!")
+
+    def close(self):
+        pass
+
+class OpenAIBackend(Backend):
+    def __init__(self, api_key_env: str = "OPENAI_API_KEY", api_base: Optional[str] = None, organization: Optional[str] = None):
+        import openai
+        # Read once when the backend is built instead of on every request
+        self.api_key = os.getenv(api_key_env)
+        self.api_base = api_base
+        self.organization = organization
+        self._openai = openai
+        # Completions from another server (a local or fake one) must not be mixed into the OpenAI ones
+        self.cache_namespace = api_base.rstrip('/') if api_base else ""
+
+    def complete(self, api_cfg: GenerationAPIConfig, prompts: List[str]) -> Dict[str, Any]:
+        from openai import error
+
+        options = asdict(api_cfg)
+        if self.api_base:
+            options["api_base"] = self.api_base
+        if self.organization:
+            options["organization"] = self.organization
+        try:
+            return self._openai.Completion.create(prompt=prompts, api_key=self.api_key, **options)
+        except error.RateLimitError as e:
+            if str(e) == QUOTA_MESSAGE:
+                raise QuotaExceeded(str(e)) from e
+            raise RateLimited(str(e)) from e
+        except (error.ServiceUnavailableError, error.Timeout, error.APIConnectionError) as e:
+            raise RetryableError(str(e)) from e
+
+class HTTPBackend(Backend):
+    """Any server with the OpenAI completions endpoint, e.g. the mock server or a local inference server."""
+    def __init__(self, api_base: str = "", api_key_env: str = "", timeout: float = 600.0):
+        self.api_base = api_base.rstrip('/')
+        self.api_key = os.getenv(api_key_env) if api_key_env else None
+        self.timeout = timeout
+        self.cache_namespace = self.api_base
+
+    def complete(self, api_cfg: GenerationAPIConfig, prompts: List[str]) -> Dict[str, Any]:
+        body = json.dumps({**asdict(api_cfg), "prompt": prompts}).encode('utf-8')
+        headers = {'Content-Type': 'application/json'}
+        if self.api_key:
+            headers['Authorization'] = f'Bearer {self.api_key}'
+        request = urllib.request.Request(f'{self.api_base}/completions', data=body, headers=headers, method='POST')
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            message = self._error_message(e)
+            if e.code == 429:
+                if message == QUOTA_MESSAGE:
+                    raise QuotaExceeded(message) from e
+                raise RateLimited(message) from e
+            if e.code >= 500:
+                raise RetryableError(message) from e
+            raise BackendError(message) from e
+        except (urllib.error.URLError, TimeoutError, ConnectionError) as e:
+            raise RetryableError(str(e)) from e
+
+    @staticmethod
+    def _error_message(e: urllib.error.HTTPError) -> str:
+        try:
+            return json.loads(e.read())["error"]["message"]
+        except (ValueError, KeyError, TypeError):
+            return f'HTTP {e.code} {e.reason}'
+
+class MockBackend(HTTPBackend):
+    """HTTPBackend pointed at src.mock_server. Without an api_base the server is started in this process."""
+    def __init__(self, api_base: str = "", server: Optional[MockServerConfig] = None, timeout: float = 600.0):
+        from src.mock_server import MockCompletionServer
+
+        self.server = None
+        if not api_base:
+            self.server = MockCompletionServer(to_dataclass(server, MockServerConfig) or MockServerConfig()).start()
+            api_base = self.server.url
+        super().__init__(api_base, timeout=timeout)
+        # The port changes from run to run
+        self.cache_namespace = 'mock'
+
+    def close(self):
+        if self.server is not None:
+            self.server.stop()
+            self.server = None
+
+class TransformersBackend(Backend):
+    """A local causal LM from the huggingface hub, run in this process. Needs torch."""
+    def __init__(self, model: str = "gpt2", device: str = "cpu", torch_threads: int = 0, seed: int = 42):
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        if torch_threads:
+            torch.set_num_threads(torch_threads)
+        self._torch = torch
+        self.device = device
+        self.seed = seed
+        self.cache_namespace = f'transformers:{model}'
+        self.tokenizer = AutoTokenizer.from_pretrained(model)
+        # Left padding so every prompt in the batch ends right where generation starts
+        self.tokenizer.padding_side = 'left'
+        # Drop the start of long prompts like the scheduler's default truncation
+        self.tokenizer.truncation_side = 'left'
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.model = AutoModelForCausalLM.from_pretrained(model).to(device).eval()
+        self.max_length = getattr(self.model.config, 'max_position_embeddings', None) or self.tokenizer.model_max_length
+        # One generate call at a time. torch already uses every core for a single batch
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _cut_at_stop(text: str, stop: List[str]) -> str:
+        cut = min((text.find(s) for s in stop if s and s in text), default=-1)
+        return text[:cut] if cut >= 0 else text
+
+    def complete(self, api_cfg: GenerationAPIConfig, prompts: List[str]) -> Dict[str, Any]:
+        torch = self._torch
+        n = max(api_cfg.n, 1)
+        inputs = self.tokenizer(
+            prompts, return_tensors='pt', padding=True, truncation=True,
+            max_length=max(self.max_length - api_cfg.max_tokens, 1),
+        ).to(self.device)
+        sample = api_cfg.temperature > 0
+
+        with self._lock, torch.no_grad():
+            torch.manual_seed(self.seed)
+            output = self.model.generate(
+                **inputs,
+                max_new_tokens=api_cfg.max_tokens,
+                do_sample=sample,
+                temperature=api_cfg.temperature if sample else None,
+                top_p=api_cfg.top_p if sample else None,
+                num_return_sequences=n,
+                pad_token_id=self.tokenizer.pad_token_id,
+                return_dict_in_generate=True,
+                output_scores=bool(api_cfg.logprobs),
+            )
+
+        n_prompt_tokens = inputs['input_ids'].shape[1]
+        generated = output.sequences[:, n_prompt_tokens:]
+        token_logprobs = None
+        if api_cfg.logprobs:
+            token_logprobs = self.model.compute_transition_scores(output.sequences, output.scores, normalize_logits=True)
+
+        choices = []
+        completion_tokens = 0
+        for i, tokens in enumerate(generated):
+            tokens = tokens[tokens != self.tokenizer.pad_token_id]
+            completion_tokens += len(tokens)
+            text = self.tokenizer.decode(tokens, skip_special_tokens=True)
+            stopped = self._cut_at_stop(text, api_cfg.stop)
+            logprobs = None
+            if token_logprobs is not None:
+                token_strings = self.tokenizer.convert_ids_to_tokens(tokens)
+                logprobs = {
+                    "tokens": token_strings,
+                    "token_logprobs": token_logprobs[i, :len(tokens)].tolist(),
+                    "top_logprobs": None,
+                    "text_offset": [],
+                }
+            choices.append({
+                "text": stopped,
+                "index": i,
+                "logprobs": logprobs,
+                "finish_reason": "stop" if stopped != text or len(tokens) < api_cfg.max_tokens else "length",
+            })
+
+        prompt_tokens = int(inputs['attention_mask'].sum())
+        return {
+            "id": f'cmpl-local-{time.time_ns()}',
+            "object": "text_completion",
+            "created": int(time.time()),
+            "model": self.model.config.name_or_path,
+            "choices": choices,
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
@@ -0,0 +1,93 @@
+import logging
+
+from typing import List, Tuple
+
+from src.config import SchedulerConfig
+
+logger = logging.getLogger("apiLogger")
+
+TRUNCATION_POLICIES = ('left', 'right', 'none')
+
+class TokenCounter:
+    """Counts prompt tokens with a local tokenizer. GPT3 uses the same BPE as gpt2."""
+    def __init__(self, tokenizer_name: str = "gpt2"):
+        from transformers import AutoTokenizer
+        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+
+    def encode(self, prompts: List[str]) -> List[List[int]]:
+        return self.tokenizer(prompts, add_special_tokens=False)["input_ids"]
+
+    def decode(self, token_ids: List[int]) -> str:
+        return self.tokenizer.decode(token_ids, clean_up_tokenization_spaces=False)
+
+def truncate(
+    counter: TokenCounter,
+    prompts: List[str],
+    token_ids: List[List[int]],
+    max_prompt_tokens: int,
+    policy: str,
+) -> Tuple[List[str], List[int]]:
+    """Shorten the prompts longer than max_prompt_tokens.
+    left drops tokens from the start (the header and few shot examples go first), right drops them from the end
+    and none leaves the prompt for the API to reject."""
+    if policy not in TRUNCATION_POLICIES:
+        raise ValueError(f'Unknown truncation policy {policy}. Choose one of {TRUNCATION_POLICIES}')
+
+    prompts = list(prompts)
+    counts = [len(ids) for ids in token_ids]
+    for i, ids in enumerate(token_ids):
+        if counts[i] <= max_prompt_tokens or policy == 'none':
+            continue
+        logger.warning(f'Prompt {i} has {counts[i]} tokens. Truncating it from the {policy} to {max_prompt_tokens}')
+        keep = ids[-max_prompt_tokens:] if policy == 'left' else ids[:max_prompt_tokens]
+        prompts[i] = counter.decode(keep)
+        counts[i] = len(keep)
+    return prompts, counts
+
+def pack_slices(
+    prompt_tokens: List[int],
+    completion_tokens: int,
+    max_request_tokens: int,
+    max_batch_size: int,
+) -> List[Tuple[int, int]]:
+    """Greedily pack consecutive prompts into requests of at most max_request_tokens
+    prompt + completion tokens and max_batch_size prompts. Keeping the slices contiguous
+    keeps the predictions in prompt order. A prompt over the budget gets a request to itself."""
+    slices = []
+    start, total = 0, 0
+    for i, n_tokens in enumerate(prompt_tokens):
+        cost = n_tokens + completion_tokens
+        if i > start and (total + cost > max_request_tokens or i - start >= max_batch_size):
+            slices.append((start, i))
+            start, total = i, 0
+        total += cost
+    if start < len(prompt_tokens):
+        slices.append((start, len(prompt_tokens)))
+    return slices
+
+def plan_batches(
+    cfg: SchedulerConfig,
+    prompts: List[str],
+    max_tokens: int,
+    completion_tokens: int,
+) -> Tuple[List[str], List[Tuple[int, int]], List[int]]:
+    """Token aware batching. Returns the (possibly truncated) prompts, the request slices
+    and the token count of every prompt."""
+    counter = TokenCounter(cfg.tokenizer)
+    token_ids = counter.encode(prompts)
+    prompts, counts = truncate(
+        counter, prompts, token_ids,
+        max_prompt_tokens=max(1, cfg.context_window - max_tokens),
+        policy=cfg.truncation,
+    )
+    slices = pack_slices(counts, completion_tokens, cfg.max_request_tokens, max(1, cfg.batch_size))
+
+    batch_tokens = [sum(counts[start:end]) + completion_tokens * (end - start) for start, end in slices]
+    for (start, end), n_tokens in zip(slices, batch_tokens):
+        logger.debug(f'Batch of prompts {start} through {end} has {n_tokens} tokens')
+    if batch_tokens:
+        logger.info(
+            f'Packed {len(prompts)} prompts into {len(slices)} requests. Tokens per request '
+            f'min {min(batch_tokens)} mean {sum(batch_tokens) / len(batch_tokens):.0f} max {max(batch_tokens)}'
+        )
+    return prompts, slices, counts
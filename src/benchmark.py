@@ -0,0 +1,290 @@
+import os
+import json
+import time
+import random
+import logging
+import platform
+import resource
+import statistics
+import subprocess
+
+from typing import Any, Callable, Dict, List
+from pathlib import Path
+
+import hydra
+
+from omegaconf import OmegaConf
+
+from src.config import (
+    CacheConfig,
+    MockServerConfig,
+    SchedulerConfig,
+    GenerationAPIConfig,
+    to_dataclass,
+)
+from src.metrics import answer_tokens, hotpot_qa_eval, normalize_answer, nq_open_eval
+from src.backends import MockBackend
+from src.instrument import PeakRSS, max_rss_bytes
+from src.main import batch_generate
+
+logger = logging.getLogger("apiLogger")
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ren', 'to', 'sa', 'vin', 'du', 'pe', 'ri', 'an', 'gor', 'el', 'shu']
+
+def git_commit() -> Dict[str, Any]:
+    repo = Path(__file__).resolve().parents[1]
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=repo, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return {"commit": None, "dirty": None}
+    return {"commit": commit, "dirty": bool(dirty)}
+
+"""
+Synthetic data with the columns of the huggingface hotpot_qa and nq_open datasets
+"""
+def _word(rng: random.Random) -> str:
+    return ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 3)))
+
+def _sentence(rng: random.Random, n_words: int) -> str:
+    return ' '.join(_word(rng) for _ in range(n_words)).capitalize() + '. '
+
+def hotpot_qa_rows(n: int, seed: int = 0) -> List[Dict[str, Any]]:
+    rng = random.Random(seed)
+    rows = []
+    for i in range(n):
+        titles = [_word(rng).title() for _ in range(10)]
+        sentences = [[_sentence(rng, rng.randint(8, 25)) for _ in range(rng.randint(2, 5))] for _ in titles]
+        rows.append({
+            "id": f'{seed:x}{i:08x}',
+            "question": _sentence(rng, rng.randint(6, 18))[:-2] + '?',
+            "answer": ' '.join(_word(rng) for _ in range(rng.randint(1, 3))),
+            "type": rng.choice(['bridge', 'comparison']),
+            "level": rng.choice(['easy', 'medium', 'hard']),
+            "supporting_facts": {"title": titles[:2], "sent_id": [0, 1]},
+            "context": {"title": titles, "sentences": sentences},
+        })
+    return rows
+
+def nq_open_rows(n: int, seed: int = 0) -> List[Dict[str, Any]]:
+    rng = random.Random(seed)
+    return [
+        {
+            "question": _sentence(rng, rng.randint(5, 12))[:-2].lower(),
+            "answer": [' '.join(_word(rng) for _ in range(rng.randint(1, 3))) for _ in range(rng.randint(1, 3))],
+        }
+        for _ in range(n)
+    ]
+
+def write_jsonl(fname: str, rows: List[Dict[str, Any]]):
+    with open(fname, 'w') as f:
+        for row in rows:
+            f.write(json.dumps(row) + '\n')
+
+def synthetic_predictions(data: Any, label_col: str, seed: int = 0) -> Dict[Any, str]:
+    """A third exact, a third partially right and a third wrong so every scoring path is hit."""
+    rng = random.Random(seed)
+    predictions = {}
+    for id, answer in zip(data['id'], data[label_col]):
+        gold = answer[0] if isinstance(answer, list) else answer
+        kind = rng.randrange(3)
+        if kind == 0:
+            predictions[id] = gold
+        elif kind == 1:
+            predictions[id] = f'the {gold} {_word(rng)}'
+        else:
+            predictions[id] = _word(rng)
+    return predictions
+
+"""
+Benchmarks
+"""
+def timed(fn: Callable[[], Any], repeats: int) -> Dict[str, Any]:
+    seconds = []
+    with PeakRSS() as rss:
+        for _ in range(max(repeats, 1)):
+            start = time.perf_counter()
+            fn()
+            seconds.append(time.perf_counter() - start)
+    return {"seconds": seconds, "median_seconds": statistics.median(seconds), "peak_rss_mb": rss.peak / 2**20}
+
+def bench_preprocess(dataset: Any, repeats: int) -> Dict[str, Any]:
+    n_rows = len(dataset.dataset)
+    batches = [dataset.dataset[i:i + dataset.batch_size] for i in range(0, n_rows, dataset.batch_size)]
+
+    def preprocess():
+        # _preprocess writes into the batch so every repeat gets fresh copies
+        for batch in batches:
+            dataset._preprocess(dict(batch))
+
+    result = {"rows": n_rows, "preprocess": timed(preprocess, repeats)}
+    result["preprocess"]["rows_per_sec"] = n_rows / result["preprocess"]["median_seconds"]
+
+    # The full datasets map, including writing the arrow cache file
+    dataset.load_from_cache = False
+    result["map"] = timed(dataset, repeats)
+    result["map"]["rows_per_sec"] = n_rows / result["map"]["median_seconds"]
+    return result
+
+def bench_scoring(eval_fn: Callable, dataset: Any, num_workers: int, seed: int, repeats: int) -> Dict[str, Any]:
+    data = dataset.dataset
+    predictions = synthetic_predictions(data, dataset.label_col, seed)
+    metrics = {}
+
+    def score():
+        # Time cold caches, like a fresh run sees them
+        normalize_answer.cache_clear()
+        answer_tokens.cache_clear()
+        metrics.update(eval_fn(predictions=predictions, ground_truths=data, num_workers=num_workers)[0])
+
+    result = timed(score, repeats)
+    result["questions"] = len(predictions)
+    result["questions_per_sec"] = len(predictions) / result["median_seconds"]
+    result["metrics"] = dict(metrics)
+    return result
+
+def bench_generation(
+    api: GenerationAPIConfig,
+    scheduler: SchedulerConfig,
+    server_cfg: MockServerConfig,
+    prompts: List[str],
+    data_dir: str,
+) -> Dict[str, Any]:
+    results_log = os.path.join(data_dir, 'generations.jsonl')
+    if os.path.exists(results_log):
+        os.remove(results_log)
+
+    backend = MockBackend(server=server_cfg)
+    server = backend.server
+    try:
+        with PeakRSS() as rss:
+            start = time.perf_counter()
+            predictions = batch_generate(
+                api, prompts,
+                scheduler=scheduler,
+                cache=CacheConfig(enabled=False),
+                results_log=results_log,
+                backend=backend,
+            )
+            seconds = time.perf_counter() - start
+        return {
+            "prompts": len(prompts),
+            "generated": len(predictions),
+            "seconds": seconds,
+            "prompts_per_sec": len(predictions) / seconds,
+            "requests": server.n_requests,
+            "rate_limited": server.n_rate_limited,
+            "peak_rss_mb": rss.peak / 2**20,
+        }
+    finally:
+        backend.close()
+
+def throughputs(results: Dict[str, Any], prefix: str = '') -> Dict[str, float]:
+    """Flatten every *_per_sec value so two runs can be compared key by key."""
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(throughputs(value, f'{prefix}{key}.'))
+        elif key.endswith('_per_sec'):
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+def compare(baseline: Dict[str, Any], results: Dict[str, Any]) -> Dict[str, float]:
+    """Throughput relative to the baseline run. Above 1 is faster."""
+    before = throughputs(baseline["results"])
+    after = throughputs(results)
+    ratios = {key: after[key] / before[key] for key in after if before.get(key)}
+    for key, ratio in ratios.items():
+        logger.info(f'{key}: {ratio:.2f}x of {baseline.get("commit") or "baseline"}')
+    return ratios
+
+def run_benchmarks(
+    hotpot_qa: Any,
+    nq_open: Any,
+    api: GenerationAPIConfig,
+    scheduler: SchedulerConfig,
+    server: MockServerConfig,
+    stages: List[str],
+    n_rows: int,
+    n_prompts: int,
+    repeats: int,
+    num_workers: int,
+    seed: int,
+    data_dir: str,
+    output_fname: str,
+    baseline: str,
+    **kw,
+) -> Dict[str, Any]:
+    """Time preprocessing, scoring and generation offline. Run it with
+
+        python -m src.main --config-name benchmark
+
+    and compare commits by pointing baseline at the benchmark.json of another run."""
+    api = to_dataclass(api, GenerationAPIConfig)
+    scheduler = to_dataclass(scheduler, SchedulerConfig)
+    server = to_dataclass(server, MockServerConfig)
+    os.makedirs(data_dir, exist_ok=True)
+    data_dir = os.path.abspath(data_dir)
+
+    results: Dict[str, Any] = {}
+    datasets = {}
+    for name, dataset_cfg, make_rows, eval_fn in (
+        ('hotpot_qa', hotpot_qa, hotpot_qa_rows, hotpot_qa_eval),
+        ('nq_open', nq_open, nq_open_rows, nq_open_eval),
+    ):
+        n_extra = max(dataset_cfg.n_few_shot, 0)
+        fname = os.path.join(data_dir, f'{name}_{n_rows}_{seed}.jsonl')
+        if not os.path.exists(fname):
+            logger.info(f'Writing {n_rows} synthetic {name} rows to {fname}')
+            write_jsonl(fname, make_rows(n_rows + n_extra, seed))
+
+        start = time.perf_counter()
+        dataset = hydra.utils.instantiate(
+            dataset_cfg,
+            name='json', option=None, split='train', data_files=fname,
+            cache_dir=os.path.join(data_dir, 'hf_cache'),
+            select_n_samples=n_rows, shuffle=False, streaming=False,
+        )
+        results[name] = {"load_seconds": time.perf_counter() - start}
+        datasets[name] = dataset
+
+        if 'preprocess' in stages:
+            logger.info(f'Benchmarking {name} preprocessing')
+            results[name].update(bench_preprocess(dataset, repeats))
+        if 'scoring' in stages:
+            logger.info(f'Benchmarking {name} scoring')
+            results[name]["scoring"] = bench_scoring(eval_fn, dataset, num_workers, seed, repeats)
+
+    if 'generation' in stages:
+        logger.info(f'Benchmarking generation of {n_prompts} prompts against the mock server')
+        dataset = datasets['hotpot_qa']
+        data = dataset.dataset.select(range(min(n_prompts, len(dataset.dataset))))
+        prompts = list(dataset.prompts(data.map(dataset._preprocess, batched=True, load_from_cache_file=False)))
+        results["generation"] = bench_generation(api, scheduler, server, prompts, data_dir)
+
+    output = {
+        **git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "time": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "config": {"n_rows": n_rows, "n_prompts": n_prompts, "repeats": repeats, "num_workers": num_workers, "seed": seed,
+                   "server": OmegaConf.to_container(OmegaConf.structured(server))},
+        "results": results,
+        "peak_rss_mb": max_rss_bytes() / 2**20,
+        "peak_rss_children_mb": max_rss_bytes(resource.RUSAGE_CHILDREN) / 2**20,
+    }
+    if baseline:
+        with open(hydra.utils.to_absolute_path(baseline)) as f:
+            output["vs_baseline"] = compare(json.load(f), results)
+
+    for key, value in throughputs(results).items():
+        logger.info(f'{key}: {value:,.1f}')
+    with open(output_fname, 'w') as f:
+        json.dump(output, f, indent=4)
+    logger.info(f'Wrote the benchmark results to {output_fname}')
+    return output
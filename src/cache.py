@@ -0,0 +1,138 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+from typing import Any, Dict, List, Optional
+from dataclasses import asdict
+
+from src.config import CacheConfig, GenerationAPIConfig, to_dataclass
+from src.sqlite_util import select_many
+
+logger = logging.getLogger("apiLogger")
+
+# These options don't change the text we get back so they are not part of the key
+IGNORED_API_FIELDS = ('stream',)
+
+def sampling_params(api_cfg: GenerationAPIConfig) -> Dict[str, Any]:
+    params = asdict(api_cfg)
+    for name in IGNORED_API_FIELDS:
+        params.pop(name, None)
+    return params
+
+def completion_key(prompt: str, params: Dict[str, Any]) -> str:
+    """Content address of a completion. The prompt plus every sampling parameter
+    (model, temperature, top_p, max_tokens, stop, logit_bias, n, seed, ...)."""
+    payload = json.dumps({"prompt": prompt, "params": params}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class CompletionCache:
+    """On disk SQLite cache of the choices returned for a single prompt.
+
+    Entries are evicted least recently used first once the stored choices grow past max_size_mb.
+    Safe to share between the scheduler worker threads.
+    """
+    def __init__(self, path: str, max_size_mb: float = 0):
+        self.path = os.path.expanduser(path)
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS completions ("
+                "key TEXT PRIMARY KEY, choices TEXT NOT NULL, "
+                "size INTEGER NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS completions_last_used ON completions (last_used)")
+
+    @classmethod
+    def from_config(cls, cfg: CacheConfig) -> Optional["CompletionCache"]:
+        if not cfg.enabled or not cfg.path:
+            return None
+        return cls(cfg.path, cfg.max_size_mb)
+
+    def get_many(self, keys: List[str]) -> List[Optional[List[Dict[str, Any]]]]:
+        with self._lock:
+            found = select_many(self._conn, 'completions', 'choices', keys)
+            if found:
+                now = time.time()
+                with self._conn:
+                    self._conn.executemany(
+                        "UPDATE completions SET last_used = ? WHERE key = ?",
+                        [(now, key) for key in found],
+                    )
+
+        results = [json.loads(found[key]) if key in found else None for key in keys]
+        hits = sum(result is not None for result in results)
+        self.hits += hits
+        self.misses += len(keys) - hits
+        return results
+
+    def put_many(self, keys: List[str], choices: List[List[Dict[str, Any]]]):
+        now = time.time()
+        rows = []
+        for key, value in zip(keys, choices):
+            value = json.dumps(value)
+            rows.append((key, value, len(value), now))
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO completions (key, choices, size, last_used) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+
+    def size_bytes(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+
+    def evict(self) -> int:
+        """Drop the least recently used entries until we are under max_size_bytes. Returns how many were removed."""
+        if not self.max_size_bytes:
+            return 0
+        total = self.size_bytes()
+        if total <= self.max_size_bytes:
+            return 0
+
+        removed = []
+        with self._lock:
+            for key, size in self._conn.execute("SELECT key, size FROM completions ORDER BY last_used"):
+                if total <= self.max_size_bytes:
+                    break
+                removed.append((key,))
+                total -= size
+            with self._conn:
+                self._conn.executemany("DELETE FROM completions WHERE key = ?", removed)
+        logger.info(f'Evicted {len(removed)} completions from the cache')
+        return len(removed)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        # Not evicting here, batch_generate opens and closes the cache for every batch when streaming
+        logger.info(f'Completion cache stats: {self.stats()}')
+        self._conn.close()
+
+def evict_completions(cfg: CacheConfig):
+    """Trim the cache to max_size_mb. Called once at the end of a run since finding the
+    total size scans the whole table."""
+    cache = CompletionCache.from_config(to_dataclass(cfg, CacheConfig))
+    if cache is None:
+        return
+    try:
+        cache.evict()
+        logger.info(f'The completion cache holds {cache.size_bytes()} bytes')
+    finally:
+        cache._conn.close()
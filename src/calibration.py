@@ -0,0 +1,136 @@
+import logging
+
+from typing import Any, Dict, Optional, Sequence
+
+import numpy as np
+
+from src.store import ScoreStore
+
+logger = logging.getLogger("apiLogger")
+
+class RaggedLogprobs:
+    """The token logprobs of every prediction in one flat float32 array.
+
+    The logprobs of the question in row i are values[offsets[i]:offsets[i + 1]], so any
+    per question reduction is a couple of numpy calls instead of a loop over the responses.
+    Questions without logprobs have an empty slice.
+    """
+    def __init__(self, ids: Sequence[Any], values: np.ndarray, offsets: np.ndarray):
+        self.ids = list(ids)
+        self.values = values
+        self.offsets = offsets
+
+    @classmethod
+    def from_lists(cls, ids: Sequence[Any], logprobs: Sequence[Optional[Sequence[float]]]) -> "RaggedLogprobs":
+        lengths = np.fromiter((len(lp) if lp else 0 for lp in logprobs), dtype=np.int64, count=len(logprobs))
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        values = np.fromiter((v for lp in logprobs if lp for v in lp), dtype=np.float32, count=int(offsets[-1]))
+        return cls(ids, values, offsets)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __getitem__(self, row: int) -> np.ndarray:
+        return self.values[self.offsets[row]:self.offsets[row + 1]]
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def sums(self) -> np.ndarray:
+        # Differences of the running sum, so empty slices come out as 0
+        cumsum = np.concatenate(([0.0], np.cumsum(self.values, dtype=np.float64)))
+        return cumsum[self.offsets[1:]] - cumsum[self.offsets[:-1]]
+
+    def means(self) -> np.ndarray:
+        """Mean token logprob per question, nan without logprobs."""
+        lengths = self.lengths
+        return np.divide(self.sums(), lengths, out=np.full(len(lengths), np.nan), where=lengths > 0)
+
+    def save(self, fname: str):
+        np.savez(fname, ids=np.asarray(self.ids), values=self.values, offsets=self.offsets)
+
+    @classmethod
+    def load(cls, fname: str) -> "RaggedLogprobs":
+        with np.load(fname) as arrays:
+            return cls(arrays['ids'].tolist(), arrays['values'], arrays['offsets'])
+
+def _ranks(x: np.ndarray) -> np.ndarray:
+    """Ranks starting at 1 with ties given their average rank."""
+    order = np.argsort(x, kind='stable')
+    ranks = np.empty(len(x), dtype=np.float64)
+    ranks[order] = np.arange(1, len(x) + 1)
+    _, inverse, counts = np.unique(x, return_inverse=True, return_counts=True)
+    return (np.bincount(inverse, weights=ranks) / counts)[inverse]
+
+def _pearson(x: np.ndarray, y: np.ndarray) -> Optional[float]:
+    if len(x) < 2 or np.std(x) == 0 or np.std(y) == 0:
+        return None
+    return float(np.corrcoef(x, y)[0, 1])
+
+def auroc(confidence: np.ndarray, correct: np.ndarray) -> Optional[float]:
+    """How well the confidence separates right from wrong answers (Mann-Whitney U)."""
+    n_correct = int(correct.sum())
+    n_wrong = len(correct) - n_correct
+    if not n_correct or not n_wrong:
+        return None
+    ranks = _ranks(confidence)
+    return float((ranks[correct].sum() - n_correct * (n_correct + 1) / 2) / (n_correct * n_wrong))
+
+def calibration_curve(confidence: np.ndarray, correct: np.ndarray, n_bins: int) -> Dict[str, Any]:
+    """Equal width confidence bins with the accuracy in each, and the expected calibration error."""
+    bins = np.minimum((confidence * n_bins).astype(np.int64), n_bins - 1)
+    counts = np.bincount(bins, minlength=n_bins)
+    confidence_sums = np.bincount(bins, weights=confidence, minlength=n_bins)
+    correct_sums = np.bincount(bins, weights=correct, minlength=n_bins)
+    nonempty = counts > 0
+    mean_confidence = np.divide(confidence_sums, counts, out=np.zeros(n_bins), where=nonempty)
+    accuracy = np.divide(correct_sums, counts, out=np.zeros(n_bins), where=nonempty)
+    ece = float((counts * np.abs(accuracy - mean_confidence)).sum() / max(len(confidence), 1))
+    return {
+        "ece": ece,
+        "bins": [
+            {"lower": k / n_bins, "upper": (k + 1) / n_bins, "count": int(counts[k]),
+             "confidence": float(mean_confidence[k]), "accuracy": float(accuracy[k])}
+            for k in range(n_bins)
+        ],
+    }
+
+def analyze(logprobs: RaggedLogprobs, per_question_metrics: ScoreStore, n_bins: int = 10) -> Dict[str, Any]:
+    """Per question confidence against the per question metrics of the run.
+
+    The confidence of an answer is the probability of its whole sequence, exp(sum of the
+    token logprobs). It is compared to em with a calibration curve, the ECE and the AUROC,
+    and the sum and mean logprob are correlated (Pearson and Spearman) with em and f1.
+    Only the questions that have both logprobs and scores are used.
+    """
+    rows = per_question_metrics.rows(logprobs.ids)
+    usable = (rows >= 0) & (logprobs.lengths > 0)
+    rows = rows[usable]
+    sums = logprobs.sums()[usable]
+    means = logprobs.means()[usable]
+    em = per_question_metrics.columns['em'][rows]
+    f1 = per_question_metrics.columns['f1'][rows].astype(np.float64)
+    confidence = np.exp(sums)
+
+    result = {
+        "n_questions": len(logprobs),
+        "n_with_logprobs": int(usable.sum()),
+        "mean_confidence": float(confidence.mean()) if len(confidence) else None,
+        "accuracy": float(em.mean()) if len(em) else None,
+        "auroc": auroc(confidence, em),
+    }
+    result.update(calibration_curve(confidence, em.astype(np.float64), n_bins))
+
+    correlations = {}
+    for name, values in (('sum_logprob', sums), ('mean_logprob', means)):
+        for metric_name, metric in (('em', em.astype(np.float64)), ('f1', f1)):
+            correlations[f'{name}_{metric_name}'] = {
+                "pearson": _pearson(values, metric),
+                "spearman": _pearson(_ranks(values), _ranks(metric)) if len(values) else None,
+            }
+    result["correlations"] = correlations
+
+    logger.info(f'Calibration over {result["n_with_logprobs"]} questions: ECE {result["ece"]:.4f}, AUROC {result["auroc"]}')
+    return result
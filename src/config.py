@@ -2,6 +2,7 @@ from typing import Optional, Any, Dict, List
 from dataclasses import dataclass, field
 
 from hydra.core.config_store import ConfigStore
+from omegaconf import OmegaConf
 
 @dataclass
 class PartialInstantiableConfig:
@@ -58,8 +59,31 @@ class DatasetConfig(InstantiableConfig):
     load_from_cache: bool = True
     split: Optional[str] = None
     option: Optional[str] = None
+    # Passed to load_dataset, e.g. name: json with a local file. Real type is Union[str, List[str], Dict[str, str]]
+    data_files: Any = None
     cache_dir: Optional[str] = None
     few_shot_examples: Optional[List[str]] = field(default_factory=list)
+    # Only keep the per row part of the prompt in text_col. The header, few shot examples
+    # and prefix are stored once and added back when the prompts are sent
+    share_prefix: bool = False
+    # Number of processes used to preprocess the dataset
+    num_proc: Optional[int] = None
+    # Stream the split instead of downloading and loading all of it. The prompts are
+    # preprocessed lazily in batches and sent as soon as each batch is ready
+    streaming: bool = False
+    shuffle_buffer_size: int = 10000
+    # "bm25" picks the n_few_shot most similar examples for every question from the
+    # few_shot_pool_size rows after the samples, searched on retrieval_col.
+    # Empty uses the same few shot examples for every question
+    few_shot_retrieval: str = ""
+    few_shot_pool_size: int = 1000
+    retrieval_col: str = "question"
+    # Only load the columns the prompts and the metrics read (see _needed_columns in
+    # src.our_datasets). Every other column is dropped right after loading
+    project_columns: bool = True
+    # Add the gold_norm column (the normalized gold answers) once when the split is loaded
+    # so scoring only normalizes the predictions
+    normalize_golds: bool = True
 
 @dataclass
 class HotPotQAConfig(DatasetConfig):
@@ -75,6 +99,11 @@ class NQOpenConfig(DatasetConfig):
 class MetricConfig(PartialInstantiableConfig):
     predictions: Dict[str, str] = field(default_factory=dict)
     ground_truths: Dict[str, str] = field(default_factory=dict)
+    # Score the questions in this many processes. 1 scores them in this process
+    num_workers: int = 1
+    # SQLite file of the per question scores from earlier runs. Only new or changed
+    # predictions are rescored. Empty string scores everything
+    score_cache: str = ""
 
 @dataclass
 class GenerationAPIConfig:
@@ -93,9 +122,41 @@ class GenerationAPIConfig:
     stop: List[str] = field(default_factory=list)
     logit_bias: Dict[str, float] = field(default_factory=dict)
 
+@dataclass
+class SchedulerConfig:
+    """Controls how batch_generate splits the prompts into requests and paces them.
+    A budget of 0 disables that limit."""
+    batch_size: int = 20
+    max_in_flight: int = 4
+    requests_per_minute: int = 60
+    tokens_per_minute: int = 150000
+    max_retries: int = 8
+    backoff_base: float = 1.0
+    backoff_max: float = 60.0
+    # Pack prompts into requests of at most this many prompt + completion tokens,
+    # still capped at batch_size prompts. 0 uses fixed batches of batch_size
+    max_request_tokens: int = 0
+    tokenizer: str = "gpt2"
+    # Prompts longer than context_window - max_tokens are truncated: left, right or none
+    context_window: int = 4097
+    truncation: str = "left"
+
+@dataclass
+class CacheConfig:
+    """On disk completion cache in front of generate. Prompts found here are never sent again.
+    The path should stay outside of the hydra output dir so every run shares it."""
+    enabled: bool = True
+    path: str = "~/.cache/pile_data_analysis/completions.sqlite"
+    # Least recently used completions are evicted past this size at the end of a run. 0 keeps everything
+    max_size_mb: float = 1024
+
 @dataclass
 class OutputConfig(PartialInstantiableConfig):
     indent: int = 4
+    # json writes the files below. parquet or arrow write one table keyed by id to
+    # table_output_fname with the extension added, plus the metrics json
+    format: str = "json"
+    table_output_fname: str = "results"
     # Set any of the names to an empty string to skip creating that output
     input_output_df_fname: str = "input_output_pairs.json"
     metric_results_out_fname: str = "metrics.json"
@@ -106,11 +167,125 @@ class OutputConfig(PartialInstantiableConfig):
     answers: List[str] = field(default_factory=list)
     metrics: Dict[str, Any] = field(default_factory=dict)
     predictions: Dict[str, str] = field(default_factory=dict)
+    # Every sampled text and the per sample metrics when api.n > 1. Empty string skips them
+    samples_output_fname: str = "samples.json"
+    sample_metrics_out_fname: str = "sample_metrics.json"
+    samples: Dict[str, List[str]] = field(default_factory=dict)
+    sample_metrics: Dict[str, Any] = field(default_factory=dict)
+
+@dataclass
+class MockServerConfig:
+    """Local stand in for the completions endpoint, see src.mock_server."""
+    host: str = "127.0.0.1"
+    # 0 picks a free port
+    port: int = 0
+    # Mean latency of a request. constant, uniform or lognormal
+    latency_ms: float = 200.0
+    latency_distribution: str = "lognormal"
+    latency_sigma: float = 0.5
+    # Share of the requests answered with a 429
+    rate_limit_rate: float = 0.05
+    seed: int = 0
+
+@dataclass
+class OpenAIBackendConfig(InstantiableConfig):
+    _target_: str = "src.backends.OpenAIBackend"
+    api_key_env: str = "OPENAI_API_KEY"
+    api_base: Optional[str] = None
+    organization: Optional[str] = None
+
+@dataclass
+class HTTPBackendConfig(InstantiableConfig):
+    """Any server with the OpenAI completions endpoint"""
+    _target_: str = "src.backends.HTTPBackend"
+    api_base: str = "http://127.0.0.1:8000/v1"
+    api_key_env: str = ""
+    timeout: float = 600.0
+
+@dataclass
+class MockBackendConfig(InstantiableConfig):
+    _target_: str = "src.backends.MockBackend"
+    # Empty starts the mock server in this process. Otherwise the url of one started with python -m src.mock_server
+    api_base: str = ""
+    server: MockServerConfig = field(default_factory=MockServerConfig)
+    timeout: float = 600.0
+
+@dataclass
+class TransformersBackendConfig(InstantiableConfig):
+    _target_: str = "src.backends.TransformersBackend"
+    model: str = "gpt2"
+    device: str = "cpu"
+    # 0 leaves torch's default
+    torch_threads: int = 0
+    seed: int = 42
 
 @dataclass
 class GenerationFuncConfig(PartialInstantiableConfig):
-    api_cfg: GenerationAPIConfig = GenerationAPIConfig()
+    api_cfg: GenerationAPIConfig = field(default_factory=GenerationAPIConfig)
     prompts: List[str] = field(default_factory=list)
+    scheduler: SchedulerConfig = field(default_factory=SchedulerConfig)
+    cache: CacheConfig = field(default_factory=CacheConfig)
+    # Where the prompts are sent, one of the *BackendConfig above. Pick it with generate_func/backend=<openai|http|mock|transformers>
+    backend: Any = None
+    # Every finished slice is appended here keyed by the example id. Empty string disables it
+    results_log: str = "generations.jsonl"
+    # Skip the ids already in results_log. Point results_log at the log of the run to resume
+    resume: bool = False
+    # How the api.n samples of a prompt become its prediction: first, majority (most common
+    # normalized answer) or logprob (highest mean token logprob, needs api.logprobs > 0)
+    aggregation: str = "first"
+
+@dataclass
+class PipelineConfig:
+    """Streaming mode of entry_point. Preprocessed batches flow through bounded queues into
+    generation, per question scoring and an incremental writer, each in its own thread.
+    The final outputs are written by output_func like the other modes."""
+    enabled: bool = False
+    # Batches held between each pair of stages
+    queue_size: int = 4
+    # Prompts per batch. 0 uses the dataset batch_size
+    batch_size: int = 0
+    results_fname: str = "results.jsonl"
+    running_metrics_fname: str = "running_metrics.json"
+
+@dataclass
+class InstrumentationConfig:
+    """Timers and counters of every stage and API request, see src.instrument."""
+    # Write timings_fname and prometheus_fname at the end of the run. Empty names skip that file
+    enabled: bool = True
+    timings_fname: str = "timings.json"
+    prometheus_fname: str = "metrics.prom"
+    # cprofile or pyinstrument (pip install pyinstrument) to profile the whole run. Empty disables it.
+    # Only the main thread is profiled, the API requests run in the scheduler's threads
+    profiler: str = ""
+    # The extension is added, .prof for cprofile and .html for pyinstrument
+    profile_fname: str = "profile"
+
+@dataclass
+class DedupConfig:
+    """Send every distinct prompt once and copy its prediction to every id with that prompt, see src.dedup."""
+    enabled: bool = True
+    # Also look for near duplicate prompts (MinHash LSH over word n-grams). They are only
+    # reported in report_fname, each of them is still sent
+    near_duplicates: bool = False
+    num_perm: int = 128
+    # num_perm has to split evenly into the bands. More bands find pairs with a lower similarity
+    bands: int = 32
+    shingle_size: int = 3
+    # Estimated Jaccard similarity from which two prompts are near duplicates
+    threshold: float = 0.8
+    seed: int = 0
+    report_fname: str = "duplicates.json"
+
+@dataclass
+class CalibrationConfig:
+    """Logprob confidence analysis of the predictions, see src.calibration. Only runs when
+    the responses have logprobs, i.e. with api.logprobs > 0."""
+    enabled: bool = True
+    n_bins: int = 10
+    # Ragged token logprobs of every prediction (ids, values, offsets). Empty string skips it
+    logprobs_fname: str = "logprobs.npz"
+    calibration_fname: str = "calibration.json"
 
 @dataclass
 class GenerationConfig(InstantiableConfig):
@@ -119,11 +294,101 @@ class GenerationConfig(InstantiableConfig):
     dataset: DatasetConfig
     output_func: OutputConfig
     generate_func: GenerationFuncConfig
+    pipeline: PipelineConfig = field(default_factory=PipelineConfig)
+    instrumentation: InstrumentationConfig = field(default_factory=InstrumentationConfig)
+    calibration: CalibrationConfig = field(default_factory=CalibrationConfig)
+    dedup: DedupConfig = field(default_factory=DedupConfig)
+
+@dataclass
+class SweepConfig(InstantiableConfig):
+    """Run many api and dataset configs in one process, see src.sweep."""
+    api: GenerationAPIConfig
+    dataset: DatasetConfig
+    metric: MetricConfig
+    output_func: OutputConfig
+    generate_func: GenerationFuncConfig
+    # The dataset of every point is built from the dataset config with that point's overrides
+    _recursive_: bool = False
+    # Every combination of the values is one point, e.g. {api: {temperature: [0, 0.7]}, dataset: {n_few_shot: [0, 5]}}.
+    # Only the api and dataset sections can be swept
+    grid: Dict[str, Dict[str, List[Any]]] = field(default_factory=dict)
+    # More points on top of the grid, each {api: {...}, dataset: {...}}
+    points: List[Dict[str, Dict[str, Any]]] = field(default_factory=list)
+    # Each point writes its outputs to <output_dir>/<point number>
+    output_dir: str = "points"
+    summary_fname: str = "sweep.json"
+    instrumentation: InstrumentationConfig = field(default_factory=InstrumentationConfig)
+
+@dataclass
+class NGramIndexConfig:
+    """Disk backed index of the hashed n-grams of a corpus shard, see src.ngram_index."""
+    # JSONL shard with one document per line in text_field. May be gzip or zstandard compressed
+    corpus: str = ""
+    text_field: str = "text"
+    # Built here the first time and reused afterwards
+    index_dir: str = "ngram_index"
+    orders: List[int] = field(default_factory=lambda: [1, 2, 3])
+    # Hashes are split over this many files while building so only one has to fit in memory
+    n_buckets: int = 64
+    chunk_docs: int = 10000
+    # Only index the first max_docs documents. 0 indexes everything
+    max_docs: int = 0
+
+@dataclass
+class OverlapConfig(InstantiableConfig):
+    """Correlate the per question metrics of an earlier run with the training data."""
+    dataset: DatasetConfig
+    index: NGramIndexConfig = field(default_factory=NGramIndexConfig)
+    # Output directory of the run to analyze
+    run_dir: str = ""
+    fields: List[str] = field(default_factory=lambda: ['question', 'answer', 'context'])
+    output_fname: str = "overlap.json"
+    batch_size: int = 1000
+
+@dataclass
+class BenchmarkConfig(InstantiableConfig):
+    """Offline throughput benchmarks on synthetic data shaped like the real datasets, see src.benchmark."""
+    hotpot_qa: HotPotQAConfig
+    nq_open: NQOpenConfig
+    # The datasets can only be built once the synthetic data is written
+    _recursive_: bool = False
+    api: GenerationAPIConfig = field(default_factory=GenerationAPIConfig)
+    scheduler: SchedulerConfig = field(default_factory=SchedulerConfig)
+    server: MockServerConfig = field(default_factory=MockServerConfig)
+    # Any of preprocess, scoring and generation
+    stages: List[str] = field(default_factory=lambda: ['preprocess', 'scoring', 'generation'])
+    n_rows: int = 5000
+    n_prompts: int = 200
+    # Each timing is repeated and the median is reported
+    repeats: int = 3
+    num_workers: int = 1
+    seed: int = 0
+    data_dir: str = "benchmark_data"
+    output_fname: str = "benchmark.json"
+    # benchmark.json of an earlier commit to compare against
+    baseline: str = ""
+
+def to_dataclass(cfg: Any, cls: type) -> Any:
+    """Hydra passes nested configs to partials as DictConfig. Turn them back into the dataclass."""
+    if cfg is None or isinstance(cfg, cls):
+        return cfg
+    if OmegaConf.is_config(cfg):
+        cfg = OmegaConf.to_object(cfg)
+        if isinstance(cfg, cls):
+            return cfg
+    return cls(**cfg)
 
 cs = ConfigStore.instance()
 cs.store(name="base_config", node=GenerationConfig)
+cs.store(name="overlap_config", node=OverlapConfig)
+cs.store(name="benchmark_config", node=BenchmarkConfig)
+cs.store(name="sweep_config", node=SweepConfig)
 cs.store(group="api", name="base_config", node=GenerationAPIConfig)
 cs.store(group="metric", name="base_config", node=MetricConfig)
 cs.store(group="dataset", name="base_config", node=DatasetConfig)
 cs.store(group="dataset", name="hotpot_config", node=HotPotQAConfig)
-cs.store(group="dataset", name="nq_open_config", node=NQOpenConfig)
\ No newline at end of file
+cs.store(group="dataset", name="nq_open_config", node=NQOpenConfig)
+cs.store(group="generate_func/backend", name="openai_config", node=OpenAIBackendConfig)
+cs.store(group="generate_func/backend", name="http_config", node=HTTPBackendConfig)
+cs.store(group="generate_func/backend", name="mock_config", node=MockBackendConfig)
+cs.store(group="generate_func/backend", name="transformers_config", node=TransformersBackendConfig)
\ No newline at end of file
@@ -0,0 +1,162 @@
+import zlib
+import logging
+
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+import numpy as np
+
+from src import instrument
+from src.config import DedupConfig
+from src.prompts import SharedPrefixPrompts
+from src.sampling import Samples
+
+logger = logging.getLogger("apiLogger")
+
+# Mersenne prime for the MinHash permutations. The permuted hashes are cut to 32 bits
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+
+def exact_duplicates(keys: Sequence[str]) -> Tuple[List[int], np.ndarray]:
+    """The first row of every distinct key, and for every row the index of its key in that list."""
+    index: Dict[str, int] = {}
+    unique: List[int] = []
+    inverse = np.empty(len(keys), dtype=np.int64)
+    for row, key in enumerate(keys):
+        k = index.setdefault(key, len(unique))
+        if k == len(unique):
+            unique.append(row)
+        inverse[row] = k
+    return unique, inverse
+
+def fan_out(generated: Sequence[str], inverse: np.ndarray) -> List[str]:
+    """The generated result of each row's unique prompt. Stops at the first row whose prompt was
+    not generated, so like batch_generate the result is always a prefix of the rows."""
+    missing = np.flatnonzero(inverse >= len(generated))
+    rows = inverse[:missing[0]] if len(missing) else inverse
+    predictions = [generated[i] for i in rows]
+    if isinstance(generated, Samples):
+        return Samples(predictions, [generated.samples[i] for i in rows], [generated.logprobs[i] for i in rows])
+    return predictions
+
+def shingles(text: str, size: int) -> np.ndarray:
+    """crc32 of every word n-gram of the lower cased text."""
+    words = text.lower().split()
+    grams = [' '.join(words[i:i + size]) for i in range(max(len(words) - size + 1, 1))]
+    return np.fromiter((zlib.crc32(gram.encode('utf-8')) for gram in grams), dtype=np.uint64, count=len(grams))
+
+class MinHashLSH:
+    """MinHash signatures of word n-grams, banded so that only texts sharing a whole band
+    are compared. The Jaccard similarity of a candidate pair is estimated from the share
+    of equal signature values."""
+    def __init__(self, num_perm: int, bands: int, shingle_size: int, seed: int = 0):
+        if num_perm % bands:
+            raise ValueError(f'num_perm ({num_perm}) has to be a multiple of bands ({bands})')
+        rng = np.random.default_rng(seed)
+        # Universal hashing like datasketch: a * hash + b wraps around in 64 bits, then mod the prime
+        self.a = rng.integers(1, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.bands = bands
+        self.shingle_size = shingle_size
+        self.ids: List[Any] = []
+        self.signatures: List[np.ndarray] = []
+
+    def add(self, id: Any, text: str):
+        hashes = shingles(text, self.shingle_size)
+        self.ids.append(id)
+        permuted = (self.a[:, None] * hashes[None, :] + self.b[:, None]) % MERSENNE_PRIME & MAX_HASH
+        self.signatures.append(permuted.min(axis=1))
+
+    def clusters(self, threshold: float) -> List[Dict[str, Any]]:
+        """Groups of texts linked by pairs with an estimated Jaccard of at least threshold."""
+        if not self.signatures:
+            return []
+        signatures = np.stack(self.signatures)
+        parent = list(range(len(signatures)))
+
+        def find(i: int) -> int:
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        similarity: Dict[int, float] = {}
+        compared = set()
+        for band in np.split(signatures, self.bands, axis=1):
+            buckets: Dict[bytes, List[int]] = {}
+            for row, key in enumerate(band):
+                buckets.setdefault(key.tobytes(), []).append(row)
+            for rows in buckets.values():
+                # Every pair in the bucket, two rows can be alike without being like the first one
+                for k, i in enumerate(rows):
+                    for j in rows[k + 1:]:
+                        if (i, j) in compared:
+                            continue
+                        compared.add((i, j))
+                        jaccard = float(np.mean(signatures[i] == signatures[j]))
+                        if jaccard >= threshold:
+                            root_i, root_j = find(i), find(j)
+                            parent[root_j] = root_i
+                            similarity[root_i] = min(similarity.get(root_i, 1.0), similarity.pop(root_j, 1.0), jaccard)
+
+        groups: Dict[int, List[int]] = {}
+        for row in range(len(signatures)):
+            groups.setdefault(find(row), []).append(row)
+        clusters = [
+            {"ids": [self.ids[row] for row in rows], "min_jaccard": similarity.get(root, 1.0)}
+            for root, rows in groups.items() if len(rows) > 1
+        ]
+        return sorted(clusters, key=lambda cluster: -len(cluster["ids"]))
+
+class Deduplicator:
+    """Wraps generate_func so every distinct prompt of a call is only sent once and its
+    prediction is copied to every id with that prompt. With cfg.near_duplicates it also keeps
+    a MinHash of every distinct prompt (minus the shared prefix) for report()."""
+    def __init__(self, cfg: DedupConfig, generate_func: Callable[..., List[str]], shared_prefix: str = ""):
+        self.cfg = cfg
+        self.generate_func = generate_func
+        self.shared_prefix = shared_prefix
+        self.exact: Dict[str, List[Any]] = {}
+        self.lsh = MinHashLSH(cfg.num_perm, cfg.bands, cfg.shingle_size, cfg.seed) if cfg.near_duplicates else None
+
+    def _texts(self, prompts: Sequence[str]) -> Sequence[str]:
+        # The shared prefix would make every prompt look alike
+        if isinstance(prompts, SharedPrefixPrompts):
+            return prompts.suffixes
+        if self.shared_prefix:
+            return [prompt[len(self.shared_prefix):] if prompt.startswith(self.shared_prefix) else prompt for prompt in prompts]
+        return prompts
+
+    def __call__(self, api_cfg: Any, prompts: Sequence[str], ids: Sequence[Any], **kw) -> List[str]:
+        texts = self._texts(prompts)
+        unique, inverse = exact_duplicates(texts)
+        ids = list(ids)
+        n_duplicates = len(prompts) - len(unique)
+        if n_duplicates:
+            logger.info(f'Sending {len(unique)} unique prompts for {len(prompts)} ids')
+            instrument.count('dedup_duplicates', n_duplicates)
+            for row, k in enumerate(inverse):
+                if row != unique[k]:
+                    self.exact.setdefault(texts[unique[k]], [ids[unique[k]]]).append(ids[row])
+
+        if self.lsh is not None:
+            for row in unique:
+                self.lsh.add(ids[row], texts[row])
+
+        if not n_duplicates:
+            return self.generate_func(api_cfg=api_cfg, prompts=prompts, ids=ids, **kw)
+        generated = self.generate_func(
+            api_cfg=api_cfg, prompts=[prompts[row] for row in unique], ids=[ids[row] for row in unique], **kw,
+        )
+        return fan_out(generated, inverse)
+
+    def report(self) -> Dict[str, Any]:
+        report = {
+            "n_exact_duplicate_groups": len(self.exact),
+            "exact_duplicates": list(self.exact.values()),
+        }
+        if self.lsh is not None:
+            clusters = self.lsh.clusters(self.cfg.threshold)
+            logger.info(f'Found {len(clusters)} groups of near duplicate prompts')
+            report["n_near_duplicate_groups"] = len(clusters)
+            report["near_duplicates"] = clusters
+        return report
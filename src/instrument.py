@@ -0,0 +1,221 @@
+import os
+import re
+import sys
+import json
+import time
+import logging
+import resource
+import threading
+import contextlib
+
+from typing import Any, Dict, Iterator, List, Optional
+
+from src.config import InstrumentationConfig
+
+logger = logging.getLogger("apiLogger")
+
+PROMETHEUS_PREFIX = 'pile_data_analysis'
+QUANTILES = (0.5, 0.9, 0.99)
+
+def rss_bytes() -> int:
+    """Resident set size of this process right now."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # No procfs, fall back to the peak so far
+        return max_rss_bytes()
+
+def max_rss_bytes(who: int = resource.RUSAGE_SELF) -> int:
+    maxrss = resource.getrusage(who).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+class PeakRSS:
+    """Samples the RSS in a background thread and keeps the peak seen inside the with block."""
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.peak = 0
+        self._done = threading.Event()
+
+    def _sample(self):
+        while not self._done.wait(self.interval):
+            self.peak = max(self.peak, rss_bytes())
+
+    def __enter__(self) -> "PeakRSS":
+        self.peak = rss_bytes()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._done.set()
+        self._thread.join()
+        self.peak = max(self.peak, rss_bytes())
+
+class Timer:
+    def __init__(self):
+        self.samples: List[float] = []
+        self.peak_rss = 0
+
+    def summary(self) -> Dict[str, Any]:
+        samples = sorted(self.samples)
+        n = len(samples)
+        summary = {
+            "count": n,
+            "total_seconds": sum(samples),
+            "mean_seconds": sum(samples) / n if n else 0.0,
+            "max_seconds": samples[-1] if n else 0.0,
+        }
+        for q in QUANTILES:
+            summary[f'p{int(q * 100)}_seconds'] = samples[min(int(q * n), n - 1)] if n else 0.0
+        if self.peak_rss:
+            summary["peak_rss_mb"] = self.peak_rss / 2**20
+        return summary
+
+class Instrumentation:
+    """Timers and counters for one run. Shared by every thread.
+
+    stage() is for the few coarse steps of a run and also records their peak RSS,
+    timer() and record() are for things that happen many times like API requests.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.timers: Dict[str, Timer] = {}
+            self.counters: Dict[str, float] = {}
+            self.started = time.time()
+
+    def record(self, name: str, seconds: float):
+        with self._lock:
+            self.timers.setdefault(name, Timer()).samples.append(seconds)
+
+    def count(self, name: str, value: float = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextlib.contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        logger.debug(f'Starting stage {name}')
+        with PeakRSS() as rss, self.timer(name):
+            yield
+        with self._lock:
+            timer = self.timers[name]
+            timer.peak_rss = max(timer.peak_rss, rss.peak)
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            timers = {name: timer.summary() for name, timer in self.timers.items()}
+            counters = dict(self.counters)
+        return {
+            "wall_seconds": time.time() - self.started,
+            "peak_rss_mb": max_rss_bytes() / 2**20,
+            "timers": timers,
+            "counters": counters,
+        }
+
+    def prometheus(self) -> str:
+        """The summary in the Prometheus text format, for the node exporter textfile collector."""
+        summary = self.summary()
+        lines = [
+            f'# TYPE {PROMETHEUS_PREFIX}_wall_seconds gauge',
+            f'{PROMETHEUS_PREFIX}_wall_seconds {summary["wall_seconds"]}',
+            f'# TYPE {PROMETHEUS_PREFIX}_peak_rss_bytes gauge',
+            f'{PROMETHEUS_PREFIX}_peak_rss_bytes{{stage=""}} {max_rss_bytes()}',
+        ]
+        for name, timer in summary["timers"].items():
+            if "peak_rss_mb" in timer:
+                lines.append(f'{PROMETHEUS_PREFIX}_peak_rss_bytes{{stage="{name}"}} {int(timer["peak_rss_mb"] * 2**20)}')
+
+        metric = f'{PROMETHEUS_PREFIX}_seconds'
+        lines.append(f'# TYPE {metric} summary')
+        for name, timer in summary["timers"].items():
+            for q in QUANTILES:
+                lines.append(f'{metric}{{timer="{name}",quantile="{q}"}} {timer[f"p{int(q * 100)}_seconds"]}')
+            lines.append(f'{metric}_sum{{timer="{name}"}} {timer["total_seconds"]}')
+            lines.append(f'{metric}_count{{timer="{name}"}} {timer["count"]}')
+
+        for name, value in summary["counters"].items():
+            metric = f'{PROMETHEUS_PREFIX}_{re.sub(r"[^a-zA-Z0-9_]", "_", name)}_total'
+            lines += [f'# TYPE {metric} counter', f'{metric} {value}']
+        return '\n'.join(lines) + '\n'
+
+    def write(self, timings_fname: str, prometheus_fname: str):
+        if timings_fname:
+            with open(timings_fname, 'w') as f:
+                json.dump(self.summary(), f, indent=4)
+        if prometheus_fname:
+            # The textfile collector may read at any time so never leave a half written file
+            tmp_fname = f'{prometheus_fname}.{os.getpid()}.tmp'
+            with open(tmp_fname, 'w') as f:
+                f.write(self.prometheus())
+            os.replace(tmp_fname, prometheus_fname)
+
+    def log(self):
+        for name, timer in self.summary()["timers"].items():
+            peak = f', peak RSS {timer["peak_rss_mb"]:.0f}MB' if "peak_rss_mb" in timer else ''
+            logger.info(f'{name}: {timer["count"]} calls, {timer["total_seconds"]:.2f}s total, p50 {timer["p50_seconds"]:.3f}s{peak}')
+
+# Every module records into this one so the dataset built by hydra and the run share it
+INSTRUMENT = Instrumentation()
+
+def stage(name: str):
+    return INSTRUMENT.stage(name)
+
+def timer(name: str):
+    return INSTRUMENT.timer(name)
+
+def record(name: str, seconds: float):
+    INSTRUMENT.record(name, seconds)
+
+def count(name: str, value: float = 1):
+    INSTRUMENT.count(name, value)
+
+def write(cfg: InstrumentationConfig):
+    if not cfg.enabled:
+        return
+    INSTRUMENT.log()
+    INSTRUMENT.write(cfg.timings_fname, cfg.prometheus_fname)
+
+@contextlib.contextmanager
+def profiling(cfg: Optional[InstrumentationConfig]) -> Iterator[None]:
+    """Run the block under cProfile or pyinstrument if the config asks for it."""
+    profiler = cfg.profiler if cfg is not None else ""
+    if not profiler:
+        yield
+        return
+
+    if profiler == 'cprofile':
+        import cProfile
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+            prof.dump_stats(f'{cfg.profile_fname}.prof')
+            logger.info(f'Wrote the cProfile stats to {cfg.profile_fname}.prof. View them with snakeviz or pstats')
+    elif profiler == 'pyinstrument':
+        from pyinstrument import Profiler
+        prof = Profiler()
+        prof.start()
+        try:
+            yield
+        finally:
+            prof.stop()
+            with open(f'{cfg.profile_fname}.html', 'w') as f:
+                f.write(prof.output_html())
+            logger.info(f'Wrote the pyinstrument profile to {cfg.profile_fname}.html')
+    else:
+        raise ValueError(f'Unknown profiler {profiler}. Choose cprofile or pyinstrument')
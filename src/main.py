@@ -1,21 +1,18 @@
 import os
 import sys
 import json
-import time
 import logging
+import functools
 
-from typing import List
+from typing import Any, Dict, List, Optional, Tuple
 from pathlib import Path
-from dataclasses import asdict
 
 PARENT_DIR = Path(__file__, '../..').resolve()
 sys.path.append(str(PARENT_DIR))
 
 import hydra
-import openai
 
 from omegaconf import OmegaConf
-from openai.error import RateLimitError, InvalidRequestError
 
 from src.config import (
     MetricConfig,
@@ -24,46 +21,161 @@ from src.config import (
     GenerationConfig,
     GenerationAPIConfig,
     GenerationFuncConfig,
+    CacheConfig,
+    PipelineConfig,
+    InstrumentationConfig,
+    CalibrationConfig,
+    DedupConfig,
+    SchedulerConfig,
+    to_dataclass,
 )
+from src import instrument
+from src.backends import Backend, OpenAIBackend, QuotaExceeded
+from src.batching import plan_batches
+from src.calibration import RaggedLogprobs, analyze
+from src.dedup import Deduplicator
+from src.cache import CompletionCache, completion_key, evict_completions, sampling_params
+from src.our_datasets import batch_to_rows
+from src.result_log import ResultLog
+from src.sampling import Samples, get_aggregator, score_samples, token_logprobs
+from src.scheduler import GenerationScheduler, RateLimiter, group_choices
 
 logger = logging.getLogger("apiLogger")
 
-def generate(api_cfg: GenerationAPIConfig, prompts: List[str]):
-    API_KEY = os.getenv("OPENAI_API_KEY")
-    openai.api_key = API_KEY
-
-    api_options = asdict(api_cfg)
+def generate(backend: Backend, api_cfg: GenerationAPIConfig, prompts: List[str]):
     try:
-        response = openai.Completion.create(
-            prompt=prompts,
-            **api_options
-        )
-    except RateLimitError as e:
+        return backend.complete(api_cfg, prompts)
+    except QuotaExceeded as e:
         logger.debug(e)
-        if str(e) == 'You exceeded your current quota, please check your plan and billing details.':
-            logger.error('We ran out of tokens :(')
-            return
-        logger.error('We have hit our rate limit. Sleeping for a minute...')
-        time.sleep(60)
-        response = generate(api_cfg, prompts)
+        logger.error('We ran out of tokens :(')
+        return
+
+def batch_generate(
+    api_cfg: GenerationAPIConfig,
+    prompts: List[str],
+    ids: Optional[List[Any]] = None,
+    scheduler: SchedulerConfig = SchedulerConfig(),
+    cache: CacheConfig = CacheConfig(),
+    results_log: str = "generations.jsonl",
+    resume: bool = False,
+    backend: Optional[Backend] = None,
+    limiter: Optional[RateLimiter] = None,
+    aggregation: str = "first",
+) -> Samples:
+    """One prediction per prompt, aggregated from its api.n samples, which are kept in .samples.
+    limiter can be shared between calls so they stay inside one rate budget, e.g. the configs of a sweep."""
+    scheduler = to_dataclass(scheduler, SchedulerConfig)
+    aggregate = get_aggregator(aggregation)
+    # Only close the backend if it was made here, a passed in one is closed by its owner
+    own_backend = backend is None
+    if own_backend:
+        backend = OpenAIBackend()
+    completion_cache = CompletionCache.from_config(to_dataclass(cache, CacheConfig))
+    if ids is None:
+        ids = list(range(len(prompts)))
+
+    log = ResultLog(results_log, aggregate) if results_log else None
+    finished = log.read() if log and resume else {}
+    choices = [finished.get(id) for id in ids]
+    if finished:
+        logger.info(f'Resuming with {sum(c is not None for c in choices)} of {len(prompts)} prompts already generated')
+
+    params = sampling_params(api_cfg)
+    if backend.cache_namespace:
+        params["backend"] = backend.cache_namespace
+    keys = [completion_key(prompt, params) for prompt in prompts]
+    if completion_cache:
+        todo = [i for i, prompt_choices in enumerate(choices) if prompt_choices is None]
+        cached = completion_cache.get_many([keys[i] for i in todo])
+        hits = [(i, prompt_choices) for i, prompt_choices in zip(todo, cached) if prompt_choices is not None]
+        logger.info(f'Found {len(hits)} of {len(todo)} completions in the cache')
+        instrument.count('cache_hits', len(hits))
+        for i, prompt_choices in hits:
+            choices[i] = prompt_choices
+        if log and hits:
+            log.append([ids[i] for i, _ in hits], [prompt_choices for _, prompt_choices in hits])
+
+    # Only the prompts that are neither in the log nor in the cache are sent
+    missing = [i for i, prompt_choices in enumerate(choices) if prompt_choices is None]
 
-    return response
+    def request(batch: List[str], start: int):
+        batch_idx = missing[start:start + len(batch)]
+        logger.info(f'Generating answer for prompts {batch_idx[0]} through {batch_idx[-1] + 1}')
+        with instrument.timer('api_request'):
+            response = generate(backend, api_cfg, batch)
+        if response is not None:
+            instrument.count('api_requests')
+            instrument.count('api_prompts', len(batch))
+            for name, tokens in (response.get("usage") or {}).items():
+                instrument.count(f'api_{name}', tokens)
+            # Keep the paid for completions before anything else can fail
+            batch_choices = group_choices(response["choices"], len(batch))
+            if log:
+                log.append([ids[i] for i in batch_idx], batch_choices)
+            if completion_cache:
+                completion_cache.put_many([keys[i] for i in batch_idx], batch_choices)
+            # Only for debugging. Named by id since the prompts can arrive in several calls when streaming
+            try:
+                with open(f'response_{ids[batch_idx[0]]}.json', 'w') as f:
+                    json.dump(response, f, indent=4)
+            except OSError as e:
+                logger.warning(f'Could not write the raw response: {e}')
+        return response
+
+    to_send = [prompts[i] for i in missing]
+    completion_tokens = api_cfg.max_tokens * max(api_cfg.n, api_cfg.best_of)
+    slices, prompt_tokens = None, None
+    if scheduler.max_request_tokens and to_send:
+        to_send, slices, prompt_tokens = plan_batches(scheduler, to_send, api_cfg.max_tokens, completion_tokens)
 
-def batch_generate(api_cfg: GenerationAPIConfig, prompts: List[str]) -> List[str]:
-    predictions = []
     try:
-        for i in range(0, len(prompts), 20):
-            logger.info(f'Generating answer for prompts {i} through {i+20}')
-            response = generate(api_cfg, prompts)
-            with open(f'response_{i}.json', 'w') as f:
-                json.dump(response, f, indent=4)
-            predictions += [prediction["text"] for prediction in response["choices"]]
-
-    except InvalidRequestError as e:
-        logger.critical('Sent an invalid request')
-        logger.critical(e)
-    
-    return predictions
+        generated = GenerationScheduler(scheduler, limiter=limiter).run(
+            to_send,
+            request,
+            completion_tokens=completion_tokens,
+            slices=slices,
+            prompt_tokens=prompt_tokens,
+        )
+    finally:
+        if completion_cache:
+            completion_cache.close()
+        if own_backend:
+            backend.close()
+
+    for i, prompt_choices in zip(missing, generated):
+        choices[i] = prompt_choices
+
+    predictions, samples, logprobs = [], [], []
+    # Stop at the first prompt we could not generate so the predictions stay aligned with the ids.
+    # Everything generated after it is in the results log for the next resume.
+    for prompt_choices in choices:
+        if prompt_choices is None:
+            break
+        choice = aggregate(prompt_choices)
+        predictions.append(choice["text"])
+        samples.append([choice["text"] for choice in prompt_choices])
+        logprobs.append(token_logprobs(choice))
+    return Samples(predictions, samples, logprobs)
+
+def stream_generate(
+    api: GenerationAPIConfig,
+    dataset: DatasetConfig,
+    data: Any,
+    generate_func: GenerationFuncConfig,
+) -> Tuple[Any, Dict[Any, str], Dict[Any, List[str]], Dict[Any, Optional[List[float]]]]:
+    """Send each batch of prompts as soon as it is preprocessed. Returns the rows we
+    read as an in memory dataset along with the predictions, samples and logprobs for them."""
+    rows, predictions, samples, logprobs = [], {}, {}, {}
+    for batch in dataset.iter_batches(data):
+        batch_predictions = generate_func(api_cfg=api, prompts=dataset.prompts(batch), ids=batch['id'])
+        predictions.update(zip(batch['id'], batch_predictions))
+        samples.update(zip(batch['id'], getattr(batch_predictions, 'samples', [])))
+        logprobs.update(zip(batch['id'], getattr(batch_predictions, 'logprobs', [])))
+        rows += batch_to_rows(batch)
+        if len(batch_predictions) < len(batch['id']):
+            logger.error('Generation stopped early. Not reading any more of the dataset')
+            break
+    return dataset.materialize(rows), predictions, samples, logprobs
 
 def entry_point(
     api: GenerationAPIConfig,
@@ -71,36 +183,119 @@ def entry_point(
     metric: MetricConfig,
     output_func: OutputConfig, 
     generate_func: GenerationFuncConfig,
+    pipeline: PipelineConfig = PipelineConfig(),
+    instrumentation: InstrumentationConfig = InstrumentationConfig(),
+    calibration: CalibrationConfig = CalibrationConfig(),
+    dedup: DedupConfig = DedupConfig(),
 ):
     api = OmegaConf.to_object(api)
-    # Call the dataset preprocess method
-    logger.info(f'I am the dataset features BEFORE preprocessing: {dataset.dataset.features}')
-    data = dataset()
-    logger.info(f'I am the dataset features AFTER preprocessing: {data.features}')
-
-    logger.info('Running predictions ...')
-    raw_predictions = generate_func(api_cfg=api, prompts=data[dataset.text_col])
-    predictions = {id: prediction for id, prediction in zip(data['id'], raw_predictions)}
-
-    logger.info('Computing metrics ...')
-    metrics, per_question_metrics = metric(
-        predictions=predictions,
-        ground_truths=data
-    )
-
-    output_func(
-        dataset=data[dataset.text_col],
-        answers=data[dataset.label_col],
-        metrics=metrics,
-        per_question_metrics=per_question_metrics,
-        predictions=predictions
-    )
+    pipeline = to_dataclass(pipeline, PipelineConfig)
+    instrumentation = to_dataclass(instrumentation, InstrumentationConfig)
+    calibration = to_dataclass(calibration, CalibrationConfig)
+    dedup = to_dataclass(dedup, DedupConfig)
+    deduplicator = None
+    # The backend hydra built for generate_func, e.g. the mock backend and its server
+    backend = getattr(generate_func, 'keywords', {}).get('backend')
+    completion_cache = getattr(generate_func, 'keywords', {}).get('cache')
+    scheduler = getattr(generate_func, 'keywords', {}).get('scheduler')
+    if scheduler is not None:
+        # Streaming and the pipeline call generate_func once per batch, they all share one rate budget
+        scheduler = to_dataclass(scheduler, SchedulerConfig)
+        generate_func = functools.partial(
+            generate_func, limiter=RateLimiter(scheduler.requests_per_minute, scheduler.tokens_per_minute),
+        )
+    try:
+        # Call the dataset preprocess method
+        logger.info(f'I am the dataset features BEFORE preprocessing: {dataset.dataset.features}')
+        with instrument.stage('preprocess'):
+            data = dataset()
+        logger.info(f'I am the dataset features AFTER preprocessing: {data.features}')
+
+        if dedup.enabled:
+            # Every path below calls generate_func, so duplicates are dropped there
+            deduplicator = Deduplicator(dedup, generate_func, dataset.template.shared_prefix)
+            generate_func = deduplicator
+
+        if pipeline.enabled:
+            # Only this path scores as it goes, so the metrics stack is loaded here
+            from src.pipeline import run_pipeline
+            logger.info('Running the streaming pipeline ...')
+            # Generation and scoring overlap, the rest of the run is the same
+            with instrument.stage('pipeline'):
+                data, predictions, samples, logprobs, metrics, per_question_metrics = run_pipeline(
+                    pipeline, api, dataset, data, metric, generate_func,
+                )
+            prompts = dataset.prompts(data)
+        else:
+            logger.info('Running predictions ...')
+            with instrument.stage('generation'):
+                if dataset.streaming:
+                    # Preprocessing is lazy when streaming so it is part of this stage
+                    data, predictions, samples, logprobs = stream_generate(api, dataset, data, generate_func)
+                    prompts = dataset.prompts(data)
+                else:
+                    prompts = dataset.prompts(data)
+                    raw_predictions = generate_func(api_cfg=api, prompts=prompts, ids=data['id'])
+                    predictions = {id: prediction for id, prediction in zip(data['id'], raw_predictions)}
+                    # dry_run and other generate functions only return the predictions
+                    samples = dict(zip(data['id'], getattr(raw_predictions, 'samples', [])))
+                    logprobs = dict(zip(data['id'], getattr(raw_predictions, 'logprobs', [])))
+
+            logger.info('Computing metrics ...')
+            with instrument.stage('scoring'):
+                metrics, per_question_metrics = metric(
+                    predictions=predictions,
+                    ground_truths=data
+                )
+
+        sample_metrics = {}
+        if any(len(texts) > 1 for texts in samples.values()):
+            with instrument.stage('sample_scoring'):
+                sample_metrics = score_samples(metric, samples, data)
+        else:
+            # Nothing to add over the predictions
+            samples = {}
+
+        if calibration.enabled and any(logprobs.values()):
+            with instrument.stage('calibration'):
+                ragged = RaggedLogprobs.from_lists(list(logprobs), list(logprobs.values()))
+                if calibration.logprobs_fname:
+                    ragged.save(calibration.logprobs_fname)
+                analysis = analyze(ragged, per_question_metrics, calibration.n_bins)
+                if calibration.calibration_fname:
+                    with open(calibration.calibration_fname, 'w') as f:
+                        json.dump(analysis, f, indent=4)
+
+        with instrument.stage('output'):
+            output_func(
+                dataset=prompts,
+                answers=data[dataset.label_col],
+                metrics=metrics,
+                per_question_metrics=per_question_metrics,
+                predictions=predictions,
+                samples=samples,
+                sample_metrics=sample_metrics,
+            )
+    finally:
+        # Also written when the run fails so we can see how far it got
+        if deduplicator is not None and dedup.report_fname:
+            with open(dedup.report_fname, 'w') as f:
+                json.dump(deduplicator.report(), f, indent=4)
+        if isinstance(backend, Backend):
+            backend.close()
+        if completion_cache is not None:
+            # Once per run, generate_func is called for every batch when streaming
+            evict_completions(completion_cache)
+        instrument.write(instrumentation)
 
 @hydra.main(config_path="../conf", config_name="main", version_base="1.2")
 def main(cfg: GenerationConfig):
     cfg = OmegaConf.to_object(cfg)
     logger.info(OmegaConf.to_yaml(cfg))
-    hydra.utils.instantiate(cfg)
+    # Multiruns call main once per job in the same process
+    instrument.INSTRUMENT.reset()
+    with instrument.profiling(getattr(cfg, 'instrumentation', None)):
+        hydra.utils.instantiate(cfg)
 
 if __name__ == '__main__':
     # Make sure the hydra output is in the same place everytime
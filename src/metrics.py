@@ -1,35 +1,62 @@
 import re
+import math
 import string
+import hashlib
+import inspect
 import logging
 import unicodedata
 
-from typing import Any, Dict, Tuple
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
 from collections import Counter
 
+from src.score_cache import ScoreCache, score_key
+from src.store import ScoreStore
+
 logger = logging.getLogger("apiLogger")
 
+# Bound on the number of distinct strings we keep normalized and tokenized in memory
+NORMALIZE_CACHE_SIZE = 2 ** 18
+
+ARTICLES_RE = re.compile(r'\b(a|an|the)\b')
+PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation)
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
 def normalize_answer(s):
+    # Lower case, remove punctuation, remove articles then fix the white space
     s = unicodedata.normalize("NFD", s)
+    s = s.lower().translate(PUNCTUATION_TABLE)
+    return ' '.join(ARTICLES_RE.sub(' ', s).split())
 
-    def remove_articles(text):
-        return re.sub(r'\b(a|an|the)\b', ' ', text)
+def normalize_answers(answers: Iterable[str]) -> List[str]:
+    return [normalize_answer(answer) for answer in answers]
 
-    def white_space_fix(text):
-        return ' '.join(text.split())
+class NormalizedAnswers(list):
+    """Gold answers that already went through normalize_answer, e.g. read from the gold_norm column."""
 
-    def remove_punc(text):
-        exclude = set(string.punctuation)
-        return ''.join(ch for ch in text if ch not in exclude)
+def normalized_golds(golds: List[str]) -> List[str]:
+    return golds if isinstance(golds, NormalizedAnswers) else normalize_answers(golds)
 
-    def lower(text):
-        return text.lower()
+@lru_cache(maxsize=None)
+def normalization_hash() -> str:
+    """Changes whenever normalize_answer, gold_columns or the patterns they use change, so the
+    gold columns and scores built with an older version are not read from the caches."""
+    sources = [inspect.getsource(fn) for fn in (normalize_answer, gold_columns)]
+    return hashlib.sha1(repr((sources, ARTICLES_RE.pattern, string.punctuation)).encode('utf-8')).hexdigest()
 
-    return white_space_fix(remove_articles(remove_punc(lower(s))))
+def gold_columns(answers: List[Any]) -> Dict[str, List[List[str]]]:
+    """gold_norm, the normalized gold answers of every question. A single answer (HotPotQA)
+    is stored as a list of one so every dataset has the same column."""
+    return {'gold_norm': [normalize_answers(golds if isinstance(golds, list) else [golds]) for golds in answers]}
 
-def f1_score(prediction, ground_truth):
-    normalized_prediction = normalize_answer(prediction)
-    normalized_ground_truth = normalize_answer(ground_truth)
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def answer_tokens(normalized_answer: str) -> Tuple[Counter, int]:
+    """Token counts of an already normalized answer. The Counter is shared so don't modify it."""
+    tokens = normalized_answer.split()
+    return Counter(tokens), len(tokens)
 
+def normalized_f1_score(normalized_prediction, normalized_ground_truth):
     # If the ground truth and prediction only contained stop words this is empty
     if normalized_prediction == "" and normalized_ground_truth == "":
         return (1.0, 1.0, 1.0)
@@ -41,23 +68,40 @@ def f1_score(prediction, ground_truth):
     if normalized_ground_truth in ['yes', 'no', 'noanswer'] and normalized_prediction != normalized_ground_truth:
         return ZERO_METRIC
 
-    prediction_tokens = normalized_prediction.split()
-    ground_truth_tokens = normalized_ground_truth.split()
-    common = Counter(prediction_tokens) & Counter(ground_truth_tokens)
+    prediction_counts, n_prediction_tokens = answer_tokens(normalized_prediction)
+    ground_truth_counts, n_ground_truth_tokens = answer_tokens(normalized_ground_truth)
+    common = prediction_counts & ground_truth_counts
     num_same = sum(common.values())
     if num_same == 0:
         return ZERO_METRIC
-    precision = 1.0 * num_same / len(prediction_tokens)
-    recall = 1.0 * num_same / len(ground_truth_tokens)
+    precision = 1.0 * num_same / n_prediction_tokens
+    recall = 1.0 * num_same / n_ground_truth_tokens
     f1 = (2 * precision * recall) / (precision + recall)
     return f1, precision, recall
 
+def f1_score(prediction, ground_truth):
+    return normalized_f1_score(normalize_answer(prediction), normalize_answer(ground_truth))
+
 def exact_match_score(prediction, ground_truth):
     return (normalize_answer(prediction) == normalize_answer(ground_truth))
 
+def compute_normalized_metrics(normalized_prediction, normalized_gold):
+    em = normalized_prediction == normalized_gold
+    f1, prec, recall = normalized_f1_score(normalized_prediction, normalized_gold)
+    return em, f1, prec, recall
+
 def compute_metrics(prediction, gold):
-    em = exact_match_score(prediction, gold)
-    f1, prec, recall = f1_score(prediction, gold)
+    return compute_normalized_metrics(normalize_answer(prediction), normalize_answer(gold))
+
+def score_question(prediction: str, golds: List[str]):
+    """Best em, f1, precision and recall over every gold answer, each maxed on its own.
+    The prediction is only normalized once, the golds not at all when they are NormalizedAnswers."""
+    normalized_prediction = normalize_answer(prediction)
+    scores = [
+        compute_normalized_metrics(normalized_prediction, normalized_gold)
+        for normalized_gold in normalized_golds(golds)
+    ]
+    em, f1, prec, recall = (max(metric_scores) for metric_scores in zip(*scores))
     return em, f1, prec, recall
 
 def update_metrics(metrics, em, f1, prec, recall):
@@ -67,73 +111,137 @@ def update_metrics(metrics, em, f1, prec, recall):
     metrics['recall'] += recall
     return em, f1, prec, recall
 
+def score_rows(rows: List[Tuple[Any, str, List[str]]]) -> List[Tuple[Any, Any, Any, Any]]:
+    """Score (id, prediction, gold answers) rows. Module level so worker processes can pickle it."""
+    return [score_question(prediction, golds) for _, prediction, golds in rows]
+
+def score_all(rows: List[Tuple[Any, str, List[str]]], num_workers: int = 1) -> List[Tuple[Any, Any, Any, Any]]:
+    """Score every row, split into chunks over num_workers processes.
+    The scores come back in row order so the sums are the same as the serial path."""
+    if num_workers <= 1 or len(rows) <= 1:
+        return score_rows(rows)
+
+    # A few chunks per worker keeps them all busy when some chunks are slower
+    chunk_size = max(1, math.ceil(len(rows) / (num_workers * 4)))
+    chunks = [rows[i:i + chunk_size] for i in range(0, len(rows), chunk_size)]
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        return [scores for chunk_scores in pool.map(score_rows, chunks) for scores in chunk_scores]
+
+def score_incremental(
+    dataset: str,
+    rows: List[Tuple[Any, str, List[str]]],
+    num_workers: int = 1,
+    score_cache: str = "",
+) -> List[Tuple[Any, Any, Any, Any]]:
+    """Like score_all but only rescores the rows whose (dataset, id, prediction, golds)
+    are not in the score cache yet. Everything else is read back from the cache."""
+    if not score_cache:
+        return score_all(rows, num_workers)
+
+    cache = ScoreCache(score_cache)
+    try:
+        # Keyed on the normalized golds so runs with and without the gold_norm column share the cache,
+        # and on the normalization so changing it rescores everything
+        normalization = normalization_hash()
+        keys = [
+            score_key(dataset, id, prediction, normalized_golds(golds), normalization)
+            for id, prediction, golds in rows
+        ]
+        scores = cache.get_many(keys)
+        missing = [i for i, question_scores in enumerate(scores) if question_scores is None]
+        logger.info(f'Rescoring {len(missing)} of {len(rows)} questions not in the score cache')
+
+        new_scores = score_all([rows[i] for i in missing], num_workers)
+        for i, question_scores in zip(missing, new_scores):
+            scores[i] = question_scores
+        cache.put_many(dataset, [rows[i][0] for i in missing], [keys[i] for i in missing], new_scores)
+    finally:
+        cache.close()
+    return scores
+
+def reduce_scores(
+    rows: List[Tuple[Any, str, List[str]]],
+    scores: List[Tuple[Any, Any, Any, Any]],
+    N: int,
+    groups: Optional[Dict[str, List[Any]]] = None,
+) -> Tuple[Dict[str, Any], ScoreStore]:
+    metrics = {'em': 0, 'f1': 0, 'prec': 0, 'recall': 0}
+
+    # Summed from the full precision scores, the store keeps them as float32
+    for em, f1, prec, recall in scores:
+        update_metrics(metrics, em, f1, prec, recall)
+
+    for k in metrics.keys():
+        metrics[k] /= N
+
+    logger.info(metrics)
+
+    per_question_metrics = ScoreStore.from_scores([row[0] for row in rows], scores, groups)
+    for name in per_question_metrics.groups:
+        logger.info(f'Metrics by {name}: {per_question_metrics.groupby(name)}')
+
+    return metrics, per_question_metrics
+
 """
 Code for hotpotQA evaluation modified from https://github.com/hotpotqa/hotpot/blob/master/hotpot_evaluate_v1.py
 """
-def hotpot_qa_eval(
-    predictions: Dict[str, str],
-    ground_truths: Dict[str, str]
-) -> Tuple[Dict[str, Any], Dict[str, Any]]:
-    metrics = {'em': 0, 'f1': 0, 'prec': 0, 'recall': 0}
+Rows = List[Tuple[Any, str, List[str]]]
 
-    per_question_metrics = {}
+def label_golds(label: Dict[str, Any], golds: List[str]) -> List[str]:
+    # Use the gold answers normalized when the dataset was built if it has them
+    if label.get('gold_norm') is not None:
+        return NormalizedAnswers(label['gold_norm'])
+    return golds
 
+def hotpot_qa_rows(predictions: Dict[str, str], ground_truths: Any) -> Tuple[Rows, Dict[str, List[Any]]]:
+    rows = []
+    groups = {'type': [], 'level': []}
     for label in ground_truths:
         cur_id = label['id']
         if cur_id not in predictions:
             logger.info('missing answer {}'.format(cur_id))
         else:
-            em, f1, prec, recall = compute_metrics(
-                predictions[cur_id], label['answer']
-            )
-
-            update_metrics(metrics, em, f1, prec, recall)
-            per_question_metrics[cur_id] = {
-                'em': em, 'f1': f1, 'prec': prec, 'recall': recall
-            }
+            rows.append((cur_id, predictions[cur_id], label_golds(label, [label['answer']])))
+            for name, values in groups.items():
+                values.append(label.get(name))
 
-    N = len(ground_truths)
-    for k in metrics.keys():
-        metrics[k] /= N
+    # Only group by the columns the preprocessed dataset kept
+    groups = {name: values for name, values in groups.items() if values and None not in values}
+    return rows, groups
 
-    logger.info(metrics)
+def hotpot_qa_eval(
+    predictions: Dict[str, str],
+    ground_truths: Dict[str, str],
+    num_workers: int = 1,
+    score_cache: str = "",
+) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    rows, groups = hotpot_qa_rows(predictions, ground_truths)
+    scores = score_incremental('hotpot_qa', rows, num_workers, score_cache)
+    return reduce_scores(rows, scores, len(ground_truths), groups)
 
-    return metrics, per_question_metrics
+def nq_open_rows(predictions: Dict[str, str], ground_truths: Any) -> Tuple[Rows, Dict[str, List[Any]]]:
+    rows = []
+    for label in ground_truths:
+        cur_id = label['id']
+        if cur_id not in predictions:
+            logger.info('missing answer {}'.format(cur_id))
+        else:
+            # Get the max value over every answer
+            rows.append((cur_id, predictions[cur_id], label_golds(label, label['answer'])))
+    return rows, {}
 
 def nq_open_eval(
     predictions: Dict[str, str],
     ground_truths: Dict[str, str],
+    num_workers: int = 1,
+    score_cache: str = "",
 ) -> Tuple[Dict[str, Any], Dict[str, Any]]:
-    metrics = {'em': 0, 'f1': 0, 'prec': 0, 'recall': 0}
-
-    per_question_metrics = {}
-
-    for id, label in enumerate(ground_truths):
-        prediction = predictions[id]
-        # Get the max value over ever answer
-        em_scores, f1_scores, prec_scores, recall_scores = [], [], [], []
-        # TODO: Can we put this in a nice list comprehension?
-        for answer in label['answer']:
-            em, f1, prec, recall = compute_metrics(prediction, answer)
-            em_scores.append(em)
-            f1_scores.append(f1)
-            prec_scores.append(prec)
-            recall_scores.append(recall)
-
-        em = max(em_scores)
-        f1 = max(f1_scores)
-        prec = max(prec_scores)
-        recall = max(recall_scores)
-
-        update_metrics(metrics, em, f1, prec, recall)
-        per_question_metrics[id] = {
-            'em': em, 'f1': f1, 'prec': prec, 'recall': recall
-        }
-
-    N = len(ground_truths)
-    for k in metrics.keys():
-        metrics[k] /= N
-
-    logger.info(metrics)
-
-    return metrics, per_question_metrics
\ No newline at end of file
+    rows, _ = nq_open_rows(predictions, ground_truths)
+    scores = score_incremental('nq_open', rows, num_workers, score_cache)
+    return reduce_scores(rows, scores, len(ground_truths))
+
+# The score cache name and row builder of every eval, for scoring several runs at once
+EVAL_ROWS = {
+    hotpot_qa_eval: ('hotpot_qa', hotpot_qa_rows),
+    nq_open_eval: ('nq_open', nq_open_rows),
+}
@@ -0,0 +1,168 @@
+import json
+import time
+import argparse
+import random
+import hashlib
+import logging
+import threading
+
+from typing import Any, Dict, List, Optional
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from src.config import MockServerConfig
+
+logger = logging.getLogger("apiLogger")
+
+WORDS = ['yes', 'no', 'the', 'city', 'river', 'paris', 'london', 'john', 'smith', 'band', 'album', 'film', '1990', 'two']
+
+def mock_completion(prompt: str, max_tokens: int, sample: int = 0) -> str:
+    """Deterministic text for a prompt so repeated runs see the same predictions."""
+    digest = hashlib.sha1(f'{sample}:{prompt}'.encode('utf-8')).digest()
+    n_words = 1 + digest[0] % max(1, min(max_tokens, 4))
+    return ' ' + ' '.join(WORDS[b % len(WORDS)] for b in digest[1:1 + n_words])
+
+class MockCompletionServer:
+    """Local stand in for the OpenAI completions endpoint.
+
+    Answers POST <url>/completions with deterministic completions in the OpenAI response
+    format, after a latency drawn from the configured distribution. A share of the
+    requests gets a 429 rate limit error instead. Used by the mock backend, which starts
+    one in process unless it is given the url of one running on its own
+
+        python -m src.mock_server --port 8000 --latency-ms 500 --rate-limit-rate 0.1
+    """
+    def __init__(self, cfg: MockServerConfig):
+        self.cfg = cfg
+        self._random = random.Random(cfg.seed)
+        self._lock = threading.Lock()
+        self.n_requests = 0
+        self.n_rate_limited = 0
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/v1'
+
+    def latency(self) -> float:
+        mean = self.cfg.latency_ms / 1000
+        with self._lock:
+            if self.cfg.latency_distribution == 'uniform':
+                return self._random.uniform(0, 2 * mean)
+            if self.cfg.latency_distribution == 'lognormal':
+                # sigma controls the tail, the mean stays at latency_ms
+                sigma = self.cfg.latency_sigma
+                return self._random.lognormvariate(0, sigma) * mean / (2.718281828459045 ** (sigma ** 2 / 2))
+            return mean
+
+    def rate_limited(self) -> bool:
+        with self._lock:
+            self.n_requests += 1
+            limited = self._random.random() < self.cfg.rate_limit_rate
+            self.n_rate_limited += limited
+            return limited
+
+    def respond(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        prompts = body.get('prompt', [])
+        if isinstance(prompts, str):
+            prompts = [prompts]
+        n = body.get('n', 1)
+        max_tokens = body.get('max_tokens', 16)
+        choices: List[Dict[str, Any]] = []
+        completion_tokens = 0
+        for i, prompt in enumerate(prompts):
+            for j in range(n):
+                text = mock_completion(prompt, max_tokens, j)
+                tokens = text.split()
+                completion_tokens += len(tokens)
+                choice = {"text": text, "index": i * n + j, "logprobs": None, "finish_reason": "stop"}
+                if body.get('logprobs'):
+                    digest = hashlib.sha1(text.encode('utf-8')).digest()
+                    choice["logprobs"] = {
+                        "tokens": tokens,
+                        "token_logprobs": [-(b / 255) * 3 for b in digest[:len(tokens)]],
+                        "top_logprobs": None,
+                        "text_offset": [],
+                    }
+                choices.append(choice)
+        prompt_tokens = sum(len(prompt) // 4 + 1 for prompt in prompts)
+        return {
+            "id": "cmpl-mock",
+            "object": "text_completion",
+            "created": int(time.time()),
+            "model": body.get('model', 'mock'),
+            "choices": choices,
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+            def _send(self, status: int, payload: Dict[str, Any]):
+                data = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                time.sleep(server.latency())
+                if not self.path.rstrip('/').endswith('/completions'):
+                    self._send(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+                elif server.rate_limited():
+                    self._send(429, {"error": {"message": "Rate limit reached for requests", "type": "requests"}})
+                else:
+                    self._send(200, server.respond(body))
+
+        return Handler
+
+    def start(self) -> "MockCompletionServer":
+        self._server = ThreadingHTTPServer((self.cfg.host, self.cfg.port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        logger.info(f'Mock completion server listening on {self.url}')
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self) -> "MockCompletionServer":
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve mock completions on /v1/completions')
+    defaults = MockServerConfig()
+    parser.add_argument('--host', default=defaults.host)
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency-ms', type=float, default=defaults.latency_ms)
+    parser.add_argument('--latency-distribution', default=defaults.latency_distribution, choices=['constant', 'uniform', 'lognormal'])
+    parser.add_argument('--latency-sigma', type=float, default=defaults.latency_sigma)
+    parser.add_argument('--rate-limit-rate', type=float, default=defaults.rate_limit_rate)
+    parser.add_argument('--seed', type=int, default=defaults.seed)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    with MockCompletionServer(MockServerConfig(**vars(args))):
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,304 @@
+import os
+import io
+import gzip
+import json
+import hashlib
+import logging
+
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+
+from src.config import DatasetConfig, NGramIndexConfig
+from src.retrieval import tokenize
+
+logger = logging.getLogger("apiLogger")
+
+_PRIME = np.uint64(0x100000001B3)
+
+def open_corpus(path: str) -> io.TextIOBase:
+    """Open a plain, gzip or zstandard compressed corpus shard as text."""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    if path.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('Reading .zst shards needs the zstandard package. Install it with pip install zstandard')
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb')), encoding='utf-8')
+    return open(path, encoding='utf-8')
+
+def iter_documents(path: str, text_field: str = "text", max_docs: int = 0) -> Iterator[str]:
+    """Stream the documents of a JSONL shard (one json object per line, like the Pile)
+    or of a plain text file where every line is a document."""
+    is_jsonl = '.jsonl' in path or '.json' in path
+    with open_corpus(path) as f:
+        for i, line in enumerate(f):
+            if max_docs and i >= max_docs:
+                break
+            yield json.loads(line)[text_field] if is_jsonl else line
+
+def splitmix64(x: np.ndarray) -> np.ndarray:
+    """Finalizer that spreads the hash bits evenly so the top bits can pick the bucket."""
+    with np.errstate(over='ignore'):
+        x = x + np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return x ^ (x >> np.uint64(31))
+
+class NGramHasher:
+    """Stable 64 bit hashes of token n-grams. The same text always hashes the same way
+    across processes and runs, unlike python's hash()."""
+    def __init__(self, orders: Sequence[int]):
+        self.orders = sorted(set(orders))
+        self._token_hashes: Dict[str, int] = {}
+
+    def token_hashes(self, tokens: List[str]) -> np.ndarray:
+        cache = self._token_hashes
+        # Bound the memory of the token cache on huge shards
+        if len(cache) > 2_000_000:
+            cache.clear()
+        out = np.empty(len(tokens), dtype=np.uint64)
+        for i, token in enumerate(tokens):
+            value = cache.get(token)
+            if value is None:
+                value = int.from_bytes(hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest(), 'little')
+                cache[token] = value
+            out[i] = value
+        return out
+
+    def hash_docs(self, docs: List[List[str]], orders: Optional[Sequence[int]] = None) -> np.ndarray:
+        """Hashes of every n-gram of every order inside each document. N-grams never cross documents."""
+        lengths = np.array([len(doc) for doc in docs], dtype=np.int64)
+        if lengths.sum() == 0:
+            return np.zeros(0, dtype=np.uint64)
+        tokens = self.token_hashes([token for doc in docs for token in doc])
+        doc_of_token = np.repeat(np.arange(len(docs)), lengths)
+
+        hashes = []
+        with np.errstate(over='ignore'):
+            for n in orders or self.orders:
+                n_grams = len(tokens) - n + 1
+                if n_grams <= 0:
+                    continue
+                h = np.full(n_grams, np.uint64(n), dtype=np.uint64)
+                for j in range(n):
+                    h = h * _PRIME + tokens[j:j + n_grams]
+                # Drop the n-grams that start in one document and end in the next
+                same_doc = doc_of_token[:n_grams] == doc_of_token[n - 1:]
+                hashes.append(splitmix64(h[same_doc]))
+        return np.concatenate(hashes) if hashes else np.zeros(0, dtype=np.uint64)
+
+    def hash_text(self, text: str, n: int) -> np.ndarray:
+        return self.hash_docs([tokenize(text)], orders=[n])
+
+class NGramIndex:
+    """Sorted unique n-gram hashes of a corpus shard with their counts, memory mapped from disk.
+
+    Building streams the shard in chunks and spreads the hashes over n_buckets files by their
+    top bits, so only one bucket has to fit in memory to be sorted and counted. Concatenating
+    the buckets in order gives a globally sorted array that lookups binary search.
+    """
+    HASHES_FNAME = 'ngrams.u64'
+    COUNTS_FNAME = 'counts.u32'
+    META_FNAME = 'meta.json'
+
+    def __init__(self, index_dir: str):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, self.META_FNAME)) as f:
+            self.meta = json.load(f)
+        self.orders = self.meta['orders']
+        size = self.meta['n_unique']
+        if size:
+            self.hashes = np.memmap(os.path.join(index_dir, self.HASHES_FNAME), dtype=np.uint64, mode='r', shape=(size,))
+            self.counts = np.memmap(os.path.join(index_dir, self.COUNTS_FNAME), dtype=np.uint32, mode='r', shape=(size,))
+        else:
+            self.hashes = np.zeros(0, dtype=np.uint64)
+            self.counts = np.zeros(0, dtype=np.uint32)
+        self.hasher = NGramHasher(self.orders)
+
+    @classmethod
+    def exists(cls, index_dir: str) -> bool:
+        return os.path.exists(os.path.join(index_dir, cls.META_FNAME))
+
+    @staticmethod
+    def source(cfg: NGramIndexConfig) -> Dict[str, Any]:
+        """What the index is built from, kept in the meta file. The size and mtime catch an edited shard."""
+        stat = os.stat(cfg.corpus)
+        return {
+            'corpus': cfg.corpus, 'corpus_size': stat.st_size, 'corpus_mtime': stat.st_mtime,
+            'text_field': cfg.text_field, 'orders': sorted(set(cfg.orders)), 'max_docs': cfg.max_docs,
+        }
+
+    @classmethod
+    def load_or_build(cls, cfg: NGramIndexConfig, index_dir: str) -> "NGramIndex":
+        """The index in index_dir if it was built from the same corpus and orders, otherwise build it again."""
+        if cls.exists(index_dir):
+            index = cls(index_dir)
+            source = cls.source(cfg)
+            if all(index.meta.get(key) == value for key, value in source.items()):
+                return index
+            logger.warning(f'The n-gram index in {index_dir} was built from another corpus or config. Rebuilding it')
+        logger.info(f'Building an n-gram index over {cfg.corpus}')
+        return cls.build(cfg, index_dir)
+
+    @classmethod
+    def build(cls, cfg: NGramIndexConfig, index_dir: str) -> "NGramIndex":
+        os.makedirs(index_dir, exist_ok=True)
+        n_buckets = max(1, cfg.n_buckets)
+        bucket_bits = max(1, (n_buckets - 1).bit_length())
+        n_buckets = 1 << bucket_bits
+        bucket_paths = [os.path.join(index_dir, f'bucket_{b}.tmp') for b in range(n_buckets)]
+        bucket_files = [open(path, 'wb') for path in bucket_paths]
+        hasher = NGramHasher(cfg.orders)
+
+        n_docs, n_total = 0, 0
+        def flush(docs: List[List[str]]):
+            nonlocal n_total
+            hashes = hasher.hash_docs(docs)
+            n_total += len(hashes)
+            buckets = (hashes >> np.uint64(64 - bucket_bits)).astype(np.int64)
+            order = np.argsort(buckets, kind='stable')
+            hashes, buckets = hashes[order], buckets[order]
+            bounds = np.searchsorted(buckets, np.arange(n_buckets + 1))
+            for b in range(n_buckets):
+                if bounds[b + 1] > bounds[b]:
+                    hashes[bounds[b]:bounds[b + 1]].tofile(bucket_files[b])
+
+        try:
+            chunk = []
+            for text in iter_documents(cfg.corpus, cfg.text_field, cfg.max_docs):
+                chunk.append(tokenize(text))
+                n_docs += 1
+                if len(chunk) == cfg.chunk_docs:
+                    flush(chunk)
+                    chunk = []
+                    logger.info(f'Hashed {n_docs} documents, {n_total} n-grams')
+            if chunk:
+                flush(chunk)
+        finally:
+            for f in bucket_files:
+                f.close()
+
+        # Sort and count one bucket at a time, appending to the final arrays
+        n_unique = 0
+        with open(os.path.join(index_dir, cls.HASHES_FNAME), 'wb') as hashes_out, \
+                open(os.path.join(index_dir, cls.COUNTS_FNAME), 'wb') as counts_out:
+            for path in bucket_paths:
+                bucket = np.fromfile(path, dtype=np.uint64)
+                os.remove(path)
+                if not len(bucket):
+                    continue
+                unique, counts = np.unique(bucket, return_counts=True)
+                unique.tofile(hashes_out)
+                np.minimum(counts, np.iinfo(np.uint32).max).astype(np.uint32).tofile(counts_out)
+                n_unique += len(unique)
+
+        meta = {**cls.source(cfg), 'n_docs': n_docs, 'n_ngrams': n_total, 'n_unique': n_unique}
+        with open(os.path.join(index_dir, cls.META_FNAME), 'w') as f:
+            json.dump(meta, f, indent=4)
+        logger.info(f'Built the n-gram index in {index_dir}: {meta}')
+        return cls(index_dir)
+
+    def lookup(self, hashes: np.ndarray) -> np.ndarray:
+        """Corpus count of every hash, 0 when it never occurs. Queries are sorted first
+        so the binary searches walk the memory map in order."""
+        if not len(hashes) or not len(self.hashes):
+            return np.zeros(len(hashes), dtype=np.int64)
+        order = np.argsort(hashes)
+        sorted_hashes = hashes[order]
+        positions = np.searchsorted(self.hashes, sorted_hashes)
+        positions = np.minimum(positions, len(self.hashes) - 1)
+        found = np.asarray(self.hashes[positions]) == sorted_hashes
+        counts = np.where(found, np.asarray(self.counts[positions]), 0).astype(np.int64)
+        out = np.empty_like(counts)
+        out[order] = counts
+        return out
+
+    def overlap(self, texts: List[str]) -> List[Dict[str, Any]]:
+        """Overlap stats of each text for every n-gram order. All the n-grams of all
+        the texts are looked up in one batch."""
+        per_text = [{} for _ in texts]
+        for n in self.orders:
+            hashes = [self.hasher.hash_text(text, n) for text in texts]
+            counts = self.lookup(np.concatenate(hashes) if hashes else np.zeros(0, dtype=np.uint64))
+            start = 0
+            for stats, text_hashes in zip(per_text, hashes):
+                text_counts = counts[start:start + len(text_hashes)]
+                start += len(text_hashes)
+                stats[f'{n}gram_total'] = len(text_counts)
+                stats[f'{n}gram_found'] = int((text_counts > 0).sum())
+                stats[f'{n}gram_frac'] = float((text_counts > 0).mean()) if len(text_counts) else None
+                # The rarest n-gram is the best signal of how often the text as a whole was seen
+                stats[f'{n}gram_min_count'] = int(text_counts.min()) if len(text_counts) else None
+        return per_text
+
+def field_text(value: Any) -> str:
+    """Flatten a dataset field into plain text. HotPotQA context is a dict of paragraphs
+    of sentences and NQ-Open answers are a list of strings."""
+    if value is None:
+        return ''
+    if isinstance(value, str):
+        return value
+    if isinstance(value, dict):
+        return field_text(value.get('sentences', list(value.values())))
+    if isinstance(value, (list, tuple)):
+        return ' '.join(field_text(item) for item in value)
+    return str(value)
+
+def load_per_question_metrics(run_dir: str) -> Dict[str, Dict[str, Any]]:
+    """The per question metrics of an earlier run, from its json or table output."""
+    json_path = os.path.join(run_dir, 'per_question_metrics.json')
+    if os.path.exists(json_path):
+        with open(json_path) as f:
+            return json.load(f)
+
+    for fname in ('results.parquet', 'results.arrow'):
+        path = os.path.join(run_dir, fname)
+        if os.path.exists(path):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pq.read_table(path) if fname.endswith('parquet') else pa.ipc.open_file(pa.memory_map(path)).read_all()
+            metric_cols = [col for col in table.column_names if col not in ('id', 'input', 'prediction', 'answer')]
+            rows = table.select(['id'] + metric_cols).to_pylist()
+            return {str(row.pop('id')): row for row in rows}
+    raise FileNotFoundError(f'No per question metrics found in {run_dir}')
+
+def overlap_analysis(
+    dataset: DatasetConfig,
+    index: NGramIndexConfig,
+    run_dir: str,
+    fields: List[str],
+    output_fname: str,
+    batch_size: int = 1000,
+    **kw,
+):
+    """Join the n-gram overlap of each example's fields with a corpus shard onto the
+    per question metrics of an earlier run."""
+    from hydra.utils import to_absolute_path
+
+    index.corpus = to_absolute_path(index.corpus)
+    ngram_index = NGramIndex.load_or_build(index, to_absolute_path(index.index_dir))
+
+    per_question_metrics = load_per_question_metrics(to_absolute_path(run_dir))
+    data = dataset.materialize(dataset.dataset)
+    fields = [field for field in fields if field in data.column_names]
+    logger.info(f'Computing overlap for the fields {fields}')
+
+    table = {}
+    for start in range(0, len(data), batch_size):
+        batch = data[start:start + batch_size]
+        ids = [str(id) for id in batch['id']]
+        row_stats = [{} for _ in ids]
+        for field in fields:
+            stats = ngram_index.overlap([field_text(value) for value in batch[field]])
+            for row, field_stats in zip(row_stats, stats):
+                row.update({f'{field}_{name}': value for name, value in field_stats.items()})
+        for id, stats in zip(ids, row_stats):
+            if id in per_question_metrics:
+                table[id] = {**per_question_metrics[id], **stats}
+
+    logger.info(f'Writing the overlap of {len(table)} questions to {output_fname}')
+    with open(output_fname, 'w') as f:
+        json.dump(table, f, indent=4)
+    return table
@@ -1,64 +1,300 @@
 #!/usr/bin/env python3
-from typing import Dict, List, Union
-from dataclasses import dataclass
+import json
+import logging
 
-import datasets
-from datasets import load_dataset
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional, Sequence, Union
+from dataclasses import dataclass
+from functools import lru_cache
 
+from src import instrument
 from src.config import (
     DatasetConfig,
     HotPotQAConfig,
     NQOpenConfig,
 )
+from src.metrics import gold_columns, normalization_hash
+from src.prompts import PromptTemplate, SharedPrefixPrompts
+from src.retrieval import index_fingerprint, load_or_build_index
+
+if TYPE_CHECKING:
+    # datasets takes over a second to import. It is only imported once a dataset is loaded
+    import datasets
+
+logger = logging.getLogger("apiLogger")
 
 BatchType = Dict[str, Union[str, List[str]]]
 
+def rows_to_batch(rows: List[Dict[str, Any]]) -> BatchType:
+    return {key: [row[key] for row in rows] for key in rows[0]}
+
+def batch_to_rows(batch: BatchType) -> List[Dict[str, Any]]:
+    return [dict(zip(batch, values)) for values in zip(*batch.values())]
+
+@lru_cache(maxsize=None)
+def _load_split(name: str, option: Optional[str], data_files: str, split: Optional[str], cache_dir: Optional[str]):
+    from datasets import load_dataset
+    return load_dataset(name, option, data_files=json.loads(data_files), split=split, cache_dir=cache_dir)
+
+def load_split(
+    name: str,
+    option: Optional[str] = None,
+    data_files: Any = None,
+    split: Optional[str] = None,
+    cache_dir: Optional[str] = None,
+    streaming: bool = False,
+) -> Union["datasets.Dataset", "datasets.IterableDataset"]:
+    """load_dataset, but every split is only loaded once per process so the configs of a sweep share it.
+    Datasets are never modified in place so handing out the same object is safe."""
+    if streaming:
+        from datasets import load_dataset
+        return load_dataset(name, option, data_files=data_files, split=split, cache_dir=cache_dir, streaming=True)
+    return _load_split(name, option, json.dumps(data_files, sort_keys=True), split, cache_dir)
+
 @dataclass
 class BaseDataset(DatasetConfig):
     _target_: str = ""
 
     def __post_init__(self):
-        self.dataset = load_dataset(
-            self.name, self.option,
-            split=self.split,
-            cache_dir=self.cache_dir
-        )
+        with instrument.stage('dataset_load'):
+            self.dataset = load_split(
+                self.name, self.option,
+                data_files=self.data_files,
+                split=self.split,
+                cache_dir=self.cache_dir,
+                streaming=self.streaming,
+            )
+            if self.project_columns:
+                self._project_columns()
 
         if self.shuffle:
-            self.dataset = self.dataset.shuffle(seed=self.random_seed)
+            if self.streaming:
+                self.dataset = self.dataset.shuffle(seed=self.random_seed, buffer_size=self.shuffle_buffer_size)
+            else:
+                self.dataset = self.dataset.shuffle(seed=self.random_seed)
 
         # If remove columns is a bool and True the remove all except label col
         # If False then remove nothing. If not a bool then remove the list
         # of columns provided
         if isinstance(self.remove_columns, bool):
-            self.remove_columns = self.dataset.column_names if self.remove_columns else []
+            self.remove_columns = self._column_names(self.dataset) if self.remove_columns else []
             if self.label_col in self.remove_columns:
                 self.remove_columns.remove(self.label_col)
+        else:
+            # Columns that were projected away are already gone
+            columns = self._column_names(self.dataset)
+            self.remove_columns = [column for column in self.remove_columns if column in columns]
 
-        # If no few shot examples are passed then generate them
-        if self.n_few_shot > 0 and len(self.few_shot_examples) == 0:
-            few_shot_dataset = self.dataset.select(range(self.select_n_samples, self.select_n_samples + self.n_few_shot))
-            few_shot_dataset = few_shot_dataset.map(
-                self._create_few_shot_examples,
-                batched=self.batched,
-                batch_size=self.n_few_shot,
-                remove_columns=self.remove_columns,
-                load_from_cache_file=False,
-            )
-            self.few_shot_examples = few_shot_dataset[self.text_col]
+        with instrument.stage('few_shot'):
+            if self.few_shot_retrieval:
+                # Every question gets its own few shot examples from the candidate pool
+                self._build_few_shot_index()
+                self.few_shot_examples = []
+            # If no few shot examples are passed then generate them
+            elif self.n_few_shot > 0 and len(self.few_shot_examples) == 0:
+                few_shot_dataset = self._few_shot_rows(self.n_few_shot).map(
+                    self._create_few_shot_examples,
+                    batched=self.batched,
+                    batch_size=self.n_few_shot,
+                    remove_columns=self.remove_columns,
+                    load_from_cache_file=False,
+                )
+                self.few_shot_examples = few_shot_dataset[self.text_col]
 
         self.few_shot_examples = self.section_delim.join(self.few_shot_examples)
+        self.template = PromptTemplate(self.header, self.few_shot_examples, self.prefix, self.section_delim)
+
+        # Results are logged and resumed by id so it has to be unique across preprocessing batches
+        if self.streaming:
+            self.dataset = self.dataset.take(self.select_n_samples)
+            if 'id' not in self._column_names(self.dataset):
+                self.dataset = self.dataset.map(self._add_id, with_indices=True)
+        else:
+            with instrument.stage('select'):
+                self.dataset = self.dataset.select(list(range(self.select_n_samples)))
+                if self.shuffle:
+                    # The shuffle left an indices mapping over the whole split behind. Write the
+                    # samples out contiguously so the maps below read them sequentially
+                    self.dataset = self.dataset.flatten_indices()
+            if 'id' not in self.dataset.column_names:
+                self.dataset = self.dataset.add_column('id', list(range(len(self.dataset))))
 
-        self.dataset = self.dataset.select(list(range(self.select_n_samples)))
+        if self.normalize_golds:
+            with instrument.stage('gold_columns'):
+                self._add_gold_columns()
 
-    def __call__(self) -> datasets.dataset_dict:
+    def _needed_columns(self) -> List[str]:
+        """Every column that preprocessing, the few shot examples or the metrics read."""
+        columns = ['id', self.label_col]
+        if self.few_shot_retrieval:
+            columns.append(self.retrieval_col)
+        return columns
+
+    def _project_columns(self):
+        available = self._column_names(self.dataset)
+        if not available:
+            # Some streaming datasets don't know their columns before the first row
+            return
+        needed = set(self._needed_columns())
+        keep = [column for column in available if column in needed]
+        dropped = [column for column in available if column not in needed]
+        if dropped:
+            logger.info(f'Only loading the columns {keep}, dropping {dropped}')
+            self.dataset = self.dataset.select_columns(keep)
+
+    def _add_gold_columns(self):
+        """Normalize the gold answers once. The result is cached like any other map, under a
+        fingerprint that also covers the normalization code so changing it rebuilds the columns."""
+        if self.streaming:
+            self.dataset = self.dataset.map(self._gold_columns, batched=True, batch_size=self.batch_size)
+            return
+        fingerprint = index_fingerprint(
+            data=self.dataset._fingerprint, label_col=self.label_col, normalization=normalization_hash(),
+        )
+        self.dataset = self.dataset.map(
+            self._gold_columns,
+            batched=True,
+            batch_size=self.batch_size,
+            load_from_cache_file=self.load_from_cache,
+            new_fingerprint=fingerprint,
+        )
+
+    def _gold_columns(self, examples: BatchType) -> BatchType:
+        return gold_columns(examples[self.label_col])
+
+    def __call__(self) -> Union["datasets.Dataset", "datasets.IterableDataset"]:
+        """Preprocess the dataset. In streaming mode this is lazy and the rows are
+        only preprocessed as they are read, see iter_batches."""
+        if self.streaming:
+            return self.dataset.map(
+                self._preprocess,
+                batched=self.batched,
+                batch_size=self.batch_size,
+                remove_columns=self.remove_columns,
+            )
         return self.dataset.map(
             self._preprocess,
             batched=self.batched,
             batch_size=self.batch_size,
             remove_columns=self.remove_columns,
             load_from_cache_file=self.load_from_cache,
+            num_proc=self.num_proc,
+        )
+
+    def iter_batches(
+        self,
+        data: Union["datasets.Dataset", "datasets.IterableDataset"],
+        batch_size: Optional[int] = None,
+    ) -> Iterator[BatchType]:
+        """Yield the preprocessed data in column batches. Streaming data is read lazily."""
+        import datasets
+        batch_size = batch_size or self.batch_size
+        if isinstance(data, datasets.Dataset):
+            for i in range(0, len(data), batch_size):
+                yield data[i:i + batch_size]
+            return
+
+        rows = []
+        for row in data:
+            rows.append(row)
+            if len(rows) == batch_size:
+                yield rows_to_batch(rows)
+                rows = []
+        if rows:
+            yield rows_to_batch(rows)
+
+    def materialize(
+        self,
+        data: Union["datasets.Dataset", "datasets.IterableDataset", List[Dict[str, Any]]],
+    ) -> "datasets.Dataset":
+        """Turn streamed data, or rows collected from it, into an in memory Dataset."""
+        import datasets
+        if isinstance(data, datasets.Dataset):
+            return data
+        return datasets.Dataset.from_list(list(data))
+
+    @staticmethod
+    def _column_names(dataset: Union["datasets.Dataset", "datasets.IterableDataset"]) -> List[str]:
+        # Streaming datasets don't always know their columns but they know their features
+        if dataset.column_names is not None:
+            return list(dataset.column_names)
+        return list(dataset.features or {})
+
+    @staticmethod
+    def _add_id(example: Dict[str, Any], idx: int) -> Dict[str, Any]:
+        return {'id': idx}
+
+    def _few_shot_rows(self, n: int) -> "datasets.Dataset":
+        """The n rows right after the evaluation samples, or as many as the split has.
+        Few shot examples are taken from here."""
+        if self.streaming:
+            import datasets
+            # Only these rows are pulled from the stream
+            rows = datasets.Dataset.from_list(
+                list(self.dataset.skip(self.select_n_samples).take(n)),
+                features=self.dataset.features,
+            )
+        else:
+            n_left = len(self.dataset) - self.select_n_samples
+            # select raises on an empty range at the end of the split
+            rows = self.dataset.select(range(self.select_n_samples, self.select_n_samples + min(n, n_left))) if n_left > 0 else []
+        if not len(rows):
+            raise ValueError(
+                f'No rows left for the few shot examples after the {self.select_n_samples} samples. '
+                'Lower select_n_samples or use a bigger split'
+            )
+        if len(rows) < n:
+            logger.warning(f'Only {len(rows)} rows left for the few shot examples, {n} were asked for')
+        return rows
+
+    def _build_few_shot_index(self):
+        if self.few_shot_retrieval != 'bm25':
+            raise ValueError(f'Unknown few shot retrieval {self.few_shot_retrieval}. Only bm25 is supported')
+
+        pool = self._few_shot_rows(self.few_shot_pool_size)
+        fingerprint = index_fingerprint(
+            name=self.name, option=self.option, data_files=self.data_files, split=self.split,
+            shuffle=self.shuffle, random_seed=self.random_seed,
+            select_n_samples=self.select_n_samples, pool_size=self.few_shot_pool_size,
+            retrieval_col=self.retrieval_col, data=getattr(pool, '_fingerprint', None),
         )
+        self._few_shot_index = load_or_build_index(self.cache_dir, fingerprint, pool[self.retrieval_col])
+        self._few_shot_pool = pool.map(
+            self._create_few_shot_examples,
+            batched=self.batched,
+            batch_size=self.batch_size,
+            remove_columns=self.remove_columns,
+            load_from_cache_file=self.load_from_cache,
+        )[self.text_col]
+
+    def _retrieve_few_shot(self, examples: BatchType) -> List[Optional[str]]:
+        """The few shot block for every row of the batch. None when the shared examples are used."""
+        if not self.few_shot_retrieval:
+            return [None] * len(examples[self.label_col])
+        hits = self._few_shot_index.query_many(examples[self.retrieval_col], self.n_few_shot)
+        # The most similar example goes last, right before the question
+        return [
+            self.section_delim.join(self._few_shot_pool[i] for i in reversed(top))
+            for top in hits
+        ]
+
+    @property
+    def _prefix_is_shared(self) -> bool:
+        # Retrieved few shot examples differ per row so there is no shared prefix to factor out
+        return self.share_prefix and not self.few_shot_retrieval
+
+    def prompts(self, data: Union["datasets.Dataset", BatchType]) -> Sequence[str]:
+        """The full prompts of the preprocessed data or of one batch of it. With share_prefix the text_col only
+        holds the per row suffix and the shared prefix is added back as each prompt is read."""
+        if self._prefix_is_shared:
+            return SharedPrefixPrompts(self.template.shared_prefix, data[self.text_col])
+        return data[self.text_col]
+
+    def _render(self, few_shot_examples: Optional[str], *row_parts: str) -> str:
+        if few_shot_examples is not None:
+            return self.template.render_with_few_shot(few_shot_examples, *row_parts)
+        if self._prefix_is_shared:
+            return ''.join(row_parts)
+        return self.template.render(*row_parts)
 
     def _preprocess(self, examples: BatchType) -> BatchType:
         examples[self.label_col] = examples[self.label_col]
@@ -71,69 +307,58 @@ class BaseDataset(DatasetConfig):
 
 @dataclass
 class HotPotQA(BaseDataset, HotPotQAConfig):
+    def _needed_columns(self) -> List[str]:
+        # supporting_facts is never read. type and level are only used to group the metrics
+        return super()._needed_columns() + ['question', 'context', 'type', 'level']
+
+    def _passage(self, context: Dict[str, List[List[str]]]) -> str:
+        return self.sentence_delim.join(''.join(sentences) for sentences in context['sentences'])
+
     def _create_few_shot_examples(self, examples: BatchType) -> BatchType:
-        sentences_grouped = [
-            [''.join(sent) for sent in sent_list['sentences']]
-            for sent_list in examples['context']
-        ]
-        sentences_arr = [
-            self.sentence_delim.join(sent) for sent in sentences_grouped
-        ]
         examples[self.text_col] = [
-            self.prefix \
-            + sent + self.section_delim \
-            + self.suffix \
-            + examples['question'][i] + self.section_delim \
-            + self.answer_prefix + examples[self.label_col][i]
-            for i, sent in enumerate(sentences_arr)
+            ''.join((
+                self.prefix, self._passage(context), self.section_delim,
+                self.suffix, question, self.section_delim,
+                self.answer_prefix, answer,
+            ))
+            for context, question, answer
+            in zip(examples['context'], examples['question'], examples[self.label_col])
         ]
         return examples
 
     def _preprocess(self, examples: BatchType) -> BatchType:
-        sentences_grouped = [
-            [''.join(sent) for sent in sent_list['sentences']]
-            for sent_list in examples['context']
-        ]
-        sentences_arr = [
-            self.sentence_delim.join(sent) for sent in sentences_grouped
-        ]
         examples[self.text_col] = [
-            self.header + self.section_delim \
-            + self.few_shot_examples + self.section_delim \
-            + self.prefix \
-            + sent + self.section_delim \
-            + self.suffix \
-            + examples['question'][i] + self.section_delim \
-            + self.answer_prefix
-            for i, sent in enumerate(sentences_arr)
+            self._render(
+                few_shot,
+                self._passage(context), self.section_delim,
+                self.suffix, question, self.section_delim,
+                self.answer_prefix,
+            )
+            for few_shot, context, question
+            in zip(self._retrieve_few_shot(examples), examples['context'], examples['question'])
         ]
         examples = super()._preprocess(examples)
         return examples
 
 @dataclass
 class NQOpen(BaseDataset, NQOpenConfig):
+    def _needed_columns(self) -> List[str]:
+        return super()._needed_columns() + [self.question_col]
+
     def _create_few_shot_examples(self, examples: BatchType) -> BatchType:
         # The answers for the dataset are a list.
         # For now take the first answer
         # TODO: Should we combine the list with commas?
         examples[self.text_col] = [
-            self.prefix \
-            + examples[self.question_col][i] \
-            + self.section_delim \
-            + self.suffix + examples[self.label_col][i][0]
-            for i in range(len(examples[self.question_col]))
+            ''.join((self.prefix, question, self.section_delim, self.suffix, answers[0]))
+            for question, answers in zip(examples[self.question_col], examples[self.label_col])
         ]
         return examples
 
     def _preprocess(self, examples: BatchType) -> BatchType:
         examples[self.text_col] = [
-            self.header + self.section_delim \
-            + self.few_shot_examples + self.section_delim \
-            + self.prefix \
-            + examples[self.question_col][i] \
-            + self.section_delim \
-            + self.suffix
-            for i in range(len(examples[self.question_col]))
+            self._render(few_shot, question, self.section_delim, self.suffix)
+            for few_shot, question in zip(self._retrieve_few_shot(examples), examples[self.question_col])
         ]
         examples = super()._preprocess(examples)
-        return examples
\ No newline at end of file
+        return examples
@@ -0,0 +1,222 @@
+import json
+import queue
+import logging
+import threading
+
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from src import instrument
+from src.config import (
+    MetricConfig,
+    DatasetConfig,
+    PipelineConfig,
+    GenerationAPIConfig,
+    GenerationFuncConfig,
+)
+from src.metrics import EVAL_ROWS, reduce_scores, score_incremental, update_metrics
+from src.our_datasets import batch_to_rows
+from src.store import ScoreStore
+
+logger = logging.getLogger("apiLogger")
+
+_DONE = object()
+
+class _Aborted(Exception):
+    """Raised inside a stage thread when another stage failed."""
+
+class Pipeline:
+    """Runs a source and a chain of stages in their own threads connected by bounded queues.
+
+    Each stage maps one item to the next and sees the items in the order the source
+    produced them. Calling stop() stops reading the source but lets the items already
+    in flight finish. If any stage raises, every thread is torn down and run() re-raises.
+    """
+    def __init__(self, queue_size: int = 4):
+        self.queue_size = queue_size
+        self._stop = threading.Event()
+        self._errors: List[BaseException] = []
+
+    def stop(self):
+        self._stop.set()
+
+    def _put(self, q: queue.Queue, item: Any):
+        while True:
+            if self._errors:
+                raise _Aborted()
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _get(self, q: queue.Queue) -> Any:
+        while True:
+            if self._errors:
+                raise _Aborted()
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+    def _guard(self, name: str, fn: Callable, *args):
+        try:
+            fn(*args)
+        except _Aborted:
+            pass
+        except BaseException as e:
+            logger.critical(f'Pipeline stage {name} failed')
+            self._errors.append(e)
+            self._stop.set()
+
+    def _read_source(self, source: Iterable, out: queue.Queue):
+        for item in source:
+            if self._stop.is_set():
+                break
+            self._put(out, item)
+        self._put(out, _DONE)
+
+    def _run_stage(self, fn: Callable[[Any], Any], inp: queue.Queue, out: Optional[queue.Queue]):
+        while True:
+            with instrument.timer(f'pipeline_{fn.__name__}_wait'):
+                item = self._get(inp)
+            if item is _DONE:
+                break
+            with instrument.timer(f'pipeline_{fn.__name__}'):
+                result = fn(item)
+            if out is not None:
+                self._put(out, result)
+        if out is not None:
+            self._put(out, _DONE)
+
+    def run(self, source: Iterable, stages: List[Callable[[Any], Any]]):
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in stages]
+        threads = [threading.Thread(
+            target=self._guard, args=('source', self._read_source, source, queues[0]), daemon=True,
+        )]
+        for i, stage in enumerate(stages):
+            out = queues[i + 1] if i + 1 < len(stages) else None
+            threads.append(threading.Thread(
+                target=self._guard, args=(stage.__name__, self._run_stage, stage, queues[i], out), daemon=True,
+            ))
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if self._errors:
+            raise self._errors[0]
+
+class IncrementalWriter:
+    """Appends each scored question to a JSONL file and keeps the running metrics on disk."""
+    def __init__(self, results_fname: str, running_metrics_fname: str):
+        self.results_fname = results_fname
+        self.running_metrics_fname = running_metrics_fname
+        self.sums = {'em': 0, 'f1': 0, 'prec': 0, 'recall': 0}
+        self.n_questions = 0
+        self.n_scored = 0
+        if self.results_fname:
+            # Start from an empty file so a rerun in the same directory doesn't mix results
+            open(self.results_fname, 'w').close()
+
+    def metrics(self) -> Dict[str, Any]:
+        N = max(self.n_questions, 1)
+        return {k: v / N for k, v in self.sums.items()}
+
+    def write(
+        self,
+        ids: List[Any],
+        prompts: List[str],
+        answers: List[Any],
+        predictions: Dict[Any, str],
+        scores: List[Tuple[Any, Any, Any, Any]],
+        per_question_metrics: Dict[Any, Dict[str, Any]],
+    ):
+        """scores are the full precision (em, f1, prec, recall) of the scored ids in order.
+        They are summed instead of the float32 store so the metrics match the non streaming run."""
+        self.n_questions += len(ids)
+        lines = []
+        full_scores = iter(scores)
+        for id, prompt, answer in zip(ids, prompts, answers):
+            if id not in per_question_metrics:
+                continue
+            update_metrics(self.sums, *next(full_scores))
+            self.n_scored += 1
+            lines.append(json.dumps({
+                "id": id, "input": prompt, "prediction": predictions[id], "answer": answer, **per_question_metrics[id]
+            }) + '\n')
+
+        if self.results_fname:
+            with open(self.results_fname, 'a') as f:
+                f.write(''.join(lines))
+        if self.running_metrics_fname:
+            with open(self.running_metrics_fname, 'w') as f:
+                json.dump({**self.metrics(), "n_questions": self.n_questions, "n_scored": self.n_scored}, f, indent=4)
+
+def run_pipeline(
+    cfg: PipelineConfig,
+    api: GenerationAPIConfig,
+    dataset: DatasetConfig,
+    data: Any,
+    metric: MetricConfig,
+    generate_func: GenerationFuncConfig,
+) -> Tuple[Any, Dict[Any, str], Dict[Any, List[str]], Dict[Any, Any], Dict[str, Any], ScoreStore]:
+    """Overlap preprocessing, generation, scoring and writing. Only queue_size batches
+    are in flight between each pair of stages.
+
+    Returns the data, predictions, samples, logprobs, metrics and per question metrics like
+    the generation and scoring stages of entry_point, so the sample scoring, calibration and
+    output_func run on them the same way. The final metrics are summed in question order and
+    divided by the number of questions in the split, or with dataset.streaming by the number
+    of rows read, so they match the non pipelined run. The running metrics are over the rows
+    read so far."""
+    pipeline = Pipeline(cfg.queue_size)
+    # Score like the eval function does but keep the full precision scores for the writer
+    score_name, build_rows = EVAL_ROWS[metric.func]
+    writer = IncrementalWriter(cfg.results_fname, cfg.running_metrics_fname)
+    # Collected in question order for the final outputs
+    read, rows, scores, groups = [], [], [], {}
+    predictions, samples, logprobs = {}, {}, {}
+
+    def generation(batch):
+        batch_predictions = generate_func(api_cfg=api, prompts=dataset.prompts(batch), ids=batch['id'])
+        if len(batch_predictions) < len(batch['id']):
+            logger.error('Generation stopped early. Not reading any more of the dataset')
+            pipeline.stop()
+        return batch, batch_predictions
+
+    def scoring(item):
+        batch, batch_predictions = item
+        batch_rows, batch_groups = build_rows(dict(zip(batch['id'], batch_predictions)), batch_to_rows(batch))
+        batch_scores = score_incremental(
+            score_name, batch_rows, metric.keywords.get('num_workers', 1), metric.keywords.get('score_cache', ""),
+        )
+        store = ScoreStore.from_scores([row[0] for row in batch_rows], batch_scores)
+        return batch, batch_predictions, batch_rows, batch_groups, batch_scores, store
+
+    def writing(item):
+        batch, batch_predictions, batch_rows, batch_groups, batch_scores, store = item
+        batch_predictions_by_id = dict(zip(batch['id'], batch_predictions))
+        writer.write(
+            batch['id'], dataset.prompts(batch), batch[dataset.label_col], batch_predictions_by_id, batch_scores, store,
+        )
+        logger.info(f'Scored {writer.n_scored} of {writer.n_questions} questions so far. Running metrics {writer.metrics()}')
+
+        predictions.update(batch_predictions_by_id)
+        # dry_run and other generate functions only return the predictions
+        samples.update(zip(batch['id'], getattr(batch_predictions, 'samples', [])))
+        logprobs.update(zip(batch['id'], getattr(batch_predictions, 'logprobs', [])))
+        rows.extend(batch_rows)
+        scores.extend(batch_scores)
+        for name, values in batch_groups.items():
+            groups.setdefault(name, []).extend(values)
+        if dataset.streaming:
+            read.extend(batch_to_rows(batch))
+
+    pipeline.run(dataset.iter_batches(data, cfg.batch_size or None), [generation, scoring, writing])
+
+    if dataset.streaming:
+        data = dataset.materialize(read)
+    # A group column that some batch didn't have can't be grouped by
+    groups = {name: values for name, values in groups.items() if len(values) == len(rows)}
+    metrics, per_question_metrics = reduce_scores(rows, scores, len(data), groups)
+    return data, predictions, samples, logprobs, metrics, per_question_metrics
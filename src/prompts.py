@@ -0,0 +1,42 @@
+from typing import List, Sequence, Union, overload
+
+class PromptTemplate:
+    """Compiled form of the prompt layout described in DatasetConfig.
+
+    Everything before the row text is the same for every row
+
+        <header><section_delim><FEW_SHOT_EXAMPLES><section_delim><prefix>
+
+    so it is built once here and each row is rendered with a single join.
+    """
+    def __init__(self, header: str, few_shot_examples: str, prefix: str, section_delim: str):
+        self.header = header
+        self.prefix = prefix
+        self.section_delim = section_delim
+        self.shared_prefix = ''.join((header, section_delim, few_shot_examples, section_delim, prefix))
+
+    def render(self, *row_parts: str) -> str:
+        return ''.join((self.shared_prefix,) + row_parts)
+
+    def render_with_few_shot(self, few_shot_examples: str, *row_parts: str) -> str:
+        """Render a row with its own few shot examples instead of the shared ones."""
+        return ''.join((self.header, self.section_delim, few_shot_examples, self.section_delim, self.prefix) + row_parts)
+
+class SharedPrefixPrompts(Sequence):
+    """Prompts stored as one shared prefix plus the per row suffixes.
+    The full prompt is only built when it is read."""
+    def __init__(self, shared_prefix: str, suffixes: List[str]):
+        self.shared_prefix = shared_prefix
+        self.suffixes = suffixes
+
+    def __len__(self) -> int:
+        return len(self.suffixes)
+
+    @overload
+    def __getitem__(self, i: int) -> str: ...
+    @overload
+    def __getitem__(self, i: slice) -> List[str]: ...
+    def __getitem__(self, i: Union[int, slice]) -> Union[str, List[str]]:
+        if isinstance(i, slice):
+            return [self.shared_prefix + suffix for suffix in self.suffixes[i]]
+        return self.shared_prefix + self.suffixes[i]
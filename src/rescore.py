@@ -0,0 +1,103 @@
+import os
+import json
+import time
+import logging
+import argparse
+
+from typing import Any, Dict, List, Optional, Tuple
+
+from src.metrics import EVAL_ROWS
+
+logger = logging.getLogger("apiLogger")
+
+# Only the metrics are imported here. No hydra, datasets or openai, so this starts in a
+# fraction of a second and can be called from scripts over many runs.
+EVALS = {name: eval_fn for eval_fn, (name, _) in EVAL_ROWS.items()}
+
+TABLE_EXTENSIONS = ('.parquet', '.arrow')
+
+def read_table(fname: str) -> List[Dict[str, Any]]:
+    """Rows of a results table written with output_func.format=parquet or arrow."""
+    import pyarrow as pa
+
+    if fname.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        table = pq.read_table(fname)
+    else:
+        with pa.memory_map(fname) as source:
+            table = pa.ipc.open_file(source).read_all()
+    return table.to_pylist()
+
+def read_run(path: str) -> Tuple[Dict[Any, str], List[Dict[str, Any]]]:
+    """The predictions and the gold answers of a run, from its results table or its input_output_pairs.json.
+    path is the file or the run directory."""
+    if os.path.isdir(path):
+        candidates = [os.path.join(path, f'results{ext}') for ext in TABLE_EXTENSIONS]
+        candidates.append(os.path.join(path, 'input_output_pairs.json'))
+        found = [fname for fname in candidates if os.path.exists(fname)]
+        if not found:
+            raise FileNotFoundError(f'No results table or input_output_pairs.json in {path}')
+        path = found[0]
+
+    logger.info(f'Reading the predictions and answers from {path}')
+    if path.endswith(TABLE_EXTENSIONS):
+        rows = read_table(path)
+        predictions = {row['id']: row['prediction'] for row in rows}
+        # The group columns (e.g. the HotPotQA type and level) come along with the answer
+        labels = [{k: v for k, v in row.items() if k not in ('input', 'prediction', 'samples')} for row in rows]
+        return predictions, labels
+
+    with open(path) as f:
+        pairs = json.load(f)
+    predictions = {id: pair['output'] for id, pair in pairs.items()}
+    labels = [{'id': id, 'answer': pair['answer']} for id, pair in pairs.items()]
+    return predictions, labels
+
+def infer_dataset(labels: List[Dict[str, Any]]) -> str:
+    # NQ-Open has a list of answers per question, HotPotQA a single one
+    if labels and isinstance(labels[0]['answer'], list):
+        return 'nq_open'
+    return 'hotpot_qa'
+
+def rescore(
+    path: str,
+    dataset: Optional[str] = None,
+    predictions_fname: str = "",
+    num_workers: int = 1,
+    score_cache: str = "",
+) -> Tuple[Dict[str, Any], Any]:
+    """Recompute the metrics of a finished run, optionally with the predictions from another json file."""
+    predictions, labels = read_run(path)
+    if predictions_fname:
+        with open(predictions_fname) as f:
+            predictions = json.load(f)
+        # json keys are always strings
+        labels = [dict(label, id=str(label['id'])) for label in labels]
+
+    dataset = dataset or infer_dataset(labels)
+    logger.info(f'Rescoring {len(predictions)} predictions for {len(labels)} {dataset} questions')
+    return EVALS[dataset](predictions, labels, num_workers=num_workers, score_cache=score_cache)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Recompute the metrics of a finished run without calling the API')
+    parser.add_argument('path', help='Run directory, results table (.parquet / .arrow) or input_output_pairs.json')
+    parser.add_argument('--dataset', choices=sorted(EVALS), help='Inferred from the answers when not given')
+    parser.add_argument('--predictions', default='', help='json of {id: prediction} to score instead of the run ones')
+    parser.add_argument('--num-workers', type=int, default=1)
+    parser.add_argument('--score-cache', default='')
+    parser.add_argument('--metrics-out', default='rescored_metrics.json')
+    parser.add_argument('--per-question-out', default='rescored_per_question_metrics.json',
+                        help='Empty string to skip')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    start = time.perf_counter()
+    metrics, per_question_metrics = rescore(
+        args.path, args.dataset, args.predictions, args.num_workers, args.score_cache,
+    )
+    with open(args.metrics_out, 'w') as f:
+        json.dump(metrics, f, indent=4)
+    if args.per_question_out:
+        with open(args.per_question_out, 'w') as f:
+            json.dump(per_question_metrics.to_dict(), f, indent=4)
+    logger.info(f'Rescored in {time.perf_counter() - start:.2f}s. Wrote {args.metrics_out}')
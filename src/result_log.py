@@ -0,0 +1,52 @@
+import os
+import json
+import logging
+import threading
+
+from typing import Any, Callable, Dict, List
+
+from src.sampling import first
+
+logger = logging.getLogger("apiLogger")
+
+class ResultLog:
+    """Append only JSONL log of the choices generated for each example id.
+
+    Every slice is flushed to disk as soon as it arrives so a crash, running out of quota
+    or a kill signal only loses the requests that were in flight. A run with resume on
+    reads the log back and only generates the ids that are not in it yet.
+    The prediction of each line is picked from its choices with aggregate, like batch_generate does.
+    """
+    def __init__(self, path: str, aggregate: Callable[[List[Dict[str, Any]]], Dict[str, Any]] = first):
+        self.path = os.path.expanduser(path)
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.aggregate = aggregate
+        self._lock = threading.Lock()
+
+    def read(self) -> Dict[Any, List[Dict[str, Any]]]:
+        finished = {}
+        if not os.path.exists(self.path):
+            return finished
+        with open(self.path) as f:
+            for line_num, line in enumerate(f):
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line can be cut short if we were killed while writing it
+                    logger.warning(f'Skipping malformed line {line_num} in {self.path}')
+                    continue
+                finished[record["id"]] = record["choices"]
+        logger.info(f'Read {len(finished)} finished ids from {self.path}')
+        return finished
+
+    def append(self, ids: List[Any], choices: List[List[Dict[str, Any]]]):
+        lines = ''.join(
+            json.dumps({"id": id, "prediction": self.aggregate(prompt_choices)["text"], "choices": prompt_choices}) + '\n'
+            for id, prompt_choices in zip(ids, choices)
+        )
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(lines)
+                f.flush()
+                os.fsync(f.fileno())
@@ -0,0 +1,135 @@
+import os
+import re
+import json
+import hashlib
+import logging
+
+from typing import Any, Dict, List, Optional
+from collections import Counter
+
+import numpy as np
+
+logger = logging.getLogger("apiLogger")
+
+TOKEN_RE = re.compile(r'\w+')
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_RE.findall(text.lower())
+
+class BM25Index:
+    """BM25 over a fixed pool of documents with the inverted index stored as CSR arrays.
+
+    The BM25 weight of every (term, document) pair is computed when the index is built
+    so a query is just a scatter add of the posting lists of its terms and a top k.
+    """
+    def __init__(
+        self,
+        vocab: Dict[str, int],
+        term_ptr: np.ndarray,
+        doc_ids: np.ndarray,
+        weights: np.ndarray,
+        n_docs: int,
+    ):
+        self.vocab = vocab
+        self.term_ptr = term_ptr
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.n_docs = n_docs
+
+    @classmethod
+    def build(cls, docs: List[str], k1: float = 1.5, b: float = 0.75) -> "BM25Index":
+        vocab: Dict[str, int] = {}
+        term_ids, doc_ids, term_freqs, doc_lengths = [], [], [], []
+        for doc_id, doc in enumerate(docs):
+            counts = Counter(tokenize(doc))
+            for term, tf in counts.items():
+                term_ids.append(vocab.setdefault(term, len(vocab)))
+                doc_ids.append(doc_id)
+                term_freqs.append(tf)
+            doc_lengths.append(sum(counts.values()))
+
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        doc_ids = np.asarray(doc_ids, dtype=np.int32)
+        tf = np.asarray(term_freqs, dtype=np.float32)
+        doc_lengths = np.asarray(doc_lengths, dtype=np.float32)
+        avg_length = doc_lengths.mean() if len(docs) and doc_lengths.mean() > 0 else 1.0
+
+        n_docs = len(docs)
+        df = np.bincount(term_ids, minlength=len(vocab))
+        idf = np.log1p((n_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+        norm = k1 * (1 - b + b * doc_lengths[doc_ids] / avg_length)
+        weights = idf[term_ids] * tf * (k1 + 1) / (tf + norm)
+
+        # Group the postings by term so each term is a contiguous slice
+        order = np.argsort(term_ids, kind='stable')
+        term_ptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(df, out=term_ptr[1:])
+        return cls(vocab, term_ptr, doc_ids[order], weights[order].astype(np.float32), n_docs)
+
+    def scores(self, text: str) -> np.ndarray:
+        scores = np.zeros(self.n_docs, dtype=np.float32)
+        for term in set(tokenize(text)):
+            term_id = self.vocab.get(term)
+            if term_id is None:
+                continue
+            start, end = self.term_ptr[term_id], self.term_ptr[term_id + 1]
+            scores[self.doc_ids[start:end]] += self.weights[start:end]
+        return scores
+
+    def query(self, text: str, k: int) -> np.ndarray:
+        """Indices of the k best documents, best first."""
+        k = min(k, self.n_docs)
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64)
+        scores = self.scores(text)
+        top = np.argpartition(-scores, k - 1)[:k]
+        return top[np.argsort(-scores[top], kind='stable')]
+
+    def query_many(self, texts: List[str], k: int) -> List[np.ndarray]:
+        return [self.query(text, k) for text in texts]
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        terms = sorted(self.vocab, key=self.vocab.get)
+        # Write to a temporary file first so a concurrent run never reads half an index
+        tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+        np.savez(
+            tmp_path,
+            terms=np.array(json.dumps(terms)),
+            term_ptr=self.term_ptr,
+            doc_ids=self.doc_ids,
+            weights=self.weights,
+            n_docs=np.array(self.n_docs),
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        with np.load(path) as arrays:
+            terms = json.loads(str(arrays['terms']))
+            return cls(
+                {term: i for i, term in enumerate(terms)},
+                arrays['term_ptr'],
+                arrays['doc_ids'],
+                arrays['weights'],
+                int(arrays['n_docs']),
+            )
+
+def index_fingerprint(**kwargs: Any) -> str:
+    return hashlib.sha1(json.dumps(kwargs, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+def load_or_build_index(cache_dir: Optional[str], fingerprint: str, docs: List[str]) -> BM25Index:
+    """Build the index once and keep it on disk next to the huggingface dataset cache."""
+    if cache_dir is None:
+        from datasets import config
+        cache_dir = config.HF_DATASETS_CACHE
+    path = os.path.join(os.path.expanduser(str(cache_dir)), 'few_shot_index', f'{fingerprint}.npz')
+
+    if os.path.exists(path):
+        logger.info(f'Loading the few shot index from {path}')
+        return BM25Index.load(path)
+
+    logger.info(f'Building the few shot index over {len(docs)} candidates')
+    index = BM25Index.build(docs)
+    index.save(path)
+    return index
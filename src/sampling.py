@@ -0,0 +1,107 @@
+import logging
+
+from typing import Any, Callable, Dict, List, Optional, Sequence
+from collections import Counter
+
+import numpy as np
+
+from src.metrics import normalize_answer
+from src.store import METRIC_NAMES
+
+logger = logging.getLogger("apiLogger")
+
+Choice = Dict[str, Any]
+
+def token_logprobs(choice: Choice) -> Optional[List[float]]:
+    """The token logprobs of a choice, None when the response has no logprobs."""
+    logprobs = choice.get("logprobs")
+    if not logprobs or logprobs.get("token_logprobs") is None:
+        return None
+    # The first token of an echoed prompt has no logprob
+    return [logprob for logprob in logprobs["token_logprobs"] if logprob is not None]
+
+def mean_logprob(choice: Choice) -> float:
+    """Mean token logprob of a choice, -inf when the response has no logprobs."""
+    logprobs = token_logprobs(choice)
+    return sum(logprobs) / len(logprobs) if logprobs else float('-inf')
+
+def first(choices: Sequence[Choice]) -> Choice:
+    return choices[0]
+
+def majority(choices: Sequence[Choice]) -> Choice:
+    """Self consistency. The most common answer after normalization, ties go to the earliest sample.
+    The first sample with that answer is returned."""
+    normalized = [normalize_answer(choice["text"]) for choice in choices]
+    # most_common keeps insertion order between equal counts
+    answer, _ = Counter(normalized).most_common(1)[0]
+    return choices[normalized.index(answer)]
+
+def max_logprob(choices: Sequence[Choice]) -> Choice:
+    """The sample the model is most confident in. Needs api.logprobs > 0."""
+    return max(choices, key=mean_logprob)
+
+AGGREGATORS: Dict[str, Callable[[Sequence[Choice]], Choice]] = {
+    'first': first,
+    'majority': majority,
+    'logprob': max_logprob,
+}
+
+def get_aggregator(name: str) -> Callable[[Sequence[Choice]], Choice]:
+    if name not in AGGREGATORS:
+        raise ValueError(f'Unknown aggregation {name}. Choose one of {list(AGGREGATORS)}')
+    return AGGREGATORS[name]
+
+class Samples(list):
+    """The aggregated prediction of every prompt. Every sampled text of each prompt is in samples
+    and the token logprobs of each prediction (None without api.logprobs) in logprobs, so callers
+    that only want the predictions can keep treating this as a list."""
+    def __init__(
+        self,
+        predictions: List[str],
+        samples: List[List[str]],
+        logprobs: Optional[List[Optional[List[float]]]] = None,
+    ):
+        super().__init__(predictions)
+        self.samples = samples
+        self.logprobs = logprobs if logprobs is not None else [None] * len(predictions)
+
+def score_samples(
+    metric: Callable,
+    samples: Dict[Any, List[str]],
+    ground_truths: Any,
+) -> Dict[str, Any]:
+    """Score every sample of every question on its own with the metric function.
+
+    mean is what one sample scores on average and oracle takes the best sample of each
+    question (pass@k for em). Both count the questions without samples as 0 like the metrics.
+    per_question holds the score of every sample by metric.
+    """
+    ids = list(samples)
+    n_samples = max((len(texts) for texts in samples.values()), default=0)
+    scores = {name: np.full((len(ids), n_samples), np.nan, dtype=np.float32) for name in METRIC_NAMES}
+    for j in range(n_samples):
+        logger.info(f'Scoring sample {j + 1} of {n_samples}')
+        predictions = {id: texts[j] for id, texts in samples.items() if j < len(texts)}
+        _, store = metric(predictions=predictions, ground_truths=ground_truths)
+        rows = store.rows(ids)
+        scored = rows >= 0
+        for name in METRIC_NAMES:
+            scores[name][scored, j] = store.columns[name][rows[scored]]
+
+    n = max(len(ground_truths), 1)
+    result = {"n_samples": n_samples, "mean": {}, "oracle": {}}
+    for name, values in scores.items():
+        # A question with no scored sample counts as 0
+        scored = ~np.isnan(values)
+        counts = scored.sum(axis=1)
+        totals = np.where(scored, values, 0).sum(axis=1, dtype=np.float64)
+        per_question_mean = np.divide(totals, counts, out=np.zeros_like(totals), where=counts > 0)
+        result["mean"][name] = float(per_question_mean.sum() / n)
+        result["oracle"][name] = float(np.where(scored, values, 0).max(axis=1, initial=0).sum(dtype=np.float64) / n)
+    logger.info(f'Sample metrics over {n_samples} samples: mean {result["mean"]} oracle {result["oracle"]}')
+
+    result["per_question"] = {
+        id: {name: [None if np.isnan(v) else float(str(v)) for v in scores[name][i]] for name in METRIC_NAMES}
+        for i, id in enumerate(ids)
+    }
+    return result
@@ -0,0 +1,175 @@
+import time
+import random
+import logging
+import threading
+
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from src import instrument
+from src.backends import RetryableError
+from src.config import SchedulerConfig
+
+logger = logging.getLogger("apiLogger")
+
+# (prompts, index of the first prompt) -> OpenAI style response or None when we are out of quota
+RequestFunc = Callable[[List[str], int], Optional[Dict[str, Any]]]
+
+def estimate_tokens(prompt: str) -> int:
+    """Rough token count used for the tokens per minute budget. ~4 characters per token."""
+    return len(prompt) // 4 + 1
+
+class RateLimiter:
+    """Sliding one minute window over the requests and tokens we have sent.
+    Shared by every worker so the budget holds across concurrent requests."""
+    def __init__(self, requests_per_minute: int = 0, tokens_per_minute: int = 0, window: float = 60.0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.window = window
+        self._lock = threading.Lock()
+        self._sent = deque()
+        self._tokens_in_window = 0
+
+    def _expire(self, now: float):
+        while self._sent and now - self._sent[0][0] >= self.window:
+            _, tokens = self._sent.popleft()
+            self._tokens_in_window -= tokens
+
+    def acquire(self, tokens: int) -> float:
+        """Block until the request fits in the budget. Returns the number of seconds we waited."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._expire(now)
+                fits_requests = not self.requests_per_minute or len(self._sent) < self.requests_per_minute
+                # A request bigger than the whole budget is still let through on an empty window
+                fits_tokens = not self.tokens_per_minute or not self._sent \
+                    or self._tokens_in_window + tokens <= self.tokens_per_minute
+                if fits_requests and fits_tokens:
+                    self._sent.append((now, tokens))
+                    self._tokens_in_window += tokens
+                    return waited
+                wait = self._sent[0][0] + self.window - now
+            wait = max(wait, 0.01)
+            time.sleep(wait)
+            waited += wait
+
+class GenerationScheduler:
+    """Sends slices of the prompts concurrently while staying inside the rate budget.
+
+    Each slice is retried with exponential backoff and full jitter when the request
+    function raises one of rate_limit_errors, by default any RetryableError of the
+    backend. Any other error, or a None response (out of quota), stops the run. The
+    choices are returned grouped per prompt in the original prompt order. If the run
+    stopped early only the leading slices that finished are returned so the
+    predictions stay aligned with the prompts.
+    """
+    def __init__(
+        self,
+        cfg: SchedulerConfig,
+        rate_limit_errors: Tuple[Type[BaseException], ...] = (RetryableError,),
+        limiter: Optional[RateLimiter] = None,
+    ):
+        self.cfg = cfg
+        self.rate_limit_errors = rate_limit_errors
+        self.limiter = limiter or RateLimiter(cfg.requests_per_minute, cfg.tokens_per_minute)
+        self._random = random.Random()
+
+    def slices(self, n_prompts: int) -> List[Tuple[int, int]]:
+        batch_size = max(1, self.cfg.batch_size)
+        return [(i, min(i + batch_size, n_prompts)) for i in range(0, n_prompts, batch_size)]
+
+    def backoff(self, attempt: int) -> float:
+        cap = min(self.cfg.backoff_max, self.cfg.backoff_base * 2 ** attempt)
+        return self._random.uniform(0, cap)
+
+    def _send(
+        self,
+        request_fn: RequestFunc,
+        prompts: List[str],
+        start: int,
+        tokens: int,
+        stop: threading.Event,
+    ) -> Optional[List[List[Dict[str, Any]]]]:
+        for attempt in range(self.cfg.max_retries + 1):
+            if stop.is_set():
+                return None
+            waited = self.limiter.acquire(tokens)
+            if waited:
+                instrument.record('rate_limiter_wait', waited)
+            try:
+                response = request_fn(prompts, start)
+            except self.rate_limit_errors as e:
+                if attempt == self.cfg.max_retries:
+                    raise
+                delay = self.backoff(attempt)
+                instrument.count('api_retries')
+                instrument.count(f'api_errors_{type(e).__name__}')
+                instrument.record('retry_backoff', delay)
+                logger.warning(f'{type(e).__name__} on prompts {start} through {start + len(prompts)}. Retrying in {delay:.1f}s')
+                logger.debug(e)
+                time.sleep(delay)
+                continue
+
+            if response is None:
+                return None
+            return group_choices(response["choices"], len(prompts))
+
+    def run(
+        self,
+        prompts: List[str],
+        request_fn: RequestFunc,
+        completion_tokens: int = 0,
+        slices: Optional[List[Tuple[int, int]]] = None,
+        prompt_tokens: Optional[List[int]] = None,
+    ) -> List[List[Dict[str, Any]]]:
+        """Slices default to fixed batches of batch_size. prompt_tokens are the real token
+        counts if we have them, otherwise they are estimated for the tokens per minute budget."""
+        if slices is None:
+            slices = self.slices(len(prompts))
+        if prompt_tokens is None:
+            prompt_tokens = [estimate_tokens(prompt) for prompt in prompts]
+        results: List[Optional[List[List[Dict[str, Any]]]]] = [None] * len(slices)
+        stop = threading.Event()
+
+        with ThreadPoolExecutor(max_workers=max(1, self.cfg.max_in_flight)) as pool:
+            futures = {
+                pool.submit(
+                    self._send, request_fn, prompts[start:end], start,
+                    sum(prompt_tokens[start:end]) + completion_tokens * (end - start), stop,
+                ): k
+                for k, (start, end) in enumerate(slices)
+            }
+            for future in as_completed(futures):
+                if future.cancelled():
+                    continue
+                k = futures[future]
+                start, end = slices[k]
+                try:
+                    results[k] = future.result()
+                except Exception as e:
+                    logger.critical(f'Request for prompts {start} through {end} failed')
+                    logger.critical(e)
+                if results[k] is None and not stop.is_set():
+                    stop.set()
+                    for other in futures:
+                        other.cancel()
+
+        choices = []
+        for result in results:
+            if result is None:
+                break
+            choices += result
+        if len(choices) < len(prompts):
+            logger.error(f'Generation stopped early. Got predictions for {len(choices)} of {len(prompts)} prompts')
+        return choices
+
+def group_choices(choices: List[Dict[str, Any]], n_prompts: int) -> List[List[Dict[str, Any]]]:
+    """The API returns n choices per prompt flattened, where choice index // n is the prompt."""
+    n = max(1, len(choices) // max(1, n_prompts))
+    grouped = [[] for _ in range(n_prompts)]
+    for choice in sorted(choices, key=lambda c: c["index"]):
+        grouped[choice["index"] // n].append(choice)
+    return grouped
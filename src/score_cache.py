@@ -0,0 +1,56 @@
+import os
+import json
+import sqlite3
+import hashlib
+import logging
+
+from typing import Any, List, Optional, Tuple
+
+from src.sqlite_util import select_many
+
+logger = logging.getLogger("apiLogger")
+
+Scores = Tuple[Any, Any, Any, Any]
+
+def text_hash(obj: Any) -> str:
+    return hashlib.sha1(json.dumps(obj, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def score_key(dataset: str, id: Any, prediction: str, golds: List[str], normalization: str = "") -> str:
+    """(dataset, id, hash of the prediction, hash of the gold answers, hash of the answer
+    normalization) folded into one key. The id is a string like in input_output_pairs.json,
+    whose keys can only be strings."""
+    return text_hash([dataset, str(id), text_hash(prediction), text_hash(golds), normalization])
+
+class ScoreCache:
+    """On disk SQLite store of the per question scores we have already computed.
+
+    The scores are stored as json so em stays a bool and the floats round trip exactly,
+    which keeps the aggregates rebuilt from the store identical to a full rescore.
+    """
+    def __init__(self, path: str):
+        self.path = os.path.expanduser(path)
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._conn = sqlite3.connect(self.path)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS scores ("
+                "key TEXT PRIMARY KEY, dataset TEXT NOT NULL, id TEXT NOT NULL, scores TEXT NOT NULL)"
+            )
+
+    def get_many(self, keys: List[str]) -> List[Optional[Scores]]:
+        found = select_many(self._conn, 'scores', 'scores', keys)
+        return [tuple(json.loads(found[key])) if key in found else None for key in keys]
+
+    def put_many(self, dataset: str, ids: List[Any], keys: List[str], scores: List[Scores]):
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO scores (key, dataset, id, scores) VALUES (?, ?, ?, ?)",
+                [
+                    (key, dataset, json.dumps(id), json.dumps(list(question_scores)))
+                    for id, key, question_scores in zip(ids, keys, scores)
+                ],
+            )
+
+    def close(self):
+        self._conn.close()
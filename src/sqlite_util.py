@@ -0,0 +1,17 @@
+import sqlite3
+
+from typing import Any, Dict, List
+
+# Stay under SQLite's limit on the number of query parameters
+MAX_QUERY_PARAMS = 500
+
+def select_many(conn: sqlite3.Connection, table: str, column: str, keys: List[str]) -> Dict[str, Any]:
+    """{key: column} of the rows of table whose key is one of keys. Missing keys are left out."""
+    found = {}
+    for i in range(0, len(keys), MAX_QUERY_PARAMS):
+        chunk = keys[i:i + MAX_QUERY_PARAMS]
+        found.update(conn.execute(
+            f"SELECT key, {column} FROM {table} WHERE key IN ({','.join('?' * len(chunk))})",
+            chunk,
+        ).fetchall())
+    return found
@@ -0,0 +1,113 @@
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Sequence, Tuple
+
+import numpy as np
+
+METRIC_NAMES = ('em', 'f1', 'prec', 'recall')
+
+def _as_float(values: np.ndarray) -> List[float]:
+    # Shortest repr of the float32 so 2/3 reads back as 0.6666667 and not 0.6666666865348816
+    return [float(s) for s in values.astype(str)]
+
+class ScoreStore(Mapping):
+    """Per question scores as one numpy column per metric plus an id -> row index.
+
+    Reads like the old {id: {'em', 'f1', 'prec', 'recall'}} dict, but a question costs
+    13 bytes instead of a dict of python objects. em is bool, the rest float32.
+    Optional group columns (e.g. the HotPotQA type and level) are stored as integer
+    codes into a list of categories and can be aggregated with groupby.
+    """
+    def __init__(
+        self,
+        ids: Sequence[Any],
+        columns: Dict[str, np.ndarray],
+        groups: Optional[Dict[str, Tuple[np.ndarray, List[Any]]]] = None,
+    ):
+        self.ids = list(ids)
+        self.columns = columns
+        self.groups = groups or {}
+        self._index: Optional[Dict[Any, int]] = None
+
+    @classmethod
+    def from_scores(
+        cls,
+        ids: Sequence[Any],
+        scores: Sequence[Tuple[Any, Any, Any, Any]],
+        groups: Optional[Dict[str, Sequence[Any]]] = None,
+    ) -> "ScoreStore":
+        """scores are (em, f1, prec, recall) tuples in the order of ids."""
+        n = len(scores)
+        columns = {'em': np.fromiter((s[0] for s in scores), dtype=bool, count=n)}
+        for k, name in enumerate(METRIC_NAMES[1:], 1):
+            columns[name] = np.fromiter((s[k] for s in scores), dtype=np.float32, count=n)
+
+        encoded = {}
+        for name, values in (groups or {}).items():
+            categories, codes = np.unique(np.asarray(values, dtype=object).astype(str), return_inverse=True)
+            encoded[name] = (codes.astype(np.int32), categories.tolist())
+        return cls(ids, columns, encoded)
+
+    @property
+    def index(self) -> Dict[Any, int]:
+        if self._index is None:
+            self._index = {id: row for row, id in enumerate(self.ids)}
+        return self._index
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(self.ids)
+
+    def __contains__(self, id: Any) -> bool:
+        return id in self.index
+
+    def __getitem__(self, id: Any) -> Dict[str, Any]:
+        row = self.index[id]
+        scores = {'em': bool(self.columns['em'][row])}
+        for name in METRIC_NAMES[1:]:
+            scores[name] = float(str(self.columns[name][row]))
+        return scores
+
+    def rows(self, ids: Sequence[Any]) -> np.ndarray:
+        """Row of every id, -1 for the ids that were not scored."""
+        index = self.index
+        return np.fromiter((index.get(id, -1) for id in ids), dtype=np.int64, count=len(ids))
+
+    def sums(self) -> Dict[str, float]:
+        return {name: float(self.columns[name].sum(dtype=np.float64)) for name in METRIC_NAMES}
+
+    def mean(self, n: Optional[int] = None) -> Dict[str, float]:
+        """Mean of every metric. Pass the number of questions to count the unscored ones as 0."""
+        n = len(self) if n is None else n
+        return {name: total / max(n, 1) for name, total in self.sums().items()}
+
+    def groupby(self, name: str) -> Dict[Any, Dict[str, float]]:
+        """Mean of every metric and the question count for each value of a group column."""
+        codes, categories = self.groups[name]
+        counts = np.bincount(codes, minlength=len(categories))
+        result = {category: {"count": int(count)} for category, count in zip(categories, counts)}
+        for metric in METRIC_NAMES:
+            sums = np.bincount(codes, weights=self.columns[metric], minlength=len(categories))
+            for category, total, count in zip(categories, sums, counts):
+                result[category][metric] = float(total / count) if count else 0.0
+        return result
+
+    def to_dict(self) -> Dict[Any, Dict[str, Any]]:
+        """The old dict of dicts, for the json output."""
+        em = self.columns['em'].tolist()
+        floats = [_as_float(self.columns[name]) for name in METRIC_NAMES[1:]]
+        return {
+            id: dict(zip(METRIC_NAMES, values))
+            for id, values in zip(self.ids, zip(em, *floats))
+        }
+
+    def to_arrow(self):
+        """id plus a column per metric and group. The float columns share memory with the numpy arrays."""
+        import pyarrow as pa
+
+        columns = {"id": self.ids}
+        for name in METRIC_NAMES:
+            columns[name] = pa.array(self.columns[name])
+        for name, (codes, categories) in self.groups.items():
+            columns[name] = pa.DictionaryArray.from_arrays(pa.array(codes), pa.array(categories))
+        return pa.table(columns)
@@ -0,0 +1,189 @@
+import os
+import json
+import logging
+import itertools
+import contextlib
+import dataclasses
+
+from typing import Any, Dict, Iterator, List, Tuple
+
+import hydra
+
+from omegaconf import OmegaConf
+
+from src import instrument
+from src.backends import Backend
+from src.cache import completion_key, evict_completions, sampling_params
+from src.config import (
+    MetricConfig,
+    OutputConfig,
+    DatasetConfig,
+    SchedulerConfig,
+    GenerationAPIConfig,
+    GenerationFuncConfig,
+    InstrumentationConfig,
+    to_dataclass,
+)
+from src.metrics import EVAL_ROWS, reduce_scores, score_incremental
+from src.our_datasets import batch_to_rows
+from src.scheduler import RateLimiter
+
+logger = logging.getLogger("apiLogger")
+
+SWEPT_SECTIONS = ('api', 'dataset')
+
+Point = Dict[str, Dict[str, Any]]
+
+def _plain(cfg: Any) -> Any:
+    return OmegaConf.to_container(cfg) if OmegaConf.is_config(cfg) else cfg
+
+def _key(obj: Any) -> str:
+    return json.dumps(obj, sort_keys=True, default=str)
+
+def expand_grid(grid: Dict[str, Dict[str, List[Any]]], points: List[Point]) -> List[Point]:
+    """Every combination of the grid values followed by the extra points."""
+    for section in list(grid) + [section for point in points for section in point]:
+        if section not in SWEPT_SECTIONS:
+            raise ValueError(f'Can only sweep over {SWEPT_SECTIONS}, not {section}')
+
+    names = [(section, name) for section, values in grid.items() for name in values]
+    expanded = []
+    for combination in itertools.product(*(grid[section][name] for section, name in names)):
+        point = {section: {} for section in SWEPT_SECTIONS}
+        for (section, name), value in zip(names, combination):
+            point[section][name] = value
+        expanded.append(point)
+    if not names:
+        expanded = []
+    expanded += [{section: dict(point.get(section, {})) for section in SWEPT_SECTIONS} for point in points]
+    return expanded or [{section: {} for section in SWEPT_SECTIONS}]
+
+@contextlib.contextmanager
+def in_dir(path: str) -> Iterator[None]:
+    os.makedirs(path, exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+def run_sweep(
+    api: GenerationAPIConfig,
+    dataset: DatasetConfig,
+    metric: MetricConfig,
+    output_func: OutputConfig,
+    generate_func: GenerationFuncConfig,
+    grid: Dict[str, Dict[str, List[Any]]],
+    points: List[Point],
+    output_dir: str,
+    summary_fname: str,
+    instrumentation: InstrumentationConfig = InstrumentationConfig(),
+    **kw,
+) -> Dict[str, Any]:
+    """Run every point of the sweep in this process.
+
+    Each distinct dataset config is built and preprocessed once (the split itself is
+    only loaded once, see our_datasets.load_split). The prompts of all the points are
+    deduplicated per set of sampling parameters and sent with one shared rate budget,
+    and every distinct (prediction, gold answers) pair is scored once in a single pass.
+    """
+    instrumentation = to_dataclass(instrumentation, InstrumentationConfig)
+    sweep_points = expand_grid(_plain(grid), _plain(points))
+    logger.info(f'Sweeping over {len(sweep_points)} configs')
+    backend = None
+    try:
+        # Dataset configs shared by several points are only built once
+        datasets: Dict[str, Tuple[Any, Any, Any, List[Dict[str, Any]]]] = {}
+        with instrument.stage('preprocess'):
+            for point in sweep_points:
+                key = _key(point['dataset'])
+                if key in datasets:
+                    continue
+                logger.info(f'Preprocessing the dataset with {point["dataset"] or "no overrides"}')
+                point_dataset = hydra.utils.instantiate(dataset, _convert_='all', **point['dataset'])
+                data = point_dataset.materialize(point_dataset())
+                labels = batch_to_rows(data.remove_columns(point_dataset.text_col)[:])
+                datasets[key] = (point_dataset, data, point_dataset.prompts(data), labels)
+
+        # Deduplicate the prompts of every point per set of sampling parameters
+        base_api = OmegaConf.to_object(api) if OmegaConf.is_config(api) else api
+        requests: Dict[str, Tuple[GenerationAPIConfig, Dict[str, str]]] = {}
+        point_keys = []
+        for point in sweep_points:
+            api_cfg = dataclasses.replace(base_api, **point['api'])
+            params = sampling_params(api_cfg)
+            prompts = list(datasets[_key(point['dataset'])][2])
+            keys = [completion_key(prompt, params) for prompt in prompts]
+            requests.setdefault(_key(params), (api_cfg, {}))[1].update(zip(keys, prompts))
+            point_keys.append(keys)
+
+        n_prompts = sum(len(keys) for keys in point_keys)
+        n_unique = sum(len(unique) for _, unique in requests.values())
+        logger.info(f'Generating {n_unique} unique prompts for the {n_prompts} prompts of the sweep')
+        instrument.count('sweep_prompts', n_prompts)
+        instrument.count('sweep_unique_prompts', n_unique)
+
+        generate = hydra.utils.instantiate(generate_func)
+        backend = getattr(generate, 'keywords', {}).get('backend')
+        scheduler = to_dataclass(generate_func.scheduler, SchedulerConfig)
+        # One budget for the whole sweep
+        limiter = RateLimiter(scheduler.requests_per_minute, scheduler.tokens_per_minute)
+        texts: Dict[str, str] = {}
+        with instrument.stage('generation'):
+            for api_cfg, unique in requests.values():
+                keys = list(unique)
+                predictions = generate(api_cfg=api_cfg, prompts=[unique[key] for key in keys], ids=keys, limiter=limiter)
+                texts.update(zip(keys, predictions))
+
+        # Score every distinct (prediction, golds) pair of all the points in one pass
+        eval_fn = hydra.utils.get_method(metric._target_)
+        score_name, build_rows = EVAL_ROWS[eval_fn]
+        unique_rows, unique_index = [], {}
+        scored_points = []
+        for point, keys in zip(sweep_points, point_keys):
+            _, data, _, labels = datasets[_key(point['dataset'])]
+            predictions = {id: texts[key] for id, key in zip(data['id'], keys) if key in texts}
+            rows, groups = build_rows(predictions, labels)
+            refs = []
+            for row in rows:
+                row_key = _key([row[1], row[2]])
+                if row_key not in unique_index:
+                    unique_index[row_key] = len(unique_rows)
+                    unique_rows.append(row)
+                refs.append(unique_index[row_key])
+            scored_points.append((predictions, rows, groups, refs))
+
+        logger.info(f'Scoring {len(unique_rows)} unique predictions for the sweep')
+        with instrument.stage('scoring'):
+            scores = score_incremental(score_name, unique_rows, metric.num_workers, metric.score_cache)
+
+        write = hydra.utils.instantiate(output_func)
+        summary = {"n_points": len(sweep_points), "n_prompts": n_prompts, "n_unique_prompts": n_unique,
+                   "n_unique_scored": len(unique_rows), "points": []}
+        with instrument.stage('output'):
+            for k, (point, (predictions, rows, groups, refs)) in enumerate(zip(sweep_points, scored_points)):
+                point_dataset, data, prompts, _ = datasets[_key(point['dataset'])]
+                metrics, per_question_metrics = reduce_scores(rows, [scores[i] for i in refs], len(data), groups)
+                point_dir = os.path.join(output_dir, str(k))
+                with in_dir(point_dir):
+                    with open('overrides.json', 'w') as f:
+                        json.dump(point, f, indent=4)
+                    write(
+                        dataset=prompts,
+                        answers=data[point_dataset.label_col],
+                        metrics=metrics,
+                        per_question_metrics=per_question_metrics,
+                        predictions=predictions,
+                    )
+                summary["points"].append({"dir": point_dir, "overrides": point, "metrics": metrics})
+
+        if summary_fname:
+            with open(summary_fname, 'w') as f:
+                json.dump(summary, f, indent=4)
+        return summary
+    finally:
+        if isinstance(backend, Backend):
+            backend.close()
+        evict_completions(generate_func.cache)
+        instrument.write(instrumentation)
@@ -1,7 +1,9 @@
 import json
 import logging
 
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, Sequence, Union
+
+import numpy as np
 
 from src.config import (
     MetricConfig,
@@ -10,21 +12,92 @@ from src.config import (
     GenerationAPIConfig,
     GenerationFuncConfig,
 )
+from src.prompts import SharedPrefixPrompts
+from src.store import ScoreStore
 
 logger = logging.getLogger("apiLogger")
 
+TABLE_FORMATS = ('parquet', 'arrow')
+
+def build_results_table(
+    dataset: Sequence[str],
+    answers: List[Any],
+    per_question_metrics: Union[ScoreStore, Dict[Any, Dict[str, float]]],
+    predictions: Dict[Any, str],
+    samples: Optional[Dict[Any, List[str]]] = None,
+):
+    """One row per prediction keyed by id with the input, prediction, answer and a column per metric.
+    With samples there is also a list column of every sampled text."""
+    import pyarrow as pa
+
+    ids = list(predictions.keys())
+    n_rows = len(ids)
+
+    metadata = None
+    inputs = dataset
+    if isinstance(dataset, SharedPrefixPrompts):
+        # Keep the shared prefix once in the schema metadata instead of on every row
+        metadata = {"shared_prefix": dataset.shared_prefix}
+        inputs = dataset.suffixes
+
+    columns = {
+        "id": ids,
+        "input": inputs[:n_rows],
+        "prediction": list(predictions.values()),
+        "answer": answers[:n_rows],
+    }
+    if samples:
+        columns["samples"] = [samples.get(id) for id in ids]
+    if isinstance(per_question_metrics, ScoreStore):
+        scores = per_question_metrics.to_arrow()
+        rows = per_question_metrics.rows(ids)
+        # Usually every prediction was scored in order and the columns are used as they are
+        if not np.array_equal(rows, np.arange(len(scores))):
+            scores = scores.take(pa.array(rows, mask=rows < 0))
+        for name in scores.column_names[1:]:
+            columns[name] = scores.column(name)
+        return pa.table(columns, metadata=metadata)
+
+    metric_names = []
+    for scores in per_question_metrics.values():
+        metric_names = list(scores.keys())
+        break
+    for name in metric_names:
+        columns[name] = [
+            per_question_metrics[id][name] if id in per_question_metrics else None
+            for id in ids
+        ]
+    return pa.table(columns, metadata=metadata)
+
+def write_table(fname: str, table, format: str):
+    if format == 'parquet':
+        import pyarrow.parquet as pq
+        pq.write_table(table, fname)
+    else:
+        # Uncompressed Arrow IPC file so it can be memory mapped with pyarrow.ipc.open_file
+        import pyarrow as pa
+        with pa.OSFile(fname, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
 def write_output(
     indent: int,
+    format: str,
+    table_output_fname: str,
     input_output_df_fname: str,
     metric_results_out_fname: str,
     predictions_output_fname: str,
     input_dataset_output_fname: str,
     per_question_metrics_out_fname: str,
-    dataset: List[str],
+    samples_output_fname: str,
+    sample_metrics_out_fname: str,
+    dataset: Sequence[str],
     answers: List[str],
     metrics: Dict[str, Any],
-    per_question_metrics: Dict[str, Dict[str, float]],
+    per_question_metrics: Union[ScoreStore, Dict[str, Dict[str, float]]],
     predictions: Dict[str, str],
+    samples: Optional[Dict[str, List[str]]] = None,
+    sample_metrics: Optional[Dict[str, Any]] = None,
 ):
     def write_json(fname: str, obj: Any, msg: str=""):
         if msg: logger.info(msg)
@@ -34,13 +107,31 @@ def write_output(
     if metric_results_out_fname:
         write_json(metric_results_out_fname, metrics, msg='Writing metrics to disk')
 
+    if sample_metrics and sample_metrics_out_fname:
+        write_json(sample_metrics_out_fname, sample_metrics, msg='Writing per sample metrics to disk')
+
+    if format in TABLE_FORMATS:
+        if table_output_fname:
+            fname = f'{table_output_fname}.{format}'
+            logger.info(f'Writing results table to {fname}')
+            table = build_results_table(dataset, answers, per_question_metrics, predictions, samples)
+            write_table(fname, table, format)
+        return
+    elif format != 'json':
+        raise ValueError(f'Unknown output format {format}. Choose json or one of {TABLE_FORMATS}')
+
     if input_dataset_output_fname:
-        write_json(input_dataset_output_fname, dataset, msg="Writing input data to disk")
+        write_json(input_dataset_output_fname, list(dataset), msg="Writing input data to disk")
 
     if predictions_output_fname:
         write_json(predictions_output_fname, predictions, msg='Writing predictions to disk')
+
+    if samples and samples_output_fname:
+        write_json(samples_output_fname, samples, msg='Writing every sample to disk')
     
     if per_question_metrics_out_fname:
+        if isinstance(per_question_metrics, ScoreStore):
+            per_question_metrics = per_question_metrics.to_dict()
         write_json(per_question_metrics_out_fname, per_question_metrics, msg="Writing per question metrics to disk")
 
     if input_output_df_fname:
@@ -56,7 +147,7 @@ def write_output(
         write_json(input_output_df_fname, data, msg="Writing input output pairs to disk")
 
 
-def dry_run(api_cfg: GenerationAPIConfig, prompts: List[str]):
+def dry_run(api_cfg: GenerationAPIConfig, prompts: List[str], **kw):
     logger.info('Dry run generation. Not calling OpenAI API.')
     return prompts
 
@@ -68,7 +159,7 @@ def unit_test(
 ):
     # Call the dataset preprocess method
     logger.info(f'I am the dataset features BEFORE preprocessing: {dataset.dataset.features}')
-    data = dataset()
+    data = dataset.materialize(dataset())
     logger.info(f'I am the dataset features AFTER preprocessing: {data.features}')
 
     logger.info('Running predictions ...')
@@ -84,7 +175,7 @@ def unit_test(
     )
     
     output_func(
-        dataset=data[dataset.text_col],
+        dataset=dataset.prompts(data),
         answers=data[dataset.label_col],
         metrics=metrics,
         per_question_metrics=per_question_metrics,
@@ -0,0 +1,96 @@
+import os
+import json
+import random
+
+import pytest
+import hydra
+from hydra import compose, initialize_config_dir
+from omegaconf import OmegaConf
+
+from src import instrument
+from src.backends import MockBackend
+from src.config import MockServerConfig
+from src.mock_server import WORDS
+
+CONF_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'conf')
+
+def write_hotpot(path, n: int, seed: int = 0):
+    """A HotPotQA shaped json split. The answers use the mock server words so the scores aren't all 0 or 1."""
+    rnd = random.Random(seed)
+    with open(path, 'w') as f:
+        for i in range(n):
+            context = {
+                "title": [f"title {j}" for j in range(2)],
+                "sentences": [[' '.join(rnd.choices(WORDS, k=6)) + '. ' for _ in range(2)] for _ in range(2)],
+            }
+            f.write(json.dumps({
+                "id": f"q{i}",
+                "question": ' '.join(rnd.choices(WORDS, k=5)) + '?',
+                "answer": ' '.join(rnd.choices(WORDS, k=rnd.randint(1, 3))),
+                "type": rnd.choice(["bridge", "comparison"]),
+                "level": rnd.choice(["easy", "medium", "hard"]),
+                "supporting_facts": {"title": ["title 0"], "sent_id": [0]},
+                "context": context,
+            }) + '\n')
+    return str(path)
+
+@pytest.fixture
+def hotpot_split(tmp_path):
+    """Dataset overrides that load an n row HotPotQA shaped split from a local json file."""
+    def split(n: int):
+        data_file = write_hotpot(tmp_path / f'hotpot_{n}.jsonl', n)
+        return [
+            'dataset.name=json',
+            'dataset.option=null',
+            'dataset.split=train',
+            f'dataset.data_files={data_file}',
+            f'dataset.cache_dir={tmp_path / "cache"}',
+        ]
+    return split
+
+@pytest.fixture
+def mock_backend():
+    """Overrides for the in process mock server without latency, rate limits or the completion cache."""
+    return [
+        'generate_func/backend=mock',
+        'generate_func.backend.server.latency_ms=0',
+        'generate_func.backend.server.latency_distribution=constant',
+        'generate_func.backend.server.rate_limit_rate=0',
+        'generate_func.cache.enabled=False',
+        'generate_func.scheduler.requests_per_minute=0',
+    ]
+
+@pytest.fixture
+def mock_server_backend():
+    """A MockBackend for calling batch_generate directly."""
+    backend = MockBackend(server=MockServerConfig(latency_ms=0, latency_distribution='constant', rate_limit_rate=0))
+    yield backend
+    backend.close()
+
+def compose_config(config_name, overrides):
+    """The config the command line would build, as dataclasses."""
+    with initialize_config_dir(config_dir=CONF_DIR, version_base="1.2"):
+        cfg = compose(config_name=config_name, overrides=overrides)
+    return OmegaConf.to_object(cfg)
+
+@pytest.fixture(autouse=True)
+def offline(monkeypatch):
+    monkeypatch.setenv('HF_DATASETS_OFFLINE', '1')
+
+@pytest.fixture
+def run_config(monkeypatch):
+    """Compose a config like the command line does and run it in its own directory."""
+    def run(config_name, overrides, run_dir):
+        cfg = compose_config(config_name, overrides)
+        os.makedirs(run_dir, exist_ok=True)
+        monkeypatch.chdir(run_dir)
+        instrument.INSTRUMENT.reset()
+        return hydra.utils.instantiate(cfg)
+    return run
+
+@pytest.fixture
+def build_dataset():
+    """Preprocess only the dataset of a config."""
+    def build(overrides, config_name='unit_test'):
+        return hydra.utils.instantiate(compose_config(config_name, overrides).dataset)
+    return build
@@ -0,0 +1,18 @@
+from src.backends import MockBackend, OpenAIBackend
+
+def test_openai_cache_namespace_follows_api_base():
+    assert OpenAIBackend().cache_namespace == ""
+    assert OpenAIBackend(api_base="http://localhost:8000/v1/").cache_namespace == "http://localhost:8000/v1"
+
+def test_entry_point_stops_the_mock_server(tmp_path, hotpot_split, mock_backend, run_config, monkeypatch):
+    servers = []
+    close = MockBackend.close
+
+    def record_close(self):
+        servers.append(self.server)
+        close(self)
+    monkeypatch.setattr(MockBackend, 'close', record_close)
+
+    run_config('main', hotpot_split(25) + mock_backend, tmp_path / 'run')
+    assert len(servers) == 1 and servers[0] is not None
+    assert servers[0]._server is None
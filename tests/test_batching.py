@@ -0,0 +1,55 @@
+import pytest
+
+from src import batching
+from src.batching import pack_slices, plan_batches, truncate
+from src.config import SchedulerConfig
+
+class WordCounter:
+    """One token per word so the tests don't need a tokenizer download"""
+    def __init__(self, tokenizer_name: str = "words"):
+        self.vocab = {}
+
+    def encode(self, prompts):
+        return [[self.vocab.setdefault(word, len(self.vocab)) for word in prompt.split()] for prompt in prompts]
+
+    def decode(self, token_ids):
+        words = {i: word for word, i in self.vocab.items()}
+        return ' '.join(words[i] for i in token_ids)
+
+def words(n, start=0):
+    return ' '.join(f'w{i}' for i in range(start, start + n))
+
+PROMPTS = [words(3), words(6, 10), words(2, 20)]
+
+@pytest.mark.parametrize('policy,expected', [
+    ('left', [words(3), words(4, 12), words(2, 20)]),
+    ('right', [words(3), words(4, 10), words(2, 20)]),
+    ('none', PROMPTS),
+])
+def test_truncate(policy, expected):
+    counter = WordCounter()
+    prompts, counts = truncate(counter, PROMPTS, counter.encode(PROMPTS), max_prompt_tokens=4, policy=policy)
+    assert prompts == expected
+    assert counts == [len(prompt.split()) for prompt in expected]
+
+def test_truncate_unknown_policy():
+    counter = WordCounter()
+    with pytest.raises(ValueError):
+        truncate(counter, PROMPTS, counter.encode(PROMPTS), max_prompt_tokens=4, policy='middle')
+
+def test_pack_slices():
+    # Token budget of 10 with 2 completion tokens per prompt
+    assert pack_slices([3, 3, 1, 9, 2, 2, 2], 2, 10, 3) == [(0, 2), (2, 3), (3, 4), (4, 6), (6, 7)]
+    # The batch size caps the slices too
+    assert pack_slices([1] * 5, 0, 100, 2) == [(0, 2), (2, 4), (4, 5)]
+    assert pack_slices([], 2, 10, 3) == []
+
+def test_plan_batches(monkeypatch):
+    monkeypatch.setattr(batching, 'TokenCounter', WordCounter)
+    cfg = SchedulerConfig(batch_size=2, context_window=9, max_request_tokens=16, truncation='left')
+    prompts, slices, counts = plan_batches(cfg, PROMPTS, max_tokens=4, completion_tokens=4)
+    assert prompts == [words(3), words(5, 11), words(2, 20)]
+    assert counts == [3, 5, 2]
+    assert slices == [(0, 2), (2, 3)]
+    # Every prompt ends up in exactly one slice, in order
+    assert [i for start, end in slices for i in range(start, end)] == list(range(len(PROMPTS)))
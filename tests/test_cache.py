@@ -0,0 +1,67 @@
+import json
+import time
+
+from src.cache import CompletionCache, completion_key, sampling_params
+from src.config import CacheConfig, GenerationAPIConfig, SchedulerConfig
+from src.main import batch_generate
+
+def choices(text):
+    return [{"text": text, "index": 0, "logprobs": None, "finish_reason": "stop"}]
+
+def test_key_covers_the_sampling_params_but_not_stream():
+    params = sampling_params(GenerationAPIConfig())
+    key = completion_key('question', params)
+    assert completion_key('question', sampling_params(GenerationAPIConfig(stream=True))) == key
+    assert completion_key('question', sampling_params(GenerationAPIConfig(temperature=0))) != key
+    assert completion_key('question', {**params, "backend": "mock"}) != key
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    entry = json.dumps(choices('x' * 100))
+    # Room for two entries
+    cache = CompletionCache(str(tmp_path / 'c.sqlite'), max_size_mb=2.5 * len(entry) / 2 ** 20)
+    for key in ('a', 'b', 'c'):
+        cache.put_many([key], [choices('x' * 100)])
+        time.sleep(0.01)
+    # Reading a makes b the least recently used
+    assert cache.get_many(['a'])[0] is not None
+    assert cache.evict() == 1
+    assert [value is not None for value in cache.get_many(['a', 'b', 'c'])] == [True, False, True]
+    cache.close()
+
+def test_many_keys(tmp_path):
+    cache = CompletionCache(str(tmp_path / 'c.sqlite'))
+    keys = [f'key {i}' for i in range(1200)]
+    cache.put_many(keys[::2], [choices(key) for key in keys[::2]])
+    found = cache.get_many(keys)
+    assert [value is not None for value in found] == [i % 2 == 0 for i in range(1200)]
+    assert (cache.hits, cache.misses) == (600, 600)
+    cache.close()
+
+def test_backends_do_not_share_completions(tmp_path, monkeypatch, mock_server_backend):
+    monkeypatch.chdir(tmp_path)
+    cache = CacheConfig(path=str(tmp_path / 'c.sqlite'))
+
+    def generate():
+        return batch_generate(
+            GenerationAPIConfig(max_tokens=3), ['question'], scheduler=SchedulerConfig(requests_per_minute=0),
+            cache=cache, results_log="", backend=mock_server_backend,
+        )
+    first = generate()
+    sent = []
+    complete = mock_server_backend.complete
+    monkeypatch.setattr(mock_server_backend, 'complete', lambda api_cfg, prompts: sent.extend(prompts) or complete(api_cfg, prompts))
+    assert generate() == first and sent == []
+
+    monkeypatch.setattr(mock_server_backend, 'cache_namespace', 'another server')
+    generate()
+    assert sent == ['question']
+
+def test_eviction_runs_once_per_run(tmp_path, hotpot_split, mock_backend, run_config, monkeypatch):
+    evictions = []
+    evict = CompletionCache.evict
+    monkeypatch.setattr(CompletionCache, 'evict', lambda self: evictions.append(self.path) or evict(self))
+    run_config('main', hotpot_split(30) + mock_backend + [
+        'dataset.streaming=True', 'dataset.batch_size=5',
+        'generate_func.cache.enabled=True', f'generate_func.cache.path={tmp_path / "c.sqlite"}',
+    ], tmp_path / 'run')
+    assert evictions == [str(tmp_path / 'c.sqlite')]
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from src.calibration import RaggedLogprobs, _ranks, auroc, calibration_curve
+
+def brute_force_ranks(x):
+    return [sum(y < v for y in x) + (sum(y == v for y in x) + 1) / 2 for v in x]
+
+def brute_force_auroc(confidence, correct):
+    # Chance a right answer is more confident than a wrong one, ties count half
+    pairs = [(r, w) for r, ok in zip(confidence, correct) if ok for w, bad in zip(confidence, correct) if not bad]
+    return sum(1.0 if r > w else 0.5 if r == w else 0.0 for r, w in pairs) / len(pairs)
+
+@pytest.mark.parametrize('seed', range(5))
+def test_ranks_and_auroc_match_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    # Rounded so there are plenty of ties
+    confidence = rng.random(30).round(1)
+    correct = rng.random(30) < 0.5
+    assert _ranks(confidence).tolist() == brute_force_ranks(confidence.tolist())
+    assert auroc(confidence, correct) == pytest.approx(brute_force_auroc(confidence, correct))
+
+def test_auroc_needs_both_classes():
+    assert auroc(np.array([0.1, 0.9]), np.array([True, True])) is None
+    assert auroc(np.array([0.1, 0.9]), np.array([False, False])) is None
+    assert auroc(np.array([0.1, 0.9]), np.array([False, True])) == 1.0
+
+def test_ragged_logprobs():
+    logprobs = RaggedLogprobs.from_lists(['a', 'b', 'c'], [[-1.0, -0.5], None, [-2.0]])
+    assert len(logprobs) == 3
+    assert logprobs.lengths.tolist() == [2, 0, 1]
+    assert logprobs[0].tolist() == [-1.0, -0.5]
+    assert logprobs.sums().tolist() == [-1.5, 0.0, -2.0]
+    means = logprobs.means()
+    assert means[0] == -0.75 and np.isnan(means[1]) and means[2] == -2.0
+
+def test_ragged_logprobs_save_and_load(tmp_path):
+    logprobs = RaggedLogprobs.from_lists(['a', 'b'], [[-1.0], [-0.25, -0.25]])
+    logprobs.save(str(tmp_path / 'logprobs.npz'))
+    loaded = RaggedLogprobs.load(str(tmp_path / 'logprobs.npz'))
+    assert loaded.ids == ['a', 'b']
+    assert loaded.sums().tolist() == logprobs.sums().tolist()
+
+def test_calibration_curve():
+    confidence = np.array([0.05, 0.15, 0.95, 0.95, 1.0])
+    correct = np.array([0.0, 1.0, 1.0, 0.0, 1.0])
+    curve = calibration_curve(confidence, correct, n_bins=10)
+    # Confidence 1 goes in the last bin
+    assert [b['count'] for b in curve['bins']] == [1, 1, 0, 0, 0, 0, 0, 0, 0, 3]
+    assert curve['bins'][9]['accuracy'] == pytest.approx(2 / 3)
+    expected = (abs(0 - 0.05) + abs(1 - 0.15) + 3 * abs(2 / 3 - (0.95 + 0.95 + 1.0) / 3)) / 5
+    assert curve['ece'] == pytest.approx(expected)
@@ -0,0 +1,15 @@
+import pytest
+from hydra.errors import InstantiationException
+
+def test_few_shot_pool_clamped_to_small_split(hotpot_split, build_dataset):
+    # 20 samples leave 5 rows for the pool instead of the 1000 asked for
+    dataset = build_dataset(hotpot_split(25) + [
+        'dataset.select_n_samples=20', 'dataset.few_shot_retrieval=bm25', 'dataset.few_shot_pool_size=1000',
+    ])
+    assert len(dataset._few_shot_pool) == 5
+    assert len(dataset.dataset) == 20
+
+def test_few_shot_examples_need_rows_after_the_samples(hotpot_split, build_dataset):
+    with pytest.raises(InstantiationException, match='No rows left for the few shot examples') as error:
+        build_dataset(hotpot_split(20) + ['dataset.select_n_samples=20', 'dataset.n_few_shot=1'])
+    assert isinstance(error.value.__cause__, ValueError)
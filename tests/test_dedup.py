@@ -0,0 +1,42 @@
+import numpy as np
+
+from src.config import DedupConfig
+from src.dedup import Deduplicator, MinHashLSH, exact_duplicates, fan_out
+from src.sampling import Samples
+
+def test_exact_duplicates_and_fan_out():
+    unique, inverse = exact_duplicates(['a', 'b', 'a', 'c', 'b'])
+    assert unique == [0, 1, 3]
+    assert inverse.tolist() == [0, 1, 0, 2, 1]
+    assert fan_out(['A', 'B', 'C'], inverse) == ['A', 'B', 'A', 'C', 'B']
+    # Stops at the first row whose prompt was not generated
+    assert fan_out(['A'], inverse) == ['A']
+
+def test_near_duplicates_behind_a_dissimilar_first_row():
+    lsh = MinHashLSH(num_perm=4, bands=2, shingle_size=1)
+    # All three share the first band. b and c agree on 3 of 4 values, a on 2 with either
+    lsh.ids = ['a', 'b', 'c']
+    lsh.signatures = [np.array(signature, dtype=np.uint64) for signature in ([1, 2, 3, 4], [1, 2, 5, 6], [1, 2, 5, 7])]
+    assert lsh.clusters(0.7) == [{"ids": ['b', 'c'], "min_jaccard": 0.75}]
+
+def test_near_duplicate_prompts_are_reported():
+    lsh = MinHashLSH(num_perm=128, bands=32, shingle_size=2)
+    lsh.add('q0', 'who wrote the album abbey road for the band')
+    lsh.add('q1', 'who wrote the album abbey road for the band?')
+    lsh.add('q2', 'which river runs through the city of london')
+    [cluster] = lsh.clusters(0.5)
+    assert cluster["ids"] == ['q0', 'q1']
+
+def test_deduplicator_sends_each_prompt_once():
+    calls = []
+
+    def generate(api_cfg, prompts, ids, **kw):
+        calls.append(list(ids))
+        return Samples([prompt.upper() for prompt in prompts], [[prompt] for prompt in prompts])
+
+    deduplicator = Deduplicator(DedupConfig(enabled=True), generate)
+    predictions = deduplicator(None, ['x', 'y', 'x'], ids=[0, 1, 2])
+    assert calls == [[0, 1]]
+    assert list(predictions) == ['X', 'Y', 'X']
+    assert predictions.samples == [['x'], ['y'], ['x']]
+    assert deduplicator.report()["exact_duplicates"] == [[0, 2]]
@@ -0,0 +1,25 @@
+import src.main
+
+def test_batches_share_one_rate_limiter(tmp_path, hotpot_split, mock_backend, run_config, monkeypatch):
+    limiters = []
+    batch_generate = src.main.batch_generate
+
+    def record_limiter(*args, limiter=None, **kw):
+        limiters.append(limiter)
+        return batch_generate(*args, limiter=limiter, **kw)
+    monkeypatch.setattr(src.main, 'batch_generate', record_limiter)
+
+    run_config('main', hotpot_split(30) + mock_backend + [
+        'dataset.streaming=True', 'dataset.batch_size=5', 'generate_func.scheduler.requests_per_minute=1000',
+    ], tmp_path / 'stream')
+    run_config('main', hotpot_split(30) + mock_backend + [
+        'pipeline.enabled=True', 'pipeline.batch_size=5', 'generate_func.scheduler.requests_per_minute=1000',
+    ], tmp_path / 'pipeline')
+
+    assert len(limiters) == 8
+    stream, pipeline = limiters[:4], limiters[4:]
+    for limiters_of_run in (stream, pipeline):
+        assert limiters_of_run[0] is not None
+        assert all(limiter is limiters_of_run[0] for limiter in limiters_of_run)
+        assert limiters_of_run[0].requests_per_minute == 1000
+    assert stream[0] is not pipeline[0]
@@ -0,0 +1,31 @@
+import src.metrics as metrics
+from src.metrics import NormalizedAnswers, gold_columns, normalize_answers, reduce_scores, score_all, score_incremental
+
+ROWS = [
+    ('q0', 'The Eiffel Tower', ['Eiffel tower!', 'the tower']),
+    ('q1', 'London', ['Paris']),
+    ('q2', 'two albums', ['Two']),
+]
+
+def test_gold_columns_only_keep_the_normalized_answers():
+    assert gold_columns(['The Beatles', ['a Band', 'Band!']]) == {'gold_norm': [['beatles'], ['band', 'band']]}
+
+def test_raw_and_normalized_golds_share_the_score_cache(tmp_path, monkeypatch):
+    score_cache = str(tmp_path / 'scores.sqlite')
+    normalized_rows = [(id, prediction, NormalizedAnswers(normalize_answers(golds))) for id, prediction, golds in ROWS]
+    first = score_incremental('nq_open', normalized_rows, score_cache=score_cache)
+
+    scored = []
+    score_all = metrics.score_all
+    monkeypatch.setattr(metrics, 'score_all', lambda rows, num_workers: scored.extend(rows) or score_all(rows, num_workers))
+    # Like src.rescore, which reads the raw gold answers back from the outputs
+    assert score_incremental('nq_open', ROWS, score_cache=score_cache) == first
+    assert scored == []
+
+def test_score_all_workers_match_the_serial_path():
+    # Enough rows for several chunks per worker
+    rows = [(f'q{i}', ROWS[i % 3][1] + ' two' * (i % 2), ROWS[i % 3][2]) for i in range(40)]
+    serial = score_all(rows, num_workers=1)
+    pooled = score_all(rows, num_workers=2)
+    assert pooled == serial
+    assert reduce_scores(rows, pooled, len(rows))[0] == reduce_scores(rows, serial, len(rows))[0]
@@ -0,0 +1,37 @@
+import json
+
+from src.config import NGramIndexConfig
+from src.ngram_index import NGramIndex
+
+DOCS = ['the band recorded the album in london', 'the river runs through the city', 'the band played in paris']
+
+def write_corpus(path, docs):
+    with open(path, 'w') as f:
+        for doc in docs:
+            f.write(json.dumps({"text": doc}) + '\n')
+    return str(path)
+
+def test_overlap_counts(tmp_path):
+    cfg = NGramIndexConfig(corpus=write_corpus(tmp_path / 'corpus.jsonl', DOCS), orders=[1, 2], n_buckets=4, chunk_docs=2)
+    index = NGramIndex.build(cfg, str(tmp_path / 'index'))
+    assert index.meta['n_docs'] == 3
+
+    [stats] = index.overlap(['the band played in rome'])
+    assert (stats['1gram_total'], stats['1gram_found']) == (5, 4)
+    # "the band" is in two documents, "in rome" in none
+    assert (stats['2gram_total'], stats['2gram_found'], stats['2gram_min_count']) == (4, 3, 0)
+    assert index.lookup(index.hasher.hash_text('the band', 2)).tolist() == [2]
+
+def test_index_is_rebuilt_when_the_config_changes(tmp_path):
+    index_dir = str(tmp_path / 'index')
+    cfg = NGramIndexConfig(corpus=write_corpus(tmp_path / 'a.jsonl', DOCS), orders=[1])
+    built = NGramIndex.load_or_build(cfg, index_dir)
+    assert NGramIndex.load_or_build(cfg, index_dir).meta == built.meta
+
+    cfg.orders = [1, 2]
+    assert NGramIndex.load_or_build(cfg, index_dir).orders == [1, 2]
+
+    cfg.corpus = write_corpus(tmp_path / 'b.jsonl', DOCS[:1])
+    rebuilt = NGramIndex.load_or_build(cfg, index_dir)
+    assert rebuilt.meta['corpus'] == cfg.corpus and rebuilt.meta['n_docs'] == 1
+    assert rebuilt.overlap(['river'])[0]['1gram_found'] == 0
@@ -0,0 +1,36 @@
+import os
+import json
+
+import pytest
+import pyarrow.parquet as pq
+
+OUTPUTS = [
+    'metrics.json', 'per_question_metrics.json', 'input_output_pairs.json', 'predictions.json', 'dataset.json',
+]
+SAMPLE_OUTPUTS = ['metrics.json', 'sample_metrics.json', 'calibration.json']
+
+def read_json(run_dir, fname):
+    with open(os.path.join(run_dir, fname)) as f:
+        return json.load(f)
+
+def run_both(tmp_path, run_config, overrides):
+    run_config('main', overrides, tmp_path / 'phased')
+    run_config('main', overrides + ['pipeline.enabled=True', 'pipeline.batch_size=3'], tmp_path / 'pipeline')
+    return tmp_path / 'phased', tmp_path / 'pipeline'
+
+@pytest.mark.parametrize('extra', [[], ['dataset.streaming=True']])
+def test_pipeline_outputs_match_phased_run(tmp_path, hotpot_split, mock_backend, run_config, extra):
+    phased, pipelined = run_both(tmp_path, run_config, hotpot_split(40) + mock_backend + extra)
+    assert 0 < read_json(phased, 'metrics.json')['f1'] < 1
+    for fname in OUTPUTS:
+        assert read_json(pipelined, fname) == read_json(phased, fname), fname
+
+def test_pipeline_writes_tables_samples_and_calibration(tmp_path, hotpot_split, mock_backend, run_config):
+    phased, pipelined = run_both(tmp_path, run_config, hotpot_split(40) + mock_backend + [
+        'api.n=3', 'api.logprobs=1', 'generate_func.aggregation=majority', 'output_func.format=parquet',
+    ])
+    for fname in SAMPLE_OUTPUTS:
+        assert read_json(pipelined, fname) == read_json(phased, fname), fname
+    phased_table = pq.read_table(phased / 'results.parquet')
+    assert 'samples' in phased_table.column_names
+    assert pq.read_table(pipelined / 'results.parquet').equals(phased_table)
@@ -0,0 +1,38 @@
+import json
+
+import pytest
+
+from src.rescore import infer_dataset, read_run, rescore
+
+def read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+def test_rescore_matches_the_run(tmp_path, hotpot_split, mock_backend, run_config):
+    overrides = hotpot_split(40) + mock_backend
+    run_config('main', overrides, tmp_path / 'json')
+    expected = read_json(tmp_path / 'json' / 'metrics.json')
+    # The tables keep the per question metrics in their columns instead of per_question_metrics.json
+    expected_per_question = read_json(tmp_path / 'json' / 'per_question_metrics.json')
+    for fmt in ('json', 'parquet', 'arrow'):
+        if fmt != 'json':
+            run_config('main', overrides + [f'output_func.format={fmt}'], tmp_path / fmt)
+        metrics, per_question_metrics = rescore(str(tmp_path / fmt))
+        assert metrics == expected, fmt
+        assert per_question_metrics.to_dict() == expected_per_question, fmt
+
+def test_rescore_other_predictions(tmp_path, hotpot_split, mock_backend, run_config):
+    run_dir = tmp_path / 'run'
+    run_config('main', hotpot_split(40) + mock_backend, run_dir)
+    assert read_json(run_dir / 'metrics.json')['em'] < 1
+
+    _, labels = read_run(str(run_dir))
+    assert infer_dataset(labels) == 'hotpot_qa'
+    with open(tmp_path / 'gold.json', 'w') as f:
+        json.dump({label['id']: label['answer'] for label in labels}, f)
+    metrics, _ = rescore(str(run_dir), predictions_fname=str(tmp_path / 'gold.json'))
+    assert metrics['em'] == metrics['f1'] == 1
+
+def test_rescore_without_outputs(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        rescore(str(tmp_path))
@@ -0,0 +1,54 @@
+import os
+import json
+
+from src.config import CacheConfig, GenerationAPIConfig, SchedulerConfig
+from src.main import batch_generate
+from src.result_log import ResultLog
+
+PROMPTS = [f'question {i}' for i in range(10)]
+
+def generate(backend, results_log, **kw):
+    return batch_generate(
+        GenerationAPIConfig(max_tokens=3),
+        PROMPTS,
+        scheduler=SchedulerConfig(batch_size=3, requests_per_minute=0),
+        cache=CacheConfig(enabled=False),
+        results_log=str(results_log),
+        backend=backend,
+        **kw,
+    )
+
+def test_read_skips_a_truncated_last_line(tmp_path):
+    log = ResultLog(str(tmp_path / 'generations.jsonl'))
+    log.append(['a', 'b'], [[{"text": " yes"}], [{"text": " no"}]])
+    with open(log.path, 'a') as f:
+        f.write('{"id": "c", "prediction": " th')
+    assert log.read() == {'a': [{"text": " yes"}], 'b': [{"text": " no"}]}
+
+def test_resume_only_sends_the_missing_prompts(tmp_path, monkeypatch, mock_server_backend):
+    monkeypatch.chdir(tmp_path)
+    # The log is in a directory that doesn't exist yet
+    results_log = tmp_path / 'logs' / 'generations.jsonl'
+    first = generate(mock_server_backend, results_log)
+    assert len(first) == len(PROMPTS)
+
+    # Drop the last two prompts and cut the line before them short, like a killed run
+    with open(results_log) as f:
+        lines = sorted(f, key=lambda line: json.loads(line)['id'])
+    with open(results_log, 'w') as f:
+        f.writelines(lines[:7])
+        f.write(lines[7][:10])
+
+    sent = []
+    complete = mock_server_backend.complete
+    monkeypatch.setattr(mock_server_backend, 'complete', lambda api_cfg, prompts: sent.extend(prompts) or complete(api_cfg, prompts))
+    assert generate(mock_server_backend, results_log, resume=True) == first
+    assert sent == PROMPTS[7:]
+
+def test_responses_are_kept_when_the_debug_dump_fails(tmp_path, monkeypatch, mock_server_backend):
+    monkeypatch.chdir(tmp_path)
+    # A directory where the raw response of the first batch would go
+    os.mkdir('response_0.json')
+    predictions = generate(mock_server_backend, tmp_path / 'generations.jsonl')
+    assert len(predictions) == len(PROMPTS)
+    assert len(ResultLog(str(tmp_path / 'generations.jsonl')).read()) == len(PROMPTS)
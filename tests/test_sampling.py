@@ -0,0 +1,23 @@
+import json
+
+from src.config import CacheConfig, GenerationAPIConfig, SchedulerConfig
+from src.main import batch_generate
+
+def test_results_log_has_the_aggregated_prediction(tmp_path, monkeypatch, mock_server_backend):
+    monkeypatch.chdir(tmp_path)
+    # One word answers out of a few words, so the majority is often not the first sample
+    predictions = batch_generate(
+        GenerationAPIConfig(n=5, max_tokens=1),
+        [f'question {i}' for i in range(30)],
+        scheduler=SchedulerConfig(requests_per_minute=0),
+        cache=CacheConfig(enabled=False),
+        backend=mock_server_backend,
+        aggregation='majority',
+    )
+
+    with open('generations.jsonl') as f:
+        # The requests finish in any order
+        records = sorted((json.loads(line) for line in f), key=lambda record: record['id'])
+    assert [record['id'] for record in records] == list(range(30))
+    assert [record['prediction'] for record in records] == list(predictions)
+    assert any(record['prediction'] != record['choices'][0]['text'] for record in records)
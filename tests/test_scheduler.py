@@ -0,0 +1,77 @@
+import time
+import threading
+
+import pytest
+
+from src import instrument
+from src.backends import BackendError, RateLimited
+from src.config import SchedulerConfig
+from src.scheduler import GenerationScheduler, RateLimiter, group_choices
+
+def response(prompts, start, n=1):
+    return {"choices": [
+        {"text": f"{prompt} {j}", "index": i * n + j} for i, prompt in enumerate(prompts) for j in range(n)
+    ]}
+
+def scheduler(**kw):
+    cfg = dict(batch_size=2, max_in_flight=4, requests_per_minute=0, tokens_per_minute=0, backoff_base=0.001)
+    return GenerationScheduler(SchedulerConfig(**{**cfg, **kw}))
+
+def texts(choices):
+    return [[choice["text"] for choice in prompt_choices] for prompt_choices in choices]
+
+PROMPTS = [f'p{i}' for i in range(7)]
+
+def test_rate_limiter_waits_for_the_window():
+    limiter = RateLimiter(requests_per_minute=2, window=0.2)
+    assert limiter.acquire(1) == 0 and limiter.acquire(1) == 0
+    start = time.monotonic()
+    assert limiter.acquire(1) > 0
+    assert time.monotonic() - start >= 0.15
+
+def test_rate_limiter_token_budget():
+    limiter = RateLimiter(tokens_per_minute=10, window=0.2)
+    # Bigger than the whole budget but the window is empty
+    assert limiter.acquire(50) == 0
+    assert limiter.acquire(5) > 0
+    assert limiter.acquire(5) == 0
+
+def test_choices_come_back_in_prompt_order():
+    def request(prompts, start):
+        # Later slices finish first
+        time.sleep(0.01 * (len(PROMPTS) - start))
+        return response(prompts, start, n=2)
+    assert texts(scheduler().run(PROMPTS, request)) == [[f'{p} 0', f'{p} 1'] for p in PROMPTS]
+
+def test_rate_limited_requests_are_retried():
+    instrument.INSTRUMENT.reset()
+    failures = {0: 2, 4: 1}
+    lock = threading.Lock()
+
+    def request(prompts, start):
+        with lock:
+            if failures.get(start):
+                failures[start] -= 1
+                raise RateLimited('429')
+        return response(prompts, start)
+    assert texts(scheduler(max_retries=2).run(PROMPTS, request)) == [[f'{p} 0'] for p in PROMPTS]
+    assert instrument.INSTRUMENT.counters['api_retries'] == 3
+
+def test_backoff_is_capped():
+    s = scheduler(backoff_base=1.0, backoff_max=4.0)
+    assert all(0 <= s.backoff(attempt) <= min(4.0, 2 ** attempt) for attempt in range(6) for _ in range(20))
+
+@pytest.mark.parametrize('failure', ['quota', 'error', 'retries'])
+def test_run_stops_and_keeps_the_leading_slices(failure):
+    def request(prompts, start):
+        if start == 4:
+            if failure == 'quota':
+                return None
+            raise BackendError('bad request') if failure == 'error' else RateLimited('429')
+        return response(prompts, start)
+    # Only the slices before the failed one are returned so the choices stay aligned with the prompts
+    assert texts(scheduler(max_retries=1, max_in_flight=1).run(PROMPTS, request)) == [['p0 0'], ['p1 0'], ['p2 0'], ['p3 0']]
+
+def test_group_choices():
+    grouped = group_choices([{"index": 3}, {"index": 0}, {"index": 2}, {"index": 1}], 2)
+    assert grouped == [[{"index": 0}, {"index": 1}], [{"index": 2}, {"index": 3}]]
@@ -0,0 +1,37 @@
+import src.metrics as metrics
+from src.metrics import score_incremental
+from src.score_cache import ScoreCache, score_key
+
+ROWS = [('q0', 'Paris, France', ['paris']), ('q1', 'London', ['Paris'])]
+
+def count_scored(monkeypatch):
+    scored = []
+    score_all = metrics.score_all
+    monkeypatch.setattr(metrics, 'score_all', lambda rows, num_workers: scored.extend(rows) or score_all(rows, num_workers))
+    return scored
+
+def test_scores_round_trip(tmp_path):
+    cache = ScoreCache(str(tmp_path / 'scores.sqlite'))
+    # More keys than fit in one query
+    keys = [score_key('nq_open', i, 'yes', ['no']) for i in range(1200)]
+    scores = [(i % 2 == 0, 2 / 3, 1 / 3, 0.1 * i) for i in range(1200)]
+    cache.put_many('nq_open', list(range(1200)), keys, scores)
+    assert cache.get_many(keys + ['missing']) == scores + [None]
+    cache.close()
+
+def test_only_changed_predictions_are_rescored(tmp_path, monkeypatch):
+    score_cache = str(tmp_path / 'scores.sqlite')
+    first = score_incremental('nq_open', ROWS, score_cache=score_cache)
+    scored = count_scored(monkeypatch)
+    rows = ROWS[:1] + [('q1', 'Paris', ['Paris'])]
+    second = score_incremental('nq_open', rows, score_cache=score_cache)
+    assert scored == rows[1:]
+    assert second[0] == first[0] and second[1][0]
+
+def test_changing_the_normalization_rescores(tmp_path, monkeypatch):
+    score_cache = str(tmp_path / 'scores.sqlite')
+    score_incremental('nq_open', ROWS, score_cache=score_cache)
+    scored = count_scored(monkeypatch)
+    monkeypatch.setattr(metrics, 'normalization_hash', lambda: 'another normalization')
+    score_incremental('nq_open', ROWS, score_cache=score_cache)
+    assert scored == ROWS
@@ -0,0 +1,24 @@
+import os
+import json
+
+def read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+GRID = ['+grid.api.temperature=[0,0.7]', '+grid.dataset.n_few_shot=[0,1]', '+points=[{api: {temperature: 0}}]']
+
+def test_sweep_points_match_single_runs(tmp_path, hotpot_split, mock_backend, run_config):
+    overrides = hotpot_split(30) + mock_backend + ['dataset.select_n_samples=20']
+    summary = run_config('sweep', overrides + GRID, tmp_path / 'sweep')
+    assert summary['n_points'] == 5
+    # The extra point repeats the first one so its prompts are only sent once
+    assert summary['n_prompts'] == 100 and summary['n_unique_prompts'] == 80
+    assert read_json(tmp_path / 'sweep' / 'sweep.json') == summary
+
+    for k, point in enumerate(summary['points']):
+        assert point['overrides'] == read_json(tmp_path / 'sweep' / point['dir'] / 'overrides.json')
+        single = [f'{section}.{name}={value}' for section, values in point['overrides'].items() for name, value in values.items()]
+        run_config('main', overrides + single, tmp_path / str(k))
+        assert point['metrics'] == read_json(tmp_path / str(k) / 'metrics.json'), point['overrides']
+        for fname in ('per_question_metrics.json', 'predictions.json'):
+            assert read_json(tmp_path / 'sweep' / point['dir'] / fname) == read_json(tmp_path / str(k) / fname), fname